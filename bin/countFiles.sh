@@ -12,6 +12,13 @@ if [ -z ${WRK+x} ]; then
 	exit 20
 fi
 
+# use the product manifest (bcd rows recorded by setup_pipeline) if there is one
+odir=$(grep 'OutputDIR  =' supermopex.py | cut -d\' -f2 | tr -d \/)
+if [ -e $WRK/$odir/Products.manifest.db ] && [ -e $WRK/product_manifest.py ]; then
+	cd $WRK; python product_manifest.py count bcd
+	exit 0
+fi
+
 rdir=$(grep 'RawDataDir =' supermopex.py | cut -d\' -f2 | tr -d \/)
 cd $WRK/$rdir
 
@@ -82,6 +82,18 @@ if [ $1 == "coords" ]; then
 	done
 fi
 
+#---------------------------------------------------------------------------
+# Number of products of each type (ffcbcd stbcd sub ...) per AOR and chan,
+# from the product manifest
+#---------------------------------------------------------------------------
+
+if [ $1 == "products" ]; then
+	for p in ${@:2}; do
+		echo " >> $p"
+		python product_manifest.py count $p
+	done
+fi
+
 #---------------------------------------------------------------------------
 # Number of frames of each chan  from Frames.tbl
 #---------------------------------------------------------------------------
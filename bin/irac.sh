@@ -190,19 +190,29 @@ chk_prev() {
 
 write_module() {  # write local verions of py and sh modules
     info="for $WRK, built $(date +%d.%h.%y\ %T)"
+    mem=0
+    # resources planned from the inventory and the past timings, when the inventory exists
+    if [ -e $odir/$ltab ] && [ -e plan_field.py ]; then
+        python plan_field.py > plan.out 2>&1 || ec "WARNING: plan_field.py failed ... see plan.out"
+        grep WARNING plan.out | while read line; do ec "$line"; done
+        plan=$(grep "^$module " plan.resources 2>/dev/null)
+        if [ -n "$plan" ]; then
+            read x ppn mem wtime <<< "$plan"; wtime=${wtime}:00:00
+            ec "# Planned resources for $module: ppn=$ppn, mem=${mem}gb, walltime=$wtime"
+        fi
+    fi
     sed -e "s|@NPROC@|$Nproc|g" -e "s|@WRK@|$WRK|g" -e "s|@NODE@|$NODE|g"   \
         -e "s|@INFO@|$info|g" -e "s|@PID@|$PID|g" -e "s|@WTIME@|"$wtime"|g" \
 		-e "s|@PPN@|$ppn|g"   $bindir/$module.sh > ./$module.sh
     chmod 755 $module.sh
     ec "# Wrote $module.sh with: $(grep l\ nodes= $module.sh | cut -d\  -f3)"
     if [ $dry == "T" ]; then ec "----  EXITING DRY MODE  ---- "; exit 10; fi
-    # submit module and wait for job to finish
-    if [ -e $module.out ]; then rm $module.out; fi 
-    ecn "# Submit $module file ... "; qsub $module.sh | tee -a $pipelog
-    ec "# -- Wait for job to finish --"; sleep 20
-    while :; do [ -e $WRK/$module.out ] && break; sleep 20; done
+    # submit module through the batch backend and wait for job to finish
+    echo "$module.out $ppn $mem ${wtime%%:*} ./$module.sh" > $module.jobs
+    ec "# Submit $module file and wait for job to finish ... "
+    python batch_backend.py $module $module.jobs | tee -a $pipelog
     chmod 644 $module.out
-    ec "# Job $module finished - PBS $(grep RESOURCESUSED $module.out | cut -d\, -f4)"
+    ec "# Job $module finished - $(grep EXIT\ STATUS $module.out | tail -1)"   # written by its bundle
 }
 
 chk_outputs() {  # check outputs of module
@@ -233,6 +243,11 @@ end_step() {
     fi
 }
 chkmeds() {  # check for presence of products of subtract_medians
+    # query the product manifest if there is one
+    if [ -e $odir/Products.manifest.db ]; then
+        python product_manifest.py missing -r ffcbcd sub sbunc
+        return
+    fi
     # loop over $mdir/files.aor...tbl tables
     for f in $mdir/files.*.tbl; do               
         aordir=$(tail -1 $f | cut -d\/ -f1-7)   #; echo $aordir; exit
@@ -347,8 +362,8 @@ if [ $1 == "pars" ] || [ $1 == "env" ] || [ $NAORs -eq 0 ]; then
     exit 0               # quit here ...
 fi
 
-# python processing scripts are copied when needed.  Here copy the flunctions library
-comm="rsync -a $pydir/spitzer_pipeline_functions.py ."; $comm
+# python processing scripts are copied when needed.  Here copy the flunctions libraries
+comm="rsync -a $pydir/spitzer_pipeline_functions.py $pydir/frame_inventory.py $pydir/product_manifest.py $pydir/frame_footprints.py $pydir/job_executor.py $pydir/job_timing.py $pydir/job_memory.py $pydir/batch_backend.py $pydir/task_queue.py $pydir/plan_field.py $pydir/irac_frames.py $pydir/frame_pipeline.py $pydir/product_store.py ."; $comm
 #ec "$comm"
 
 #-----------------------------------------------------------------------------
@@ -387,7 +402,7 @@ if [[ $1 =~ "setup_pipe" ]]     || [ $1 == "setup" ]; then
     module=setup_pipeline
     bdate=$(date "+%s.%N")       # start time/date
     chk_prev NULL 
-    if [ -e $fn ]; then comm="rsync -au $fn ."; ec "$comm"; $comm; fi
+    comm="rsync -au $pydir/${module}_par.py ."; ec "$comm"; $comm
     
 	Naor=$(ls -d $rdir/r* | wc -l)
 	if [ $Naor -gt 99 ]; then ppn=$ppnmany; else ppn=$ppnfew; fi
@@ -679,6 +694,52 @@ if [[ $1 =~ "subtract_med" ]]   || [ $1 == "submeds" ] ||[ $auto == "T" ]; then
     end_step
 fi
 
+#-----------------------------------------------------------------------------
+### - 3-9. stage_scheduler  (frames)    - steps 3 to 9 as one graph of jobs
+#-----------------------------------------------------------------------------
+
+if [[ $1 =~ "stage_sch" ]]      || [ $1 == "frames" ]; then
+
+    ec "#-----------------------------------------------------------------------------"
+    ec "# >>>> 3-9. Frame stages as one job graph <<<<"
+    ec "#-----------------------------------------------------------------------------"
+    module=stage_scheduler
+    bdate=$(date "+%s.%N")       # start time/date
+    chk_prev get_catalogs
+    for m in first_frame_corr find_stars merge_stars subtract_stars make_medians fix_astrometry subtract_medians; do
+        comm="rsync -au $pydir/$m.py ."; $comm
+        fn=$pydir/${m}_function.py
+        if [ -e $fn ]; then comm="rsync -au $fn ."; $comm; fi
+    done
+
+	wtime=$((5+$Nframes/1500)) ; if [ $wtime -gt 48 ]; then 
+		ec "Requested wtime: $wtime hrs; reduce to 48";  wtime=48; fi
+	wtime=${wtime}:00:00      #; echo $wtime
+    if [ $Nframes -ge 100000 ]; then ppn=$ppnmany; else ppn=$ppnfew; fi 
+    write_module
+    ec "# Job $module finished - unix walltime=$(wt)"
+    chk_outputs
+    # the later steps check for the .out files of the separate steps: only when all the tasks succeeded
+    if grep -q "EXIT STATUS: 0" $module.out; then
+        for m in first_frame_corr find_stars merge_stars subtract_stars make_medians fix_astrometry subtract_medians; do
+            cp $module.out $m.out
+        done
+    else
+        ec "# Some tasks of $module failed (see $odir/jobs.$module.failed.tbl): the steps are not marked done"
+    fi
+    mdir=$(grep ^AORoutput $pars | cut -d\' -f2 | tr -d \/)
+    chkmeds > missing_submeds.list
+    nmiss=$(cat missing_submeds.list | wc -l)
+    if [ $nmiss -ne 0 ]; then
+        ec "PROBLEM: Missing $nmiss products - see missing_submeds.list"
+        askuser
+    else 
+        ec "# Found all expected products ... continue"
+        rm missing_submeds.list
+    fi
+    end_step
+fi
+
 #-----------------------------------------------------------------------------
 ### - 10. check stars       (chkst)     - optional
 #-----------------------------------------------------------------------------
@@ -814,7 +875,7 @@ if [[ $1 =~ "find_out" ]]     || [[ $1 =~ "outli" ]]  || [ $auto == "T" ]; then
     bdate=$(date "+%s.%N")        # start time/date
     chk_prev setup_tiles    
     
-    rm -f run.outliers outliers.info outliers_*.sh
+    rm -f outliers.jobs outliers.info outliers_*.sh
         
     # Find number of jobs:
     parfile=$(grep '^IRACOutlierConfig ' $pars | cut -d\' -f2)
@@ -855,14 +916,11 @@ if [[ $1 =~ "find_out" ]]     || [[ $1 =~ "outli" ]]  || [ $auto == "T" ]; then
             awk '{printf "# job %3d: tile %3d ch %1d with %5d frames ==> %-15s ppn: %2d, wt %2d hr, mem %2d GB\n", 
                     $1,$2,$3,$4,$5,$6,$7,$8}' | \
             tee -a outliers.info
-#        echo "qsub $outmodule; sleep 2" >> run.outliers  # ... now built below
+        echo "outliers_$j.out $ppn $mem ${wtm%%:*} ./$outmodule" >> outliers.jobs
     done
-	# build run.outliers from outliers.info so as to begin largest jobs first:
-	sort -nrk9 outliers.info | cut -c44-66 > run.outliers
-	sed -i -e 's/==>/qsub/'  -e 's/ppn/; sleep 2/' run.outliers
     # check modules
     nmod=$(ls  outliers_*.sh  | wc -l)  # ; echo $nmod
-    nsub=$(cat run.outliers   | wc -l)  # ; echo $nsub
+    nsub=$(cat outliers.jobs  | wc -l)  # ; echo $nsub
     if [ $nsub -eq $njobs ]; then 
         ec "# Wrote $nmod outliers_nn.sh modules"  # | tee -a $pipelog
     else
@@ -875,31 +933,15 @@ if [[ $1 =~ "find_out" ]]     || [[ $1 =~ "outli" ]]  || [ $auto == "T" ]; then
     # remove any previous files still laying around
 	rm -rf $odir/Rmasks/tile*  $odir/${PID}.irac.tile.*.?.*mosaic*.fits outliers_*.??? 
 
-    # submit the jobs and begin the wait loop
-    ec "# Submit $nsub outliers_nn files ... " 
-    source run.outliers 2> submit_outliers.errs   # to look for errors in submission
+    # submit the jobs, packed in bundles of one node, and wait for them (largest first)
+    ec "# Submit $nsub outliers_nn files and wait for them to finish ... " 
+    python batch_backend.py ols_$PID outliers.jobs 2> submit_outliers.errs | tee -a $pipelog
     nerr=$(cat submit_outliers.errs | wc -l)
     if [ $nerr -ge 1 ]; then 
         ec "# WARNING: there are some submission errors - check submit_outliers.errs ... continuing"
     else
-        ec "# All $nmod jobs submitted ok ..."
-        #rm submit_outliers.errs
+        rm submit_outliers.errs
     fi
-    
-    ec '# Begin wait loop -- wait for all outliers_* jobs to finish  --'
-    n=40 # define loop counter to monitor progress
-    while :; do 
-        ndone=$(ls $WRK/outliers_*.out 2> /dev/null | wc -l)
-        [ $ndone -eq $nsub ] && break
-        n=$((n+1))
-        if [ $n -eq 40 ]; then  # 20: check every 10 min; 60 to check every 30 min, etc.
-			nrun=$(qstat -u moneti -r | grep ols_$PID | wc -l)
-			nque=$(qstat -u moneti    | grep ols_$PID | grep \ Q\  | wc -l)
-            echo "$(date "+[%d.%h %H:%M"]): $ndone jobs done; $nrun running; $nque queued"
-            n=0
-        fi
-        sleep 30
-    done
     ec "# Jobs outliers_nn finished - unix walltime: $(wt)"
     ec "# pbs logs in outliers_nn.out; mopex logs in outliers_nn.log"
     chmod 644 outliers_*.out
@@ -970,8 +1012,8 @@ if [[ $1 =~ "find_out" ]]     || [[ $1 =~ "outli" ]]  || [ $auto == "T" ]; then
 	fi
     
     if [ ! -d outliers.files ]; then mkdir outliers.files; fi
-    mv outliers_*.?? outliers_*.???  outliers.info   outliers.files
-    rm addkeyword.txt run.outliers
+    mv outliers_*.?? outliers_*.???  outliers.info outliers.jobs batch.ols_$PID.*  outliers.files
+    rm -f addkeyword.txt
 
 	cd $odir
 	mkdir tiles
@@ -1039,14 +1081,14 @@ if [[ $1 =~ "build_mos" ]] || [ $1 == "mosaics" ] || [ $auto == "T" ]; then
     if [ -e $fn ]; then comm="rsync -au $fn ."; ec "$comm"; $comm; fi
     bdate=$(date "+%s.%N")       # start time/date
     
-    rm -f run.mosaics ${module}_ch?.out mosaics.info
+    rm -f mosaics.jobs ${module}_ch?.out mosaics.info
     ec "# Namelist for mosaic.pl is: $(grep ^IRACMosaicConfig supermopex.py | cut -d\'  -f2,2)"
 
 	# get the channels observed
     chans=$(cut -d\  -f2 $odir/$ltab | grep 0000_0000 | sed 's|automnt/||' | cut -d\/ -f6 | sort -u | tr -d ch )
     ecn "# Found channels: $(for c in $chans; do echo -n "$c "; done) "; echo '' | tee -a $pipelog #   ; exit
 
-    # build local qsub scripts
+    # build local job scripts
     for chan in $chans; do
         outmodule=${module}_ch${chan}.sh
         info="for $WRK, built $(date +%d.%h.%y\ %T)"
@@ -1067,23 +1109,16 @@ if [[ $1 =~ "build_mos" ]] || [ $1 == "mosaics" ] || [ $auto == "T" ]; then
 			awk '{printf "# Ch%d with %6d frames ==> %s with %2d ppn, wt %2d hr, mem %0d GB\n", $1,$2,$3,$4,$5,$6}' | \
             tee -a mosaics.info
         #ec " wrote $outmodule" 
-        echo "qsub $outmodule; sleep 1" >> run.mosaics
+        echo "${module}_ch${chan}.out $ppn ${mem%gb} ${wtime%%:*} ./$outmodule" >> mosaics.jobs
     done
     if [ $dry == "T" ]; then ec "----  EXITING PIPELINE DRY MODE     ---- "; exit 10; fi
 
-    nsub=$(cat run.mosaics | wc -l)
-    ec "# Submit $nsub ${module}_ch? files ... "; source run.mosaics #| tee -a $pipelog
-    
-    # wait loop
-    ec "--  Wait for ${module}_ch? to finish  --"; sleep 20
-    while :; do 
-        ndone=$(ls ${module}_ch?.out 2> /dev/null | wc -l)
-        [ $ndone -eq $nsub ] && break
-        sleep 30
-    done
+    nsub=$(cat mosaics.jobs | wc -l)
+    ec "# Submit $nsub ${module}_ch? files and wait for them to finish ... "
+    python batch_backend.py mos_$PID mosaics.jobs | tee -a $pipelog
     chmod 644 ${module}_ch?.out
     for f in ${module}_ch?.out; do
-        ec "# Job $f finished - PBS $(grep RESOURCESUSED $f | cut -d\, -f4)"
+        ec "# Job $f finished - $(grep EXIT\ STATUS $f | tail -1)"
     done
     ec "# Build $nsub mosaics finished - unix walltime=$(wt)"
 
@@ -1121,8 +1156,8 @@ if [[ $1 =~ "build_mos" ]] || [ $1 == "mosaics" ] || [ $auto == "T" ]; then
 
 	# and finally cleanup.
 	if [ ! -d mosaics.files ]; then mkdir mosaics.files; fi
-	mv build_mosaic*.sh build_mosaic_*.??? mosaics.files
-    rm -f run.mosaics addkeyword.txt
+	mv build_mosaic*.sh build_mosaic_*.??? mosaics.jobs batch.mos_$PID.*  mosaics.files
+    rm -f addkeyword.txt
     # NB FIF.tbl needed to rerun mosaics; else rebuild by prep_mosaic
     
     ec "#-----------------------------------------------------------------------------"
@@ -3,11 +3,11 @@
 #PBS -N setup_@PID@
 #PBS -o setup_pipeline.out
 #PBS -j oe
-#PBS -l nodes=1:ppn=12,walltime=@WTIME@
+#PBS -l nodes=1:ppn=@PPN@,walltime=@WTIME@
 #
 #-----------------------------------------------------------------------------
 # File:     setup_pipeline.sh @INFO@
-# Purpose:  wrapper for setup_pipeline.py (NOT parallelised)
+# Purpose:  wrapper for setup_pipeline_par.py (headers read in parallel)
 #-----------------------------------------------------------------------------
 set -u
 
@@ -48,8 +48,8 @@ fi
 
 mycd $WRK
 
-# Build the command line
-comm="python setup_pipeline.py"
+# Build the command line: one header reader per core asked for
+comm="python setup_pipeline_par.py -n @PPN@"
 
 echo " - Work dir is:  $WRK"
 echo " - Starting on $(date) on $(hostname)"
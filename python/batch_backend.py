@@ -0,0 +1,286 @@
+#---------------------------------------------------------------------------------------------------
+# Batch backends: run a list of shell jobs (the module and tile scripts written by irac.sh) on the
+# cluster or on this machine, and wait for them.  The jobs are packed into bundles that fill a node
+# (cores and memory); the jobs of a bundle run side by side and each writes its output file, ending
+# with its "EXIT STATUS: n" line, when it finishes.  With the pbs backend the bundles that ask for
+# the same resources go in one job array, so a hundred small tile jobs pay the queue latency of a
+# few nodes, not of a hundred jobs.  The local backend runs the same bundle scripts as processes, LocalNodes bundles at a time,
+# so that the whole orchestration can be run and tested on a workstation without a scheduler.
+#
+# The job file has one line per job: output file, cores, memory (GB, 0 if unknown), walltime
+# (hours), and the command.  Usage:  python batch_backend.py name jobfile [-b pbs|local]
+#---------------------------------------------------------------------------------------------------
+
+import os, sys, time, math, re, shlex, subprocess
+import numpy as np
+from astropy.table import Table
+
+from supermopex import *
+
+PollInterval = 30     # seconds between looks at the jobs
+ReportEvery = 20      # polls between progress lines
+LostStatus = -1       # exit status given to a job whose bundle ended without its output
+
+
+#---------------------------------------------------------------------------------------------------
+# Read a job file: Output, Cores, MemGB, Hours, Command; blank lines and # comments skipped
+#---------------------------------------------------------------------------------------------------
+
+def read_jobs(JobFile):
+
+    rows = list()
+    for line in open(JobFile):
+        if (line.strip() == '') or line.lstrip().startswith('#'):
+            continue
+        output, cores, memory, hours, command = line.split(None, 4)
+        rows.append((output, int(cores), float(memory), float(hours), command.strip()))
+    return(Table(rows=rows, names=['Output','Cores','MemGB','Hours','Command'],
+                 dtype=[str, np.int64, np.double, np.double, str]))
+
+
+#---------------------------------------------------------------------------------------------------
+# Pack the jobs into bundles of one node, longest first (first fit decreasing): a job goes in the
+# first bundle where its cores and memory still fit.  A job larger than a node gets its own bundle.
+# Returns the lists of jobs of the bundles
+#---------------------------------------------------------------------------------------------------
+
+def pack_jobs(jobs, NodeCores, NodeMemory):
+
+    order = np.lexsort((-jobs['Cores'], -jobs['Hours']))
+    bundles, cores, memory = list(), list(), list()
+    for JobNo in order:
+        for b in range(len(bundles)):
+            if (cores[b] + jobs['Cores'][JobNo] <= NodeCores) and (memory[b] + jobs['MemGB'][JobNo] <= NodeMemory):
+                bundles[b].append(int(JobNo))
+                cores[b] += jobs['Cores'][JobNo]
+                memory[b] += jobs['MemGB'][JobNo]
+                break
+        else:
+            bundles.append([int(JobNo)])
+            cores.append(jobs['Cores'][JobNo])
+            memory.append(jobs['MemGB'][JobNo])
+    return(bundles)
+
+
+#---------------------------------------------------------------------------------------------------
+# Write the script of each bundle, batch.<name>.<n>.sh: its jobs in the background, each one to
+# <output>.tmp then renamed to its output with the exit status appended, so that an output file
+# appears only once complete
+#---------------------------------------------------------------------------------------------------
+
+def bundle_script(name, b):
+
+    return('batch.{:}.{:}.sh'.format(name, b))
+
+
+def write_bundles(name, jobs, bundles):
+
+    for b, bundle in enumerate(bundles):
+        with open(bundle_script(name, b), 'w') as script:
+            script.write("#!/bin/bash\n")
+            script.write("# bundle {:} of {:}: {:} jobs\n".format(b, name, len(bundle)))
+            script.write("cd " + shlex.quote(os.getcwd()) + "\n")
+            for JobNo in bundle:
+                output = shlex.quote(jobs['Output'][JobNo])
+                script.write("( bash -c {:} > {:}.tmp 2>&1; echo \"EXIT STATUS: $?\" >> {:}.tmp; mv {:}.tmp {:} ) &\n".format(
+                             shlex.quote(jobs['Command'][JobNo]), output, output, output, output))
+            script.write("wait\n")
+        os.chmod(bundle_script(name, b), 0o755)
+
+
+#---------------------------------------------------------------------------------------------------
+# Exit status of each job from its output file; None while it has none
+#---------------------------------------------------------------------------------------------------
+
+def job_status(jobs):
+
+    status = list()
+    for output in jobs['Output']:
+        value = None
+        if os.path.exists(output):
+            with open(output, errors='replace') as f:
+                found = re.findall(r'EXIT STATUS: (-?\d+)', f.read())
+            value = int(found[-1]) if found else 0
+        status.append(value)
+    return(status)
+
+
+def write_lost(output, name):
+
+    with open(output, 'w') as f:
+        f.write("## ERROR: bundle of {:} ended without this output (killed or lost)\n".format(name))
+        f.write("EXIT STATUS: {:}\n".format(LostStatus))
+
+
+#---------------------------------------------------------------------------------------------------
+# PBS backend: the bundles grouped by the resources they ask for (cores, memory and walltime of the
+# bundle), one job array per group whose array ids are the bundle numbers; the bundles still queued
+# or running are those qstat lists
+#---------------------------------------------------------------------------------------------------
+
+def pbs_capacity():
+
+    return(NodeCores, NodeMemory)
+
+
+def bundle_resources(jobs, bundle):
+
+    ppn = sum(jobs['Cores'][JobNo] for JobNo in bundle)
+    mem = sum(jobs['MemGB'][JobNo] for JobNo in bundle)
+    hours = max(jobs['Hours'][JobNo] for JobNo in bundle)
+    resources = "nodes=1:ppn={:d},walltime={:d}:00:00".format(int(ppn), int(math.ceil(hours)))
+    if mem > 0:
+        resources += ",mem={:d}gb".format(int(math.ceil(mem)))
+    return(resources)
+
+
+def pbs_submit(handle):
+
+    name, jobs, bundles = handle['name'], handle['jobs'], handle['bundles']
+    groups = dict()
+    for b, bundle in enumerate(bundles):
+        groups.setdefault(bundle_resources(jobs, bundle), list()).append(b)
+
+    handle['jobids'] = list()
+    for g, (resources, members) in enumerate(groups.items()):
+        ArrayScript = 'batch.{:}.array{:}.sh'.format(name, g)
+        with open(ArrayScript, 'w') as script:
+            script.write("#!/bin/bash\n")
+            script.write("#PBS -S /bin/bash\n")
+            script.write("#PBS -N {:}\n".format(name[:15]))
+            script.write("#PBS -o batch.{:}.array{:}.log\n".format(name, g))
+            script.write("#PBS -j oe\n")
+            script.write("#PBS -l {:}\n".format(resources))
+            script.write("#PBS -t {:}\n".format(','.join(str(b) for b in members)))
+            script.write("cd " + shlex.quote(os.getcwd()) + "\n")
+            script.write("bash batch.{:}.${{PBS_ARRAYID}}.sh\n".format(name))
+        submit = subprocess.run(['qsub', ArrayScript], capture_output=True, text=True)
+        if submit.returncode != 0:
+            raise RuntimeError("qsub {:} failed: {:}".format(ArrayScript, submit.stderr.strip()))
+        jobid = submit.stdout.strip().split('.')[0].split('[')[0]
+        handle['jobids'].append(jobid)
+        print("## Submitted {:} bundles of {:} as PBS job {:} ({:})".format(len(members), name, jobid, resources))
+
+
+def pbs_poll(handle):
+
+    listing = subprocess.run(['qstat', '-t'], capture_output=True, text=True)
+    if listing.returncode != 0:
+        return(set())   #can't tell: take them all as still there
+    active = set()
+    for line in listing.stdout.splitlines():
+        fields = line.split()
+        if len(fields) == 0:
+            continue
+        for jobid in handle['jobids']:
+            found = re.match(re.escape(jobid) + r'\[(\d+)\]', fields[0])
+            if found:
+                active.add(int(found.group(1)))
+    return(set(range(len(handle['bundles']))) - active)
+
+
+#---------------------------------------------------------------------------------------------------
+# Local backend: the bundles as processes of this machine, packed to its cores and memory, and
+# LocalNodes of them at a time
+#---------------------------------------------------------------------------------------------------
+
+def local_capacity():
+
+    return(os.cpu_count(), os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1e9)
+
+
+def local_submit(handle):
+
+    handle['pending'] = list(range(len(handle['bundles'])))
+    handle['processes'] = dict()
+    handle['ended'] = set()
+    local_poll(handle)
+    print("## Started {:} bundles of {:} on {:}, {:} at a time".format(len(handle['bundles']), handle['name'], os.uname().nodename, LocalNodes))
+
+
+def local_poll(handle):
+
+    for b, process in list(handle['processes'].items()):
+        if process.poll() is not None:
+            handle['ended'].add(b)
+            del handle['processes'][b]
+    while handle['pending'] and (len(handle['processes']) < LocalNodes):
+        b = handle['pending'].pop(0)
+        log = open('batch.{:}.{:}.log'.format(handle['name'], b), 'w')
+        handle['processes'][b] = subprocess.Popen(['bash', bundle_script(handle['name'], b)], stdout=log,
+                                                  stderr=subprocess.STDOUT, start_new_session=True)
+        log.close()
+    return(set(handle['ended']))
+
+
+Backends = {'pbs':   {'capacity': pbs_capacity,   'submit': pbs_submit,   'poll': pbs_poll},
+            'local': {'capacity': local_capacity, 'submit': local_submit, 'poll': local_poll}}
+
+
+#---------------------------------------------------------------------------------------------------
+# Run the jobs with the backend and wait for them all.  A job whose bundle ended (two looks in a
+# row, for the delays of the shared disks) without its output gets one with LostStatus.  Returns
+# the exit status of each job
+#---------------------------------------------------------------------------------------------------
+
+def run_batch(name, jobs, backend=None):
+
+    backend = Backends[backend or BatchBackend]
+    cores, memory = backend['capacity']()
+    bundles = pack_jobs(jobs, cores, memory)
+    print("## {:} jobs of {:} in {:} bundles of up to {:} cores / {:.0f} GB".format(len(jobs), name, len(bundles), cores, memory))
+    for output in jobs['Output']:
+        if os.path.exists(output):
+            os.remove(output)
+    write_bundles(name, jobs, bundles)
+
+    handle = {'name': name, 'jobs': jobs, 'bundles': bundles}
+    backend['submit'](handle)
+    gone = set()
+    polls = 0
+    while True:
+        status = job_status(jobs)
+        ended = backend['poll'](handle)
+        for b in ended & gone:
+            for JobNo in bundles[b]:
+                if status[JobNo] is None:
+                    write_lost(jobs['Output'][JobNo], name)
+                    status[JobNo] = LostStatus
+        gone = ended
+        Ndone = sum(1 for value in status if value is not None)
+        if Ndone == len(jobs):
+            break
+        polls += 1
+        if polls % ReportEvery == 0:
+            print("{:}: {:} of {:} {:} jobs done".format(time.strftime("[%d.%h %H:%M]"), Ndone, len(jobs), name))
+            sys.stdout.flush()
+        time.sleep(PollInterval)
+
+    Nfailed = sum(1 for value in status if value != 0)
+    print("## {:} jobs of {:} done; {:} with exit status not 0".format(len(jobs), name, Nfailed))
+    return(status)
+
+
+if __name__ == '__main__':
+
+    from optparse import OptionParser
+
+    usagestring = '%prog name jobfile'
+    parser = OptionParser(usage=usagestring)
+    parser.add_option('-b', '--backend', dest='backend', default=BatchBackend, help='pbs or local [%default]')
+    parser.add_option('-n', '--dry', dest='dry', action='store_true', default=False, help='only show the bundles')
+    (options, args) = parser.parse_args()
+
+    if len(args) != 2:
+        parser.error("Incorrect number of arguments.")
+    if options.backend not in Backends:
+        parser.error("Unknown backend " + options.backend)
+    name, JobFile = args
+    jobs = read_jobs(JobFile)
+    if options.dry:
+        cores, memory = Backends[options.backend]['capacity']()
+        for b, bundle in enumerate(pack_jobs(jobs, cores, memory)):
+            print("# bundle {:3d}: {:3d} cores, {:5.0f} GB, {:5.1f} hr: {:}".format(b, int(sum(jobs['Cores'][bundle])),
+                  sum(jobs['MemGB'][bundle]), max(jobs['Hours'][bundle]), ' '.join(jobs['Output'][bundle])))
+        sys.exit(0)
+    run_batch(name, jobs, options.backend)
@@ -8,67 +8,44 @@ from spitzer_pipeline_functions import *
 import sys
 import numpy as np
 from astropy.io import ascii
-from astropy.table import Table, Column, MaskedColumn, hstack
-from functools import partial
-import multiprocessing as mp
+from astropy.table import Table, hstack
+from job_timing import run_timed_jobs
+import check_astrometry_function
 
 
 #read in the log file and get IRAC info
-rawlog = ascii.read(LogTable,format="ipac")
-log = rawlog[:][(rawlog['Instrument']=='IRAC').nonzero()]
+log = read_log()
 
-#get the list of AORs
-AORlist = list(set(log['AOR']))
-Naor = len(AORlist)
+#get the frames of each exposure (AOR, ExposureID)
+index = read_group_index(['AORExposure'])
 
-#make a list of frame indexes for each AORS
-#also a list of output data to collect results
-JobList=list()
-JobNo=0
-for aorIDX in range(0,Naor):
-     IDlist = list(set(log['ExposureID'][(log['AOR']==AORlist[aorIDX]).nonzero()]))
-     for ID in IDlist:
-          ChMax = np.max(log['Channel'][((log['AOR']==AORlist[aorIDX])&(log['ExposureID']==ID)).nonzero()])
-          JobList.append([JobNo,AORlist[aorIDX],ID,ChMax])
-          JobNo+=1
-
-JobList = Table(rows=JobList,names=['JobNo','AOR','ExposureID','ChannelMax'])
-ascii.write(JobList, OutputDIR + 'jobs.check_astrometry.tbl', format="ipac",overwrite=True)  
+#make the list of jobs, one per exposure, and the job number of each frame to join the results back
+JobList, FrameJob = make_exposure_joblist(log, index)
+write_table(JobList, OutputDIR + 'jobs.check_astrometry.tbl')  
 
 #Get the size of the array
 Njobs = len(JobList)
 
-#Read the refined fluxes and postions
-StarData = ascii.read(StarTable,format="ipac") #read the data
-
-#fill in missing proper motions with zeros
-StarData['pmra'].fill_value=0.0
-StarData['pmdec'].fill_value=0.0
-StarData['pmra_error'].fill_value=0.0
-StarData['pmdec_error'].fill_value=0.0
-StarData['parallax'].fill_value=1e-8
+print("Starting check_astrometry: {:} jobs with up to {:} threads".format(Njobs, Nthred))
 
+#the log, job list and star catalog are loaded once and inherited by the workers; the jobs carry only their number
+check_astrometry_function.load_stage_data()
+jobresults = run_timed_jobs(check_astrometry_function.run_job, JobList, Nthred, 'check_astrometry')
 
-print("Starting check_astrometry: {:} jobs with {:} threads".format(Njobs, Nthred))
-
-pool = mp.Pool(processes=Nthred)
-results = pool.map(partial(check_astrometry,log=log,Nrows=Njobs,JobList=JobList,AstrometryStars=StarData), range(0,Njobs))
-pool.close()
+results = np.zeros(Njobs, dtype=AstroFixType)
+for (JobNo, status, elapsed, message, value) in jobresults:
+    if status == 'ok':
+        results[JobNo] = value
+Nfailed = sum(1 for result in jobresults if result[1] != 'ok')
+if Nfailed > 0:
+    print("## ERROR: astrometry not checked for {:} of {:} exposures; {:} not written".format(Nfailed, Njobs, AstrometryCheckFile))
+    sys.exit(1)
 
 #for i in range(0,Njobs):
 #fix_astrometry(i)
 
-DCElist = log['DCE']
-OutputList=list()
-for DCE in DCElist:
-    ID = (log['DCE']==DCE).nonzero()
-    AOR = int(log['AOR'][ID])
-    ExposureID = int(log['ExposureID'][ID])
-    JobID = int(JobList['JobNo'][((JobList['AOR']==AOR)&(JobList['ExposureID']==ExposureID)).nonzero()]) # get the job number for this
-    OutputList.append([results[JobID][1],results[JobID][2],results[JobID][3],results[JobID][4]])
-
-#add in some columns from the log first, then make table with astrometry
-OutputTable = hstack([log['Filename','DCE','AOR','ExposureID','Channel','RA','DEC'],Table(rows=OutputList,names=['dRA','dDEC','error_dRA','error_dDEC'])])
+#join the results of each exposure to its frames: add in some columns from the log first, then make table with astrometry
+OutputTable = hstack([Table(log[['Filename','DCE','AOR','ExposureID','Channel','RA','DEC']]),Table(results[FrameJob][['dRA','dDEC','error_dRA','error_dDEC']])])
 
 
 #write output table
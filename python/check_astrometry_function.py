@@ -0,0 +1,65 @@
+#----------------------------------------------------------------------------
+# module check_astrometry_function.py
+#----------------------------------------------------------------------------
+
+from supermopex import *
+from spitzer_pipeline_functions import *
+
+import numpy as np
+from astropy.io import ascii
+
+import sys
+from optparse import OptionParser
+
+#---------------------------------------------------------------------------------------------------
+# Load what all the jobs share: the log and its exposure index, the job list written by
+# check_astrometry.py (one job per exposure) and the star catalog
+#---------------------------------------------------------------------------------------------------
+
+def load_stage_data():
+
+    global log, index, JobList, StarData
+
+    #Read the log file and get IRAC info, and the frames of each exposure (AOR, ExposureID)
+    log = read_log()
+    index = read_group_index(['AORExposure'])
+
+    JobListName = OutputDIR + 'jobs.check_astrometry.tbl'
+    JobList = read_table(JobListName)
+
+    #Read the refined fluxes and postions
+    StarData = ascii.read(StarTable,format="ipac")
+
+    #fill in missing proper motions with zeros
+    StarData['pmra'].fill_value=0.0
+    StarData['pmdec'].fill_value=0.0
+    StarData['pmra_error'].fill_value=0.0
+    StarData['pmdec_error'].fill_value=0.0
+    StarData['parallax'].fill_value=1e-8
+
+
+#---------------------------------------------------------------------------------------------------
+# One job, once the stage data is loaded; returns the residual offset of the exposure (AstroFixType)
+#---------------------------------------------------------------------------------------------------
+
+def run_job(JobNo):
+
+    return(check_astrometry(JobNo,log=log,Nrows=len(JobList),JobList=JobList,AstrometryStars=StarData,index=index))
+
+
+if __name__ == '__main__':
+
+    #parse the arguments
+    usagestring ='%prog Job_Number'
+    parser = OptionParser(usage=usagestring)
+    (options, args) = parser.parse_args()
+
+    #fail if there aren't enough arguments
+    if len(args) < 1:
+        parser.error("Incorrect number of arguments.")
+
+    #read job number
+    JobNo=int(args[0])
+
+    load_stage_data()
+    print(run_job(JobNo))
@@ -7,30 +7,26 @@ from astropy.io import ascii
 from supermopex import *
 from spitzer_pipeline_functions import *
 import os
-import multiprocessing as mp
-
-def run_checkstars(JobNo):
-    cmd = "cd " + RootDIR + "; " + pythonCMD + " check_stars_function.py " + str(JobNo)
-    os.system(cmd)
+from job_timing import run_timed_jobs
+import check_stars_function
 
 #Read the log file and get IRAC info
-rawlog = ascii.read(LogTable,format="ipac")
-log = rawlog[:][(rawlog['Instrument']=='IRAC').nonzero()]
+log = read_log()
 
 #read in the AOR properties log
-AORlog = ascii.read(AORinfoTable,format="ipac")
+AORlog = read_table(AORinfoTable)
 
 #genreate a joblist for parallelization
-JobList     = make_joblist(log,AORlog)
+Nthred = int(Nthred / 2)
+JobList     = make_joblist(log, AORlog, index=read_group_index(['AORChannel']), ChunkFrames=frame_chunk_size(len(log), Nthred))
 JobListName = OutputDIR + 'jobs.check_stars.tbl'
-ascii.write(JobList, JobListName, format="ipac",overwrite=True)    
+write_table(JobList, JobListName)    
 
 Njobs  = len(JobList)
-Nthred = int(Nthred / 2)
 
-print("Starting check_stars: {:} jobs with {:} threads.".format(Njobs, Nthred))
+print("Starting check_stars: {:} jobs with up to {:} threads.".format(Njobs, Nthred))
 
-pool = mp.Pool(processes=Nthred)
-results = pool.map(run_checkstars, range(0,Njobs))
+check_stars_function.load_stage_data()
+results = run_timed_jobs(check_stars_function.run_job, JobList, Nthred, 'check_stars')
 
 print("Done!")
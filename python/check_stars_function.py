@@ -9,38 +9,60 @@ from spitzer_pipeline_functions import *
 import sys
 from optparse import OptionParser
 
-#parse the arguments
-usagestring ='%prog Job_Number'
-parser = OptionParser()
-parser = OptionParser(usage=usagestring)
-(options, args) = parser.parse_args()
+#---------------------------------------------------------------------------------------------------
+# Load what all the jobs share: the log and its index, the job list written by check_stars.py,
+# and the Gaia catalog
+#---------------------------------------------------------------------------------------------------
 
-#fail if there aren't enough arguments
-if len(args) < 1:
-    parser.error("Incorrect number of arguments.")
+def load_stage_data():
 
-#read job number
-JobNo=int(args[0])
+    global log, index, JobList, AstrometryStars
 
-#Read the log fileand get IRAC info
-rawlog = ascii.read(LogTable,format="ipac")
-log = rawlog[:][(rawlog['Instrument']=='IRAC').nonzero()]
+    #Read the log fileand get IRAC info
+    log = read_log()
+    index = read_group_index(['AORChannel'])
 
-# Read joblist for parallelization
+    # Read joblist for parallelization
+    JobListName = OutputDIR + 'jobs.check_stars.tbl'
+    JobList = read_table(JobListName)
 
-JobListName = OutputDIR + 'jobs.check_stars.tbl'
-JobList = ascii.read(JobListName, format="ipac")
-Njobs   = len(JobList)
+    #Read in the table of Gaia stars for astrometry correction
+    AstrometryStars = ascii.read(GaiaTable,format="ipac") #read the data
 
-if (JobNo > Njobs):
-    die("Requested job number greater than number of jobs available " + str(Njobs) + "!");
+    #fill in zero proper motion for stars without measurementes
+    AstrometryStars['pmra'].fill_value=0.0
+    AstrometryStars['pmdec'].fill_value=0.0
+    AstrometryStars['parallax'].fill_value=1e-8
 
-#Read in the table of Gaia stars for astrometry correction
-AstrometryStars = ascii.read(GaiaTable,format="ipac") #read the data
 
-#fill in zero proper motion for stars without measurementes
-AstrometryStars['pmra'].fill_value=0.0
-AstrometryStars['pmdec'].fill_value=0.0
-AstrometryStars['parallax'].fill_value=1e-8
+#---------------------------------------------------------------------------------------------------
+# One job, once the stage data is loaded
+#---------------------------------------------------------------------------------------------------
 
-checkstar(JobNo,JobList,log=log,AstrometryStars=AstrometryStars)
+def run_job(JobNo):
+
+    checkstar(JobNo,JobList,log=log,AstrometryStars=AstrometryStars,index=index)
+
+
+if __name__ == '__main__':
+
+    #parse the arguments
+    usagestring ='%prog Job_Number'
+    parser = OptionParser()
+    parser = OptionParser(usage=usagestring)
+    (options, args) = parser.parse_args()
+
+    #fail if there aren't enough arguments
+    if len(args) < 1:
+        parser.error("Incorrect number of arguments.")
+
+    #read job number
+    JobNo=int(args[0])
+
+    load_stage_data()
+    Njobs   = len(JobList)
+
+    if (JobNo > Njobs):
+        die("Requested job number greater than number of jobs available " + str(Njobs) + "!");
+
+    run_job(JobNo)
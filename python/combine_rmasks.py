@@ -1,17 +1,19 @@
 #!/opt/local/bin/python
 
-import re,os,shutil
+import re,os,sys,shutil
 import numpy as np
 from astropy import wcs
 from astropy.io import ascii
 from astropy import units as u
 from astropy.table import Table, Column, MaskedColumn
 from astropy import wcs
-from functools import partial
 import multiprocessing as mp
 
 from supermopex import *
 from spitzer_pipeline_functions import *
+from product_manifest import manifest_exists, product_dces
+from job_timing import run_timed_jobs
+import combine_rmasks_function
 
 print("----- Begin combine_rmasks.py -----")
 
@@ -19,43 +21,56 @@ print("----- Begin combine_rmasks.py -----")
 pid = os.getpid() #get the PID for temp files
 
 #read in the log file
-log = ascii.read(LogTable,format="ipac")
+log = read_table(LogTable)
 Nrows = len(log)
 
-# find all the rmask files and collect DCEs
-print('# Finding Rmask Files')
-fileList = TMPDIR + '/' + str(pid) + ".rmasks.lst"
-cmd = "find " + str(RMaskDir) + " -name '*_rmask.fits' > " + fileList
-os.system(cmd)
+# the rmasks of each tile, with the DCE of their frame, as recorded in the manifest by find_outliers
+# when the tile was complete; the tiles without rows (not recorded, or their job died) are read
+# from disk
+RecordedTiles = dict()
+if manifest_exists():
+    for Filename, DCE in product_dces(RmaskTileProduct):
+        RecordedTiles.setdefault(os.path.dirname(Filename), list()).append((Filename, DCE))
+TileDirs = [RMaskDir] + sorted(entry.path for entry in os.scandir(RMaskDir) if entry.is_dir())
+RmaskRows = [row for TileDir in TileDirs for row in RecordedTiles.get(os.path.dirname(os.path.join(TileDir, '')), [])]
+print("# Found {:} RMasks of {:} tiles in the product manifest".format(len(RmaskRows), len(TileDirs) - 1))
 
-# read the list of files
-RmaskFiles = ascii.read(fileList,format="no_header")
-RmaskFiles.rename_column('col1','Filename')
+# not in the manifest: list the rmask files of the other tiles and read their DCEs
+RmaskFiles = Table([[os.path.join(TileDir, name) for TileDir in TileDirs if os.path.dirname(os.path.join(TileDir, '')) not in RecordedTiles
+                     for name in sorted(os.listdir(TileDir)) if name.endswith('_' + rmaskSuffix + '.fits')]], names=['Filename'], dtype=[str])
 Nfiles = len(RmaskFiles)
-
-print("# Reading DCE numbers of " + str(Nfiles) + " RMasks with " + str(Nthred) + " threads.")
-#get_rmask_dce(0,RmaskFileList=RmaskFiles)
-pool = mp.Pool(processes=Nthred)
-RmaskDCEresults = pool.map(partial(get_rmask_dce, RmaskFileList=RmaskFiles), range(0,Nfiles))
-pool.close()
+if Nfiles > 0:
+    print("# Reading DCE numbers of " + str(Nfiles) + " RMasks not in the manifest with " + str(Nthred) + " threads.")
+    #the list of files is inherited by the forked workers; the tasks carry only the file number
+    def rmask_dce(FileNo):
+        return(get_rmask_dce(FileNo, RmaskFileList=RmaskFiles))
+    pool = mp.Pool(processes=Nthred)
+    RmaskDCEresults = pool.map(rmask_dce, range(0,Nfiles), chunksize=max(1, Nfiles // (4*Nthred)))
+    pool.close()
+    RmaskRows += [(RmaskFiles['Filename'][i], RmaskDCEresults[i]) for i in range(0,Nfiles)]
 
 # make the RMASK table
 print("# Making list of Rmask files with DCEs")
-OutputRmaskList=list()
-for i in range(0,Nfiles):
-    OutputRmaskList.append([RmaskFiles['Filename'][i],RmaskDCEresults[i]])
+OutputRmaskTable = Table(rows=RmaskRows, names=['Filename','DCE']) if RmaskRows else Table(names=['Filename','DCE'], dtype=[str, np.int64])
+
+write_table(OutputRmaskTable, TMPDIR + "OutputRmasks.tbl")   #and its binary copy, read by the jobs
 
-#add in some columns from the log first, then make table with astrometry
-OutputRmaskTable = Table(rows=OutputRmaskList,names=['Filename','DCE'])
-ascii.write(OutputRmaskTable, TMPDIR+"OutputRmasks.tbl", format="ipac",overwrite=True) 
+# jobs of chunks of rows of the log; the log and the rmask files by DCE are loaded once and
+# inherited by the workers, which record the combined rmasks in the manifest
+ChunkFrames = frame_chunk_size(Nrows, Nthred)
+FirstRow = np.arange(0, Nrows, ChunkFrames)
+JobList = Table([FirstRow, np.minimum(ChunkFrames, Nrows - FirstRow)], names=['FirstRow','NumFrames'])
+write_table(JobList, OutputDIR + 'jobs.combine_rmasks.tbl')
 
-#Nproc=1   #for testing
-print("# Combining RMask files using {:} threads".format(Nthred))
+print("# Combining RMask files in {:} jobs using up to {:} threads".format(len(JobList), Nthred))
+combine_rmasks_function.load_stage_data()
+results = run_timed_jobs(combine_rmasks_function.run_job, JobList, Nthred, 'combine_rmasks')
 
-#combine_rmasks(5,RmaskFileList=OutputRmaskTable,log=log)
-pool = mp.Pool(processes=Nthred)
-results = pool.map(partial(combine_rmasks, RmaskFileList=OutputRmaskTable, log=log), range(0, Nrows))
-pool.close()
+#without all the combined rmasks the lists would name missing files: stop here
+Nfailed = sum(1 for result in results if result[1] != 'ok')
+if Nfailed > 0:
+    print("## ERROR: {:} of {:} combine_rmasks jobs failed; the rmask lists not written".format(Nfailed, len(JobList)))
+    sys.exit(1)
 
 #make the rmask lists in the same way we did it in setup_pipeline
 IracChannels = set(log['Channel'][(log['Instrument']=='IRAC')])
@@ -74,4 +89,3 @@ for Ch in IracChannels:
     np.savetxt(listname,OutputFileList,fmt='%s')
     print("Wrote list of rmask frames to " + listname)
 
-os.system("rm " + fileList)
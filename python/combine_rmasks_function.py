@@ -0,0 +1,57 @@
+#-----------------------------------------------------------------------------
+# module combine_rmasks_function.py (par)
+#-----------------------------------------------------------------------------
+
+from supermopex import *
+from spitzer_pipeline_functions import *
+
+import numpy as np
+
+import sys
+from optparse import OptionParser
+
+#---------------------------------------------------------------------------------------------------
+# Load what all the jobs share: the log, the job list written by combine_rmasks.py (chunks of rows
+# of the log) and the rmask files of the tiles by DCE, from the list it wrote
+#---------------------------------------------------------------------------------------------------
+
+def load_stage_data():
+
+    global log, JobList, RmaskFiles
+
+    log = read_table(LogTable)
+    JobList = read_table(OutputDIR + 'jobs.combine_rmasks.tbl')
+
+    RmaskTable = read_table(TMPDIR + 'OutputRmasks.tbl')
+    RmaskFiles = dict()
+    for Filename, DCE in zip(RmaskTable['Filename'], RmaskTable['DCE']):
+        RmaskFiles.setdefault(DCE, set()).add(Filename)
+
+
+#---------------------------------------------------------------------------------------------------
+# One job, once the stage data is loaded: combine the rmasks of its rows of the log
+#---------------------------------------------------------------------------------------------------
+
+def run_job(JobNo):
+
+    FirstRow = JobList['FirstRow'][JobNo]
+    products = [combine_rmasks(row, RmaskFiles=RmaskFiles, log=log) for row in range(FirstRow, FirstRow + JobList['NumFrames'][JobNo])]
+    record_products('combine_rmasks', [product for product in products if product is not None])
+
+
+if __name__ == '__main__':
+
+    #parse the arguments
+    usagestring ='%prog Job_Number'
+    parser = OptionParser(usage=usagestring)
+    (options, args) = parser.parse_args()
+
+    #fail if there aren't enough arguments
+    if len(args) < 1:
+        parser.error("Incorrect number of arguments.")
+
+    #read job number
+    JobNo=int(args[0])
+
+    load_stage_data()
+    run_job(JobNo)
@@ -5,20 +5,17 @@ from astropy.io import ascii
 from supermopex import *
 from spitzer_pipeline_functions import *
 import os
-import multiprocessing as mp
-
-def run_find_outliers(JobNo):
-    cmd = "cd " + RootDIR + "; " + pythonCMD + " find_outliers_function.py " + str(JobNo)
-    os.system(cmd)
+from job_timing import run_timed_jobs
+import find_outliers_function
 
 #WRead in the list of tiles
-JobList = ascii.read(TileListFile,format="ipac")
+JobList = read_table(TileListFile)
 Njobs = len(JobList)
 
-print("Begin find_outliers for {:} jobs and with {:} threads".format(Njobs, Nthred))
+print("Begin find_outliers for {:} jobs and with up to {:} threads".format(Njobs, Nthred))
 
-pool = mp.Pool(processes=Nthred)
-results = pool.map(run_find_outliers, range(0,Njobs))
+find_outliers_function.load_stage_data()
+results = run_timed_jobs(find_outliers_function.run_job, JobList, Nthred, 'find_outliers', speculate=False)  #temp dirs are per job
 
 print("Done!")
 
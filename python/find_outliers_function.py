@@ -10,33 +10,55 @@ from astropy.table import Table, Column, MaskedColumn
 import sys
 from optparse import OptionParser
 
-#parse the arguments
-usagestring ='%prog Job_Number'
-parser = OptionParser()
-parser = OptionParser(usage=usagestring)
-(options, args) = parser.parse_args()
+debug = 0   # set by the command line
 
-#fail if there aren't enough arguments
-if len(args) < 1:
-    parser.error("Incorrect number of arguments.")
+#---------------------------------------------------------------------------------------------------
+# Load what all the jobs share: the list of tiles
+#---------------------------------------------------------------------------------------------------
 
-#read job number
-JobNo=int(args[0])
+def load_stage_data():
 
-# check if debug mode
-if len(args) > 1:
-    debug = 1
-#    print("### DEBUG MODE ##")
-else:
-    debug = 0
+    global JobList
 
-#WRead in the list of tiles
-JobList = ascii.read(TileListFile,format="ipac")
-Njobs = len(JobList)
+    #WRead in the list of tiles
+    JobList = read_table(TileListFile)
 
-if (JobNo > Njobs):
-    die("Requested job number greater than number of jobs available " + str(Njobs) + "!");
 
-find_outlier_tile(JobNo, JobList=JobList, debug=debug)
+#---------------------------------------------------------------------------------------------------
+# One job, once the stage data is loaded
+#---------------------------------------------------------------------------------------------------
 
+def run_job(JobNo):
 
+    find_outlier_tile(JobNo, JobList=JobList, debug=debug)
+
+
+if __name__ == '__main__':
+
+    #parse the arguments
+    usagestring ='%prog Job_Number'
+    parser = OptionParser()
+    parser = OptionParser(usage=usagestring)
+    (options, args) = parser.parse_args()
+
+    #fail if there aren't enough arguments
+    if len(args) < 1:
+        parser.error("Incorrect number of arguments.")
+
+    #read job number
+    JobNo=int(args[0])
+
+    # check if debug mode
+    if len(args) > 1:
+        debug = 1
+    #    print("### DEBUG MODE ##")
+    else:
+        debug = 0
+
+    load_stage_data()
+    Njobs = len(JobList)
+
+    if (JobNo > Njobs):
+        die("Requested job number greater than number of jobs available " + str(Njobs) + "!");
+
+    run_job(JobNo)
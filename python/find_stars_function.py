@@ -11,48 +11,87 @@ from spitzer_pipeline_functions import *
 
 from optparse import OptionParser
 
-#parse the arguments
-usagestring ='%prog Job_Number'
-parser = OptionParser()
-parser = OptionParser(usage=usagestring)
-(options, args) = parser.parse_args()
-
-#fail if there aren't enough arguments
-if len(args) < 1:
-    parser.error("Incorrect number of arguments.")
-
-#read job number
-JobNo=int(args[0])
-
-#print("-- Read the log file and get the IRAC info")   ##DEUG
-rawlog = ascii.read(LogTable,format="ipac")
-log = rawlog[:][(rawlog['Instrument']=='IRAC').nonzero()]
-
-# Joblist is generated in find_stars.py
-#print("-- Read job list written find_stars")  ##DEUG
-JobListName = OutputDIR + 'jobs.find_stars.tbl'
-JobList = ascii.read(JobListName, format="ipac")
-Njobs = len(JobList)
-
-if (JobNo > Njobs):
-    die("Requested job number greater than number of jobs available " + str(Njobs) + "!");
-
-# AMo: moved the writing of this bright star catal to find_stars.py; here just read the table
-#print("-- Read bright star table")   ##DEBUG
-BrightStars = ascii.read(BrightStarCat, format="ipac")
-
-#fill in zero proper motion for stars without measurementes
-BrightStars['pmra'].fill_value=0.0
-BrightStars['pmdec'].fill_value=0.0
-BrightStars['parallax'].fill_value=1e-8
-
-# Read in the table of Gaia stars for astrometry correction
-AstrometryStars = ascii.read(GaiaTable,format="ipac") #read the data
-
-#fill in zero proper motion for stars without measurementes
-AstrometryStars['pmra'].fill_value=0.0
-AstrometryStars['pmdec'].fill_value=0.0
-AstrometryStars['parallax'].fill_value=1e-8
-
-#print("-- Launch findstar(JobNo, JobList, etc)".format(JobNo))  ##DEBUG
-findstar(JobNo, JobList, log=log, BrightStars=BrightStars, AstrometryStars=AstrometryStars)
+#---------------------------------------------------------------------------------------------------
+# Cut the WISE stars on brightness and write the bright star table used by the jobs
+#---------------------------------------------------------------------------------------------------
+
+def write_bright_star_catalog():
+
+    stars = ascii.read(StarTable,format="ipac")           # here gaia-wise tbl
+    BrightFlux = 10**((BrightStar-23.9)/-2.5)             # convert from mag to uJy 
+    BrightStars = stars[:][((stars['w1'] > BrightFlux) + (stars['w2'] > BrightFlux)).nonzero()] # select bright stars (w1 _or_ w2 > BrightFlux)
+    ascii.write(BrightStars, BrightStarCat + '.tmp', format="ipac", overwrite=True)   # write to bright_stars.tbl; same format as gaia-wise.tbl
+    replace_if_changed(BrightStarCat + '.tmp', BrightStarCat)   # unchanged, it keeps its date and the star tables stay current
+    lenbs = len(BrightStars)
+    print(">> Built {:} of stars brighter than {:} mag from WISE catal, with {:} objects.".format(BrightStarCat.split('/')[-1], BrightStar, lenbs))
+
+
+#---------------------------------------------------------------------------------------------------
+# Load what all the jobs share: the log and its indexes, the job list written by find_stars.py,
+# and the bright star and Gaia catalogs
+#---------------------------------------------------------------------------------------------------
+
+def load_stage_data():
+
+    global log, index, SkyIndex, JobList, BrightStars, AstrometryStars
+
+    #print("-- Read the log file and get the IRAC info")   ##DEUG
+    log = read_log()
+    index = read_group_index(['AORChannel'])
+    SkyIndex = read_sky_index()   #the frame footprints, for the stars of each frame
+
+    # Joblist is generated in find_stars.py
+    #print("-- Read job list written find_stars")  ##DEUG
+    JobListName = OutputDIR + 'jobs.find_stars.tbl'
+    JobList = read_table(JobListName)
+
+    # AMo: moved the writing of this bright star catal to find_stars.py; here just read the table
+    #print("-- Read bright star table")   ##DEBUG
+    BrightStars = ascii.read(BrightStarCat, format="ipac")
+
+    #fill in zero proper motion for stars without measurementes
+    BrightStars['pmra'].fill_value=0.0
+    BrightStars['pmdec'].fill_value=0.0
+    BrightStars['parallax'].fill_value=1e-8
+
+    # Read in the table of Gaia stars for astrometry correction
+    AstrometryStars = ascii.read(GaiaTable,format="ipac") #read the data
+
+    #fill in zero proper motion for stars without measurementes
+    AstrometryStars['pmra'].fill_value=0.0
+    AstrometryStars['pmdec'].fill_value=0.0
+    AstrometryStars['parallax'].fill_value=1e-8
+
+
+#---------------------------------------------------------------------------------------------------
+# One job, once the stage data is loaded
+#---------------------------------------------------------------------------------------------------
+
+def run_job(JobNo):
+
+    #print("-- Launch findstar(JobNo, JobList, etc)".format(JobNo))  ##DEBUG
+    findstar(JobNo, JobList, log=log, BrightStars=BrightStars, AstrometryStars=AstrometryStars, index=index, SkyIndex=SkyIndex)
+
+
+if __name__ == '__main__':
+
+    #parse the arguments
+    usagestring ='%prog Job_Number'
+    parser = OptionParser()
+    parser = OptionParser(usage=usagestring)
+    (options, args) = parser.parse_args()
+
+    #fail if there aren't enough arguments
+    if len(args) < 1:
+        parser.error("Incorrect number of arguments.")
+
+    #read job number
+    JobNo=int(args[0])
+
+    load_stage_data()
+    Njobs = len(JobList)
+
+    if (JobNo > Njobs):
+        die("Requested job number greater than number of jobs available " + str(Njobs) + "!");
+
+    run_job(JobNo)
@@ -7,33 +7,29 @@ from astropy.io import ascii
 from supermopex import *
 from spitzer_pipeline_functions import *
 import os
-import multiprocessing as mp
-
-def run_firstframe(JobNo):
-    cmd = "cd " + RootDIR + "; " + pythonCMD + " first_frame_corr_function.py " + str(JobNo)
-    os.system(cmd)
+from job_timing import run_timed_jobs
+import first_frame_corr_function
 
 #Read the log file and get just IRAC info
-rawlog = ascii.read(LogTable,format="ipac")
-log = rawlog[:][(rawlog['Instrument']=='IRAC').nonzero()]
+log = read_log()
 
 #Get the size of the array
 Nrows = log['Filename'].size
 
 #read in the AOR properties log
-AORlog = ascii.read(AORinfoTable,format="ipac")
+AORlog = read_table(AORinfoTable)
 
 #genreate a joblist for parallelization
-JobList = make_joblist(log,AORlog)
+JobList = make_joblist(log, AORlog, index=read_group_index(['AORChannel']), ChunkFrames=frame_chunk_size(Nrows, Nthred))
 JobListName = OutputDIR+'jobs.ffcorr.tbl'
-ascii.write(JobList, JobListName, format="ipac", overwrite=True)
+write_table(JobList, JobListName)
 Njobs = len(JobList)
 #Nthred from supermopex.py
 
-print(">> Starting first frame correction with " + str(Nthred) + " threads.")
+print(">> Starting first frame correction with up to " + str(Nthred) + " threads.")
 
-pool = mp.Pool(processes=Nthred)
-results = pool.map(run_firstframe, range(0,Njobs))
+first_frame_corr_function.load_stage_data()
+results = run_timed_jobs(first_frame_corr_function.run_job, JobList, Nthred, 'ffcorr')
 
 print("Done!")
 
@@ -12,6 +12,8 @@ import numpy as np
 from astropy.io import ascii
 from astropy.io import fits
 from scipy.interpolate import interp1d
+from product_store import read_product, write_product, copy_product
+from frame_pipeline import prefetch, write_behind, queue_write
 from optparse import OptionParser
 
 def first_frame_correct(JobNo):
@@ -20,7 +22,7 @@ def first_frame_correct(JobNo):
     Ch = JobList['Channel'][JobNo]
     
     #make the list of files for this AOR and Channel
-    LogIDX = ((log['Channel']==Ch) & (log['AOR']==AOR)).nonzero()  # get the indexes of files we should use
+    LogIDX = job_rows(index, JobList, JobNo)  # get the indexes of files we should use
     files = log['Filename'][LogIDX]
     MJDs = log['MJD'][LogIDX]
     DCElist = log['DCE'][LogIDX]
@@ -28,127 +30,160 @@ def first_frame_correct(JobNo):
     
     print('## Begin ffcorr job {:4d} - AOR {:8d} Ch {:}, {:3d} frames'.format(JobNo, AOR, Ch, Nframes))
 
-    for fileNo in range(0,Nframes):
-    
-        MJD = MJDs[fileNo]
-        BCDfilename = files[fileNo]
-        
-        #Check if we are in the Cryo mission
-        if (MJD > WarmMJD):
-            cryo = 0
-            #print("  Warm mission: apply correction")  #DEBUG
-        else:
-            cryo = 1
-            #print("  Cryo mission: nothing to correct")  #DEBUG
-            
-        #setup  some file names
-        #Setup file suffixes re replace
-        inputSuffix  = '_' + bcdSuffix + '.fits'  #used in search
-
-        outputSuffix = '_' + corDataSuffix + '.fits'
-        ImageFile     = re.sub(inputSuffix,outputSuffix,BCDfilename) #Image File
-        
-        outputSuffix = '_' + ffSuffix + '.fits'
-        FFcorFile     = re.sub(inputSuffix,outputSuffix,BCDfilename) #First Frame Corrected File
-        
-        #remove output files
-        rmCMD = 'rm -rf ' + FFcorFile
-        os.system(rmCMD)
-        while os.path.exists(FFcorFile):     #wait for file to be deleted
-            wait = 1
-
-        #Only do correction for warm mission given the data we have in hand
-        if cryo:
-#            print('Wrote ' + str(fileNo +1) + ' of ' + str(Nframes) + ' No Correction, just copying ' + ImageFile) #,end='\r')
-            shutil.copy(ImageFile,FFcorFile)  #just copy over the file
-        else:
-            #read the image
-            imageHDU = fits.open(ImageFile)
-            
-            #get some file info
-            exptime = imageHDU[0].header['EXPTIME']
-            delay = imageHDU[0].header['FRAMEDLY']
-            fluxconv = imageHDU[0].header['FLUXCONV']
-            
-            if (delay > delayInfo[len(delayInfo)-1].delay):
-                DelayIDX = len(delayInfo)-2
-                DelayFrac = (delay-delayInfo[DelayIDX].delay)/(delayInfo[DelayIDX+1].delay-delayInfo[DelayIDX].delay)
+    Nskipped = 0  #frames already corrected from the same inputs
+
+    #the frames are read ahead and written behind their correction
+    frames = [(files[fileNo], MJDs[fileNo], DCElist[fileNo]) for fileNo in range(0,Nframes)]
+    with write_behind() as writer:
+        for (BCDfilename, MJD, DCE), frame in prefetch(read_ffcorr_frame, frames):
+
+            if frame['current']:
+                Nskipped += 1
+                continue
+
+            #Only do correction for warm mission given the data we have in hand
+            if frame['cryo']:
+                queue_write(writer, copy_product, frame['ImageFile'], frame['FFcorFile'])  #just copy over the file
             else:
-                DelayFrac = delay_to_index(delay)
-                DelayIDX = int(DelayFrac)
-                DelayFrac -= DelayIDX
-            
-            #interpolate the fits images to get the corrected frame
-            corrframe = delayData[Ch-1,DelayIDX]*(1.0-DelayFrac)+delayData[Ch-1,DelayIDX+1]*DelayFrac
-            corrframe *= fluxconv / exptime  #scale to the exposure time
-            corrframe /= flatData[cryo,Ch-1]  #put the flat into the correction
-            #do the correction
-            imageHDU[0].data -= corrframe
-            imageHDU.writeto(FFcorFile,overwrite='True')  #write out the final star subtracted image
-#            print('Wrote ' + str(fileNo +1) + ' of ' + str(Nframes) + ' ' + FFcorFile) #,end="\r")
-
-    print('## Finished ffcorr job {:4d}: AOR {:8d} ch {:}'.format(JobNo, AOR, Ch))
+                image, header = frame['image'], frame['header']
+
+                #get some file info
+                exptime = header['EXPTIME']
+                delay = header['FRAMEDLY']
+                fluxconv = header['FLUXCONV']
+
+                if (delay > delayInfo[len(delayInfo)-1].delay):
+                    DelayIDX = len(delayInfo)-2
+                    DelayFrac = (delay-delayInfo[DelayIDX].delay)/(delayInfo[DelayIDX+1].delay-delayInfo[DelayIDX].delay)
+                else:
+                    DelayFrac = delay_to_index(delay)
+                    DelayIDX = int(DelayFrac)
+                    DelayFrac -= DelayIDX
+
+                #interpolate the fits images to get the corrected frame
+                corrframe = delayData[Ch-1,DelayIDX]*(1.0-DelayFrac)+delayData[Ch-1,DelayIDX+1]*DelayFrac
+                corrframe *= fluxconv / exptime  #scale to the exposure time
+                corrframe /= flatData[frame['cryo'],Ch-1]  #put the flat into the correction
+                #do the correction
+                image -= corrframe
+                queue_write(writer, write_product, frame['FFcorFile'], image, header)  #write out the final star subtracted image
+            queue_write(writer, record_products, 'first_frame_corr', [(DCE, Ch, AOR, ffSuffix, frame['FFcorFile'], frame['inputs'])])
+
+    print('## Finished ffcorr job {:4d}: AOR {:8d} ch {:}; {:} frames up to date'.format(JobNo, AOR, Ch, Nskipped))
     
 
-#parse the arguments
-usagestring ='%prog Job_Number'
-parser = OptionParser()
-parser = OptionParser(usage=usagestring)
-(options, args) = parser.parse_args()
+#---------------------------------------------------------------------------------------------------
+# File names and input hash of a frame, whether it is up to date, and its image and header (frames
+# of the warm mission to correct only); run by the reader threads ahead of the correction
+#---------------------------------------------------------------------------------------------------
+
+def read_ffcorr_frame(item):
+
+    BCDfilename, MJD, DCE = item
+
+    #Check if we are in the Cryo mission
+    if (MJD > WarmMJD):
+        cryo = 0
+    else:
+        cryo = 1
+
+    #setup  some file names
+    #Setup file suffixes re replace
+    inputSuffix  = '_' + bcdSuffix + '.fits'  #used in search
+    ImageFile = re.sub(inputSuffix, '_' + corDataSuffix + '.fits', BCDfilename) #Image File
+    FFcorFile = re.sub(inputSuffix, '_' + ffSuffix + '.fits', BCDfilename)      #First Frame Corrected File
+
+    #skip the frame if it was already corrected from the same image and calibration
+    inputs = input_hash([ImageFile], (cryo, CalibrationID))
+    frame = {'cryo': cryo, 'ImageFile': ImageFile, 'FFcorFile': FFcorFile, 'inputs': inputs,
+             'current': products_current([FFcorFile], inputs)}
+    if (not frame['current']) and (not cryo):
+        frame['image'], frame['header'] = read_product(ImageFile, ['EXPTIME','FRAMEDLY','FLUXCONV'])
+    return(frame)
+
+
+#---------------------------------------------------------------------------------------------------
+# Load what all the jobs share: the log and its index, the job list written by first_frame_corr.py,
+# and the flat and frame delay calibration
+#---------------------------------------------------------------------------------------------------
+
+def load_stage_data():
+
+    global log, index, JobList, flatData, delayInfo, delay_to_index, delayData, CalibrationID
+
+    #Read the log file and get IRAC info, and the frames of each AOR.chan
+    log = read_log()
+    index = read_group_index(['AORChannel'])
+
+    #read the joblist written by first_frame_corr.py
+    JobListName = OutputDIR+'jobs.ffcorr.tbl'
+    JobList = read_table(JobListName)
+
+    #read in the flat data
+    print('Reading in flat data ', end='\r')
+    flatData = np.zeros([2,4,256,256],dtype=np.double) #delay data
+    #just doing ch1/2 for warm mission right now, leaving in option for others if/when those corrections become available
+    for cryo in range(0,1):
+        for Ch in range(1,3):
+            flatHDU = fits.open(flatFiles[cryo,Ch-1])
+            flatData[cryo,Ch-1]=flatHDU[0].data
+
+    #read in the delay files
+    print('... and Frame Delay Data')
+
+    #Read the delay files for the first frame correction
+    delayInfo = np.recfromtxt(FrameDelayFile,
+                              dtype=[('frame', np.int),     #Number
+                                     ('delay', np.float32)  #delay since last frame
+                                     ]
+                              )
+
+    #create a lookup index for the frame delay correction
+    delay_to_index =interp1d(delayInfo.delay,delayInfo.frame,bounds_error=False,fill_value='extrapolate')
+
 
-#fail if there aren't enough arguments
-if len(args) < 1:
-    parser.error("Incorrect number of arguments.")
+    #Read the fits files
+    delayData = np.zeros([2,len(delayInfo),256,256],dtype=np.double) #delay data
+    for i in range(0,len(delayInfo)):
+        for Ch in range(1,3):
+            delayFile = './cal/labdark.' + str(i) + '.' + str (Ch) + '.fits'
+            delayHDU = fits.open(delayFile)
+            delayData[Ch-1,i]=delayHDU[0].data
 
-#read job number
-JobNo=int(args[0])
+    #identity of the calibration files, for the input hashes of the corrected frames
+    CalFiles = [flatFiles[0,Ch-1] for Ch in range(1,3)] + [FrameDelayFile]
+    CalFiles += ['./cal/labdark.' + str(i) + '.' + str(Ch) + '.fits' for i in range(0,len(delayInfo)) for Ch in range(1,3)]
+    CalibrationID = input_hash(CalFiles)
 
-#Read the log file and get IRAC info
-rawlog = ascii.read(LogTable,format="ipac")
-log = rawlog[:][(rawlog['Instrument']=='IRAC').nonzero()]
 
-#Get the size of the array
-Nrows = log['Filename'].size
+#---------------------------------------------------------------------------------------------------
+# One job, once the stage data is loaded
+#---------------------------------------------------------------------------------------------------
 
-#read in the AOR properties log
-AORlog = ascii.read(AORinfoTable,format="ipac")
+def run_job(JobNo):
 
-#genreate a joblist for parallelization
-JobList = make_joblist(log,AORlog)
-Njobs = len(JobList)
+    first_frame_correct(JobNo)
 
-if (JobNo > Njobs):
-    die("Requested job number greater than number of jobs available " + str(Njobs) + "!");
 
-#read in the flat data
-print('Reading in flat data ', end='\r')
-flatData = np.zeros([2,4,256,256],dtype=np.double) #delay data
-#just doing ch1/2 for warm mission right now, leaving in option for others if/when those corrections become available
-for cryo in range(0,1):
-    for Ch in range(1,3):
-        flatHDU = fits.open(flatFiles[cryo,Ch-1])
-        flatData[cryo,Ch-1]=flatHDU[0].data
+if __name__ == '__main__':
 
-#read in the delay files
-print('... and Frame Delay Data')
+    #parse the arguments
+    usagestring ='%prog Job_Number'
+    parser = OptionParser()
+    parser = OptionParser(usage=usagestring)
+    (options, args) = parser.parse_args()
 
-#Read the delay files for the first frame correction
-delayInfo = np.recfromtxt(FrameDelayFile,
-                          dtype=[('frame', np.int),     #Number
-                                 ('delay', np.float32)  #delay since last frame
-                                 ]
-                          )
+    #fail if there aren't enough arguments
+    if len(args) < 1:
+        parser.error("Incorrect number of arguments.")
 
-#create a lookup index for the frame delay correction
-delay_to_index =interp1d(delayInfo.delay,delayInfo.frame,bounds_error=False,fill_value='extrapolate')
+    #read job number
+    JobNo=int(args[0])
 
+    load_stage_data()
+    Njobs = len(JobList)
 
-#Read the fits files
-delayData = np.zeros([2,len(delayInfo),256,256],dtype=np.double) #delay data
-for i in range(0,len(delayInfo)):
-    for Ch in range(1,3):
-        delayFile = './cal/labdark.' + str(i) + '.' + str (Ch) + '.fits'
-        delayHDU = fits.open(delayFile)
-        delayData[Ch-1,i]=delayHDU[0].data
+    if (JobNo > Njobs):
+        die("Requested job number greater than number of jobs available " + str(Njobs) + "!");
 
-first_frame_correct(JobNo)
+    run_job(JobNo)
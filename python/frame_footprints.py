@@ -0,0 +1,356 @@
+#---------------------------------------------------------------------------------------------------
+# Frame footprints: the four sky corners of each frame, from the header WCS at inventory time, and a
+# spatial index over them.  The index is a grid of cells in declination bands, each band split in RA
+# cells of about the same size on the sky; each cell lists the frames whose footprint box touches it.
+# Queries look up the cells of the region, then test the candidate frames exactly on the tangent
+# plane at the region centre.
+#---------------------------------------------------------------------------------------------------
+
+import numpy as np
+
+CellSize = 0.5     # size of the index cells in degrees; an IRAC frame is 0.087 deg across
+
+
+#---------------------------------------------------------------------------------------------------
+# Sky corners (RA1, DEC1, ... RA4, DEC4) of a frame from its header; NaN if the WCS is not usable
+#---------------------------------------------------------------------------------------------------
+
+def frame_corners(header):
+
+    from astropy import wcs   #only the inventory needs it
+
+    try:
+        corners = wcs.WCS(header).calc_footprint()
+    except Exception:
+        corners = None
+    if (corners is None) or (np.shape(corners) != (4,2)):
+        return([np.nan]*8)
+    return([float(value) for value in corners.reshape(8)])
+
+
+#---------------------------------------------------------------------------------------------------
+# Sky corners of a mosaic (tile) from its mopex FIF table, whose header lines are '\type KEY = value'
+#---------------------------------------------------------------------------------------------------
+
+def fif_corners(FIFfile):
+
+    from astropy.io import fits   #only the tiles need it
+
+    header = fits.Header()
+    with open(FIFfile, 'r') as fif:
+        for line in fif:
+            items = line.split()
+            if (len(items) > 3) and items[0].startswith('\\') and (items[2] == '=') and (len(items[1]) <= 8):
+                value = ' '.join(items[3:]).strip("'\" ")
+                for convert in (int, float):
+                    try:
+                        value = convert(value)
+                        break
+                    except ValueError:
+                        pass
+                header[items[1]] = value
+    return(frame_corners(header))
+
+
+#---------------------------------------------------------------------------------------------------
+# Select the catalog entries (ra, dec arrays) within radius (deg) of the bounding box of a set of
+# positions; a cheap cut before computing separations frame by frame
+#---------------------------------------------------------------------------------------------------
+
+def near_positions(ra, dec, RAs, DECs, radius):
+
+    ramin, ramax, decmin, decmax = footprint_boxes(np.atleast_2d(RAs), np.atleast_2d(DECs))
+    decmin, decmax = decmin[0]-radius, decmax[0]+radius
+    if (decmax > 90.0-radius) or (decmin < -90.0+radius):
+        return((dec >= decmin) & (dec <= decmax))
+    dra = radius / np.cos(np.radians(max(abs(decmin), abs(decmax))))
+    ramin, ramax = ramin[0]-dra, ramax[0]+dra
+    if ramax - ramin >= 360.0:
+        return((dec >= decmin) & (dec <= decmax))
+    offset = (np.asarray(ra) - ramin) % 360.0
+    return((offset <= ramax-ramin) & (dec >= decmin) & (dec <= decmax))
+
+
+#---------------------------------------------------------------------------------------------------
+# Select the catalog entries (ra, dec arrays) on the footprint of one frame (a row of the index) or
+# within radius (deg) of it; returns a boolean array
+#---------------------------------------------------------------------------------------------------
+
+def positions_near_frame(SkyIndex, row, ra, dec, radius):
+
+    ra, dec = np.asarray(ra, dtype=np.double), np.asarray(dec, dtype=np.double)
+    near = np.flatnonzero(near_positions(ra, dec, SkyIndex['RA'][row], SkyIndex['DEC'][row], radius))   #the box first
+    ramin, ramax, decmin, decmax = footprint_boxes(SkyIndex['RA'][row], SkyIndex['DEC'][row])
+    ra0, dec0 = ramin[0] + 0.5*(ramax[0]-ramin[0]), 0.5*(decmin[0]+decmax[0])
+    quad = project_frames(SkyIndex, [row], ra0, dec0)
+    x, y = tangent_plane(ra[near], dec[near], ra0, dec0)
+    points = np.stack([x, y], axis=-1).reshape(-1,2)
+    inside = quads_contain(quad, points)[0]
+
+    #distance from each entry to the nearest edge: 4 x P
+    start = quad[0][:,np.newaxis,:]
+    edge = np.roll(quad[0], -1, axis=0)[:,np.newaxis,:] - start
+    t = np.clip(np.sum((points[np.newaxis] - start)*edge, axis=2) / np.maximum(np.sum(edge*edge, axis=2), 1e-30), 0.0, 1.0)
+    closest = start + t[...,np.newaxis]*edge
+    distance = np.min(np.sqrt(np.sum((points[np.newaxis] - closest)**2, axis=2)), axis=0)
+    selected = np.zeros(len(ra), dtype=bool)
+    selected[near[inside | (distance <= radius)]] = True
+    return(selected)
+
+
+#---------------------------------------------------------------------------------------------------
+# Gnomonic projection of (ra, dec) onto the tangent plane at (ra0, dec0); all in degrees
+#---------------------------------------------------------------------------------------------------
+
+def tangent_plane(ra, dec, ra0, dec0):
+
+    ra, dec = np.radians(ra), np.radians(dec)
+    ra0, dec0 = np.radians(ra0), np.radians(dec0)
+    cosc = np.sin(dec0)*np.sin(dec) + np.cos(dec0)*np.cos(dec)*np.cos(ra-ra0)
+    x = np.cos(dec)*np.sin(ra-ra0) / cosc
+    y = (np.cos(dec0)*np.sin(dec) - np.sin(dec0)*np.cos(dec)*np.cos(ra-ra0)) / cosc
+    return(np.degrees(x), np.degrees(y))
+
+
+#---------------------------------------------------------------------------------------------------
+# The grid: number of RA cells in each declination band, and the id of the first cell of each band
+#---------------------------------------------------------------------------------------------------
+
+def grid_bands():
+
+    Nbands = int(np.ceil(180.0/CellSize))
+    edges = np.minimum(np.abs(-90.0 + CellSize*np.arange(Nbands)), np.abs(-90.0 + CellSize*(np.arange(Nbands)+1)))
+    Nra = np.maximum(1, np.floor(360.0*np.cos(np.radians(edges))/CellSize)).astype(np.int64)
+    first = np.append(0, np.cumsum(Nra))
+    return(Nra, first)
+
+
+#---------------------------------------------------------------------------------------------------
+# Cells touched by a box in RA/Dec; the RA range may cross 0 (ramin < 0 or ramax > 360)
+#---------------------------------------------------------------------------------------------------
+
+def box_cells(ramin, ramax, decmin, decmax, Nra, first):
+
+    cells = list()
+    band0 = int(np.clip(np.floor((decmin+90.0)/CellSize), 0, len(Nra)-1))
+    band1 = int(np.clip(np.floor((decmax+90.0)/CellSize), 0, len(Nra)-1))
+    for band in range(band0, band1+1):
+        n = Nra[band]
+        if ramax - ramin >= 360.0:
+            cells.extend(range(first[band], first[band]+n))
+            continue
+        i0 = int(np.floor(ramin/360.0*n))
+        i1 = int(np.floor(ramax/360.0*n))
+        if i1 - i0 + 1 >= n:
+            cells.extend(range(first[band], first[band]+n))
+        else:
+            cells.extend([first[band] + (i % n) for i in range(i0, i1+1)])
+    return(cells)
+
+
+#---------------------------------------------------------------------------------------------------
+# Bounding box of footprints: RA range taken relative to the first corner to handle RA=0; the box is
+# widened to all RA when it comes close to a pole
+#---------------------------------------------------------------------------------------------------
+
+def footprint_boxes(RAcorners, DECcorners):
+
+    RAcorners, DECcorners = np.atleast_2d(RAcorners), np.atleast_2d(DECcorners)
+    ra0 = RAcorners[:,0:1]
+    dra = (RAcorners - ra0 + 180.0) % 360.0 - 180.0
+    ramin = ra0[:,0] + np.min(dra, axis=1)
+    ramax = ra0[:,0] + np.max(dra, axis=1)
+    decmin = np.min(DECcorners, axis=1)
+    decmax = np.max(DECcorners, axis=1)
+    polar = (decmax > 90.0-CellSize) | (decmin < -90.0+CellSize)
+    ramin[polar] = 0.0
+    ramax[polar] = 360.0
+    return(ramin, ramax, decmin, decmax)
+
+
+#---------------------------------------------------------------------------------------------------
+# Build the index from the corners of N frames (arrays N x 4); returns a dictionary of arrays:
+# the corners, and for the cells in use their ids, offsets and the frame rows (row = log row)
+#---------------------------------------------------------------------------------------------------
+
+def make_sky_index(RAcorners, DECcorners):
+
+    RAcorners  = np.asarray(RAcorners, dtype=np.double).reshape(-1,4)
+    DECcorners = np.asarray(DECcorners, dtype=np.double).reshape(-1,4)
+    Nra, first = grid_bands()
+
+    cellIDs = list()
+    rows = list()
+    ramin, ramax, decmin, decmax = footprint_boxes(RAcorners, DECcorners)
+    for row in range(len(RAcorners)):
+        if not np.isfinite(ramin[row] + ramax[row] + decmin[row] + decmax[row]):
+            continue   #no WCS for this frame
+        cells = box_cells(ramin[row], ramax[row], decmin[row], decmax[row], Nra, first)
+        cellIDs.extend(cells)
+        rows.extend([row]*len(cells))
+
+    cellIDs = np.array(cellIDs, dtype=np.int64)
+    rows = np.array(rows, dtype=np.int64)
+    order = np.argsort(cellIDs, kind='stable')
+    cellIDs, rows = cellIDs[order], rows[order]
+    cells, starts = np.unique(cellIDs, return_index=True)
+
+    return({'RA': RAcorners, 'DEC': DECcorners, 'cells': cells,
+            'offsets': np.append(starts, len(cellIDs)).astype(np.int64), 'rows': rows})
+
+
+#---------------------------------------------------------------------------------------------------
+# Candidate frames for a box: the frames listed in its cells
+#---------------------------------------------------------------------------------------------------
+
+def candidate_frames(SkyIndex, ramin, ramax, decmin, decmax):
+
+    Nra, first = grid_bands()
+    cells = np.array(box_cells(ramin, ramax, decmin, decmax, Nra, first), dtype=np.int64)
+    cells = cells[np.isin(cells, SkyIndex['cells'])]
+    pos = np.searchsorted(SkyIndex['cells'], cells)
+    offsets, rows = SkyIndex['offsets'], SkyIndex['rows']
+    if len(pos) == 0:
+        return(np.zeros(0, dtype=np.int64))
+    return(np.unique(np.concatenate([rows[offsets[p]:offsets[p+1]] for p in pos])))
+
+
+#---------------------------------------------------------------------------------------------------
+# Exact tests on the tangent plane: candidate quadrilaterals (N x 4 x 2) against a point, a convex
+# polygon (M x 2) or a circle
+#---------------------------------------------------------------------------------------------------
+
+def edge_sides(quads, points):
+
+    #cross product of each edge with the vector to each point: N x 4 x P
+    start = quads[:,:,np.newaxis,:]
+    edge = np.roll(quads, -1, axis=1)[:,:,np.newaxis,:] - start
+    vec = points[np.newaxis,np.newaxis,:,:] - start
+    return(edge[...,0]*vec[...,1] - edge[...,1]*vec[...,0])
+
+
+def quads_contain(quads, points):
+
+    cross = edge_sides(quads, points)
+    return(np.all(cross >= 0, axis=1) | np.all(cross <= 0, axis=1))   #N x P
+
+
+def polygon_axes(polygons):
+
+    edge = np.roll(polygons, -1, axis=-2) - polygons
+    return(np.stack([-edge[...,1], edge[...,0]], axis=-1))
+
+
+def quads_overlap_polygon(quads, polygon):
+
+    #separating axis test for convex polygons
+    overlap = np.ones(len(quads), dtype=bool)
+    axes = np.concatenate([polygon_axes(quads), np.broadcast_to(polygon_axes(polygon), (len(quads),) + polygon.shape)], axis=1)
+    for k in range(axes.shape[1]):
+        axis = axes[:,k,:]
+        pq = np.einsum('nij,nj->ni', quads, axis)
+        pp = np.einsum('ij,nj->ni', polygon, axis)
+        overlap &= (pq.max(axis=1) >= pp.min(axis=1)) & (pp.max(axis=1) >= pq.min(axis=1))
+    return(overlap)
+
+
+def quads_near_point(quads, radius):
+
+    #distance from the origin to each quad (0 if inside) compared to the radius
+    inside = quads_contain(quads, np.zeros([1,2]))[:,0]
+    start = quads
+    edge = np.roll(quads, -1, axis=1) - start
+    t = np.clip(-np.sum(start*edge, axis=2) / np.maximum(np.sum(edge*edge, axis=2), 1e-30), 0.0, 1.0)
+    closest = start + t[...,np.newaxis]*edge
+    distance = np.min(np.sqrt(np.sum(closest*closest, axis=2)), axis=1)
+    return(inside | (distance <= radius))
+
+
+def project_frames(SkyIndex, rows, ra0, dec0):
+
+    x, y = tangent_plane(SkyIndex['RA'][rows], SkyIndex['DEC'][rows], ra0, dec0)
+    return(np.stack([x, y], axis=-1))
+
+
+#---------------------------------------------------------------------------------------------------
+# Queries: frames (log rows) containing a point, overlapping a convex polygon given by its corners,
+# or within a radius (deg) of a point
+#---------------------------------------------------------------------------------------------------
+
+def frames_containing(SkyIndex, ra, dec):
+
+    rows = candidate_frames(SkyIndex, ra, ra, dec, dec)
+    if len(rows) == 0:
+        return(rows)
+    quads = project_frames(SkyIndex, rows, ra, dec)
+    return(rows[quads_contain(quads, np.zeros([1,2]))[:,0]])
+
+
+def frames_overlapping(SkyIndex, RAcorners, DECcorners):
+
+    RAcorners, DECcorners = np.asarray(RAcorners, dtype=np.double), np.asarray(DECcorners, dtype=np.double)
+    ramin, ramax, decmin, decmax = footprint_boxes(RAcorners, DECcorners)
+    rows = candidate_frames(SkyIndex, ramin[0], ramax[0], decmin[0], decmax[0])
+    if len(rows) == 0:
+        return(rows)
+    ra0, dec0 = ramin[0] + 0.5*(ramax[0]-ramin[0]), 0.5*(decmin[0]+decmax[0])
+    quads = project_frames(SkyIndex, rows, ra0, dec0)
+    x, y = tangent_plane(RAcorners, DECcorners, ra0, dec0)
+    return(rows[quads_overlap_polygon(quads, np.stack([x, y], axis=-1))])
+
+
+def frames_near(SkyIndex, ra, dec, radius):
+
+    dra = radius / max(np.cos(np.radians(min(abs(dec)+radius, 89.9))), 1e-3)
+    rows = candidate_frames(SkyIndex, ra-dra, ra+dra, dec-radius, dec+radius)
+    if len(rows) == 0:
+        return(rows)
+    quads = project_frames(SkyIndex, rows, ra, dec)
+    return(rows[quads_near_point(quads, radius)])
+
+
+#---------------------------------------------------------------------------------------------------
+# Command line: frames containing a point or overlapping a region, and the mosaic tiles to redo
+# when frames are added or reprocessed (incremental remosaicking)
+#---------------------------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+
+    import sys
+    from optparse import OptionParser
+    from supermopex import *
+    from spitzer_pipeline_functions import read_log, read_sky_index, read_table
+
+    usagestring = '%prog point RA DEC | region RA1 DEC1 ... RA4 DEC4 | tiles framelist'
+    parser = OptionParser(usage=usagestring)
+    (options, args) = parser.parse_args()
+
+    if len(args) < 2:
+        parser.error("Incorrect number of arguments.")
+    SkyIndex = read_sky_index()
+    if SkyIndex is None:
+        print("## ERROR: the frame log has no footprints; run the inventory again")
+        sys.exit(1)
+    log = read_log()
+
+    action = args[0]
+    if action == 'point':
+        for row in frames_containing(SkyIndex, float(args[1]), float(args[2])):
+            print(log['Filename'][row])
+    elif action == 'region':
+        corners = [float(value) for value in args[1:9]]
+        for row in frames_overlapping(SkyIndex, corners[0::2], corners[1::2]):
+            print(log['Filename'][row])
+    elif action == 'tiles':
+        #tiles (number and channel) overlapped by any of the frames in the list
+        frames = set(np.loadtxt(args[1], dtype=str, ndmin=1).tolist())
+        rows = np.array([row for row, filename in enumerate(log['Filename']) if filename in frames], dtype=np.int64)
+        TileList = read_table(TileListFile)
+        for JobNo in range(len(TileList)):
+            corners = fif_corners(TileList['FIF'][JobNo])
+            overlap = frames_overlapping(SkyIndex, corners[0::2], corners[1::2])
+            overlap = np.intersect1d(overlap, rows)
+            if np.any(log['Channel'][overlap] == TileList['Channel'][JobNo]):
+                print("{:} {:}".format(TileList['TileNumber'][JobNo], TileList['Channel'][JobNo]))
+    else:
+        parser.error("Unknown action " + action)
@@ -0,0 +1,340 @@
+#---------------------------------------------------------------------------------------------------
+# Frame inventory: find the BCD frames in RawDataDir, read their headers and build the log tables
+#---------------------------------------------------------------------------------------------------
+
+import re, os
+import numpy as np
+from astropy.io import fits
+from astropy.table import Table
+import multiprocessing as mp
+
+from supermopex import *
+from spitzer_pipeline_functions import write_table, write_log
+from product_manifest import insert_products, prune_frames
+from frame_footprints import frame_corners
+
+FITSblock = 2880   # size of a FITS header/data block
+FITScard  = 80     # size of a FITS header card
+
+
+#---------------------------------------------------------------------------------------------------
+# Walk the raw data directory and return the sorted list of BCD files as (filename, size, mtime) 
+# Use the UNC files to select them because they are only generated if the BCD pipeline didn't fail
+#---------------------------------------------------------------------------------------------------
+
+def find_bcd_files(DataDir):
+
+    uncEnding = '_' + UncSuffix + '.fits'
+    bcdEnding = '_' + bcdSuffix + '.fits'
+
+    BCDfiles = list()
+    Nmissing = 0
+    dirs = [DataDir]
+    while dirs:
+        uncNames = list()
+        bcdStats = dict()
+        with os.scandir(dirs.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=True):
+                    dirs.append(entry.path)
+                elif entry.name.endswith(uncEnding):
+                    uncNames.append(entry.path)
+                elif entry.name.endswith(bcdEnding):
+                    bcdStats[entry.path] = entry.stat()
+
+        for name in uncNames:
+            BCDfile = name[:-len(uncEnding)] + bcdEnding
+            if BCDfile in bcdStats:
+                BCDfiles.append((BCDfile, bcdStats[BCDfile].st_size, bcdStats[BCDfile].st_mtime_ns))
+            else:
+                Nmissing += 1
+
+    if Nmissing > 0:
+        print("## WARNING: {:} {:} files have no matching {:} file".format(Nmissing, uncEnding, bcdEnding))
+
+    BCDfiles.sort()  # keep frames in name (exposure) order
+    return(BCDfiles)
+
+
+#---------------------------------------------------------------------------------------------------
+# Read only the primary header of a fits file: stop at the END card, never touch the data unit
+#---------------------------------------------------------------------------------------------------
+
+def read_primary_header(filename):
+
+    blocks = list()
+    with open(filename, 'rb') as fitsfile:
+        while True:
+            block = fitsfile.read(FITSblock)
+            if len(block) < FITSblock:
+                raise IOError("{:}: truncated primary header".format(filename))
+            blocks.append(block)
+            for card in range(0, FITSblock, FITScard):
+                if block[card:card+8] == b'END     ':
+                    return(fits.Header.fromstring(b''.join(blocks).decode('ascii')))
+
+
+#---------------------------------------------------------------------------------------------------
+# Build the log line for one BCD file, header items then footprint corners; returns (LogLine, good)
+#---------------------------------------------------------------------------------------------------
+
+def read_frame_info(BCDfile):
+
+    header = read_primary_header(BCDfile)
+
+    LogLine = [BCDfile]
+    for item in HeaderItems:
+        LogLine.append(header.get(item))
+    LogLine.extend(frame_corners(header))
+
+    #Do some checking to see if the BCD header is good, reject frame if it is not
+    good = True
+    if header.get('FRAMEDLY') <= 0:  #reject if frame delay is not positive
+        good = False
+    if header.get('CHNLNUM') > 4:    #reject if channel number too high
+        good = False
+
+    return(LogLine, good)
+
+
+#---------------------------------------------------------------------------------------------------
+# Read the headers of a list of files with Nworkers processes, in file order.
+# Rows are streamed back from the workers as they are read: yields (LogLine, good) for each file
+#---------------------------------------------------------------------------------------------------
+
+def read_frame_headers(BCDfiles, Nworkers=1):
+
+    if (Nworkers > 1) and (len(BCDfiles) > 1):
+        pool = mp.Pool(processes=Nworkers)
+        chunk = max(1, min(256, len(BCDfiles) // (4*Nworkers)))
+        try:
+            for result in pool.imap(read_frame_info, BCDfiles, chunksize=chunk):
+                yield(result)
+        finally:
+            pool.terminate()   #all read, or the reader stopped: no work left for the workers
+            pool.join()
+    else:
+        for BCDfile in BCDfiles:
+            yield(read_frame_info(BCDfile))
+
+
+#---------------------------------------------------------------------------------------------------
+# The inventory cache: one row per BCD file found (good or rejected), keyed on (Filename, Size, Mtime),
+# with the header values of the log.  Stored as a numpy structured array next to Frames.tbl; the
+# keywords missing from a header are listed in its Missing column, and read back as None
+#---------------------------------------------------------------------------------------------------
+
+def read_inventory_cache():
+
+    if not os.path.exists(InventoryCache):
+        return(dict())
+
+    cache = np.load(InventoryCache, allow_pickle=False)
+    if not set(FootprintItems + ('Missing',)).issubset(cache.dtype.names):
+        return(dict())   #cache from before the footprints or missing values were recorded: read all headers again
+
+    entries = dict()
+    for row in cache:
+        missing = set(row['Missing'].item().split(','))
+        LogLine = [None if item in missing else row[item].item() for item in LogItems + FootprintItems]
+        entries[row['Filename'].item()] = (row['Size'].item(), row['Mtime'].item(), bool(row['Good']), LogLine)
+    return(entries)
+
+
+def write_inventory_cache(entries):
+
+    rows = list()
+    for filename in sorted(entries):
+        Size, Mtime, good, LogLine = entries[filename]
+        missing = [item for item, value in zip(LogItems + FootprintItems, LogLine) if value is None]
+        rows.append([Size, Mtime, good] + LogLine + [','.join(missing)])
+    cache = Table(rows=rows, names=('Size','Mtime','Good') + LogItems + FootprintItems + ('Missing',))
+
+    #missing header keywords give object columns: store the values found with their type, and a
+    #blank of that type where missing (listed in Missing)
+    for name in cache.colnames:
+        if cache[name].dtype.kind == 'O':
+            found = np.array([value for value in cache[name] if value is not None])
+            blank = np.zeros(1, dtype=found.dtype)[0] if len(found) > 0 else ''
+            cache[name] = np.array([blank if value is None else value for value in cache[name]], dtype=found.dtype if len(found) > 0 else str)
+
+    tmpfile = InventoryCache + '.tmp.npy'
+    np.save(tmpfile, cache.as_array(), allow_pickle=False)
+    os.replace(tmpfile, InventoryCache)
+
+
+#---------------------------------------------------------------------------------------------------
+# Bring the inventory up to date: read the headers only of new or changed files (different size
+# or mtime), drop the files that disappeared, and return the log of good frames in file order
+#---------------------------------------------------------------------------------------------------
+
+def update_inventory(BCDfiles, Nworkers=1, rescan=False):
+
+    if rescan:
+        cached = dict()
+    else:
+        cached = read_inventory_cache()
+
+    entries = dict()
+    toread = list()
+    for (filename, Size, Mtime) in BCDfiles:
+        entry = cached.get(filename)
+        if (entry is not None) and (entry[0] == Size) and (entry[1] == Mtime):
+            entries[filename] = entry
+        else:
+            toread.append((filename, Size, Mtime))
+
+    Ndeleted = len(set(cached) - set([filename for (filename, Size, Mtime) in BCDfiles]))
+    print('>> {:} files unchanged, {:} new or changed, {:} removed since last inventory'.format(len(entries), len(toread), Ndeleted))
+    print('>> Reading {:} headers with {:} workers'.format(len(toread), Nworkers))
+
+    #each row goes into the log as its header arrives
+    rows = read_frame_headers([filename for (filename, Size, Mtime) in toread], Nworkers)
+    for (filename, Size, Mtime), (LogLine, good) in zip(toread, rows):
+        entries[filename] = (Size, Mtime, good, LogLine)
+
+    write_inventory_cache(entries)
+
+    LogOutput = list()
+    for fileNo, (filename, Size, Mtime) in enumerate(BCDfiles):
+        Size, Mtime, good, LogLine = entries[filename]
+        if good:
+            LogOutput.append(LogLine)  #Add line to log
+        else:
+            print("## Rejecting frame {:} because of bad header!".format(fileNo))
+
+    return(LogOutput)
+
+
+#---------------------------------------------------------------------------------------------------
+# Make the table of AOR properties from the frame log; also returns the number of IRAC and MIPS bands
+#---------------------------------------------------------------------------------------------------
+
+def make_aor_table(log):
+
+    AORList = list(set(log['AOR']))  #get a list of AORs
+
+    NIracBands = 0
+    NMipsBands = 0
+    AORinfo = list()
+    for AOR in AORList:
+        AORLog = log[:][(log['AOR']==AOR).nonzero()] #get the log entries for this AOR
+
+        #check for HDR mode or not.  HDR mode if all data is HDR
+        HDRmode = 'True'
+        for item in AORLog['HDR']:
+            if re.match(str(item),'False'):
+                HDRmode = 'False'
+                break
+
+        #get the max number of channels
+        Nch = np.max(AORLog['Channel'])
+        AORinfo.append([AOR, AORLog['Object'][0], AORLog['Instrument'][0], AORLog['PID'][0], AORLog['ObsType'][0], HDRmode, Nch])
+
+        #How many IRAC / MIPS bands
+        if (AORLog['Instrument'][0] == 'IRAC') and (Nch > NIracBands):
+            NIracBands = Nch
+        if (AORLog['Instrument'][0] == 'MIPS') and (Nch > NMipsBands):
+            NMipsBands = Nch
+
+    AORlog = Table(rows=AORinfo, names=('AOR','Object','Instrument','PID','ObsType','HDR','NumChannel'))
+    return(AORlog, NIracBands, NMipsBands)
+
+
+#---------------------------------------------------------------------------------------------------
+# Write one list of files, replacing the bcd suffix with the given one
+#---------------------------------------------------------------------------------------------------
+
+def write_file_list(files, suffix, listname):
+
+    inputSuffix  = '_' + bcdSuffix + '.fits'  #bcd is the default ending
+    outputSuffix = '_' + suffix + '.fits'
+    OutputFileList = [re.sub(inputSuffix, outputSuffix, filename) for filename in files]
+    np.savetxt(listname, OutputFileList, fmt='%s')
+
+
+#---------------------------------------------------------------------------------------------------
+# Write the per-channel (and FIF) file lists for mopex
+#---------------------------------------------------------------------------------------------------
+
+def write_file_lists(log, NIracBands, NMipsBands):
+
+    for Ch in range(1, NIracBands+1):
+        #get the list of files for this instrument and band
+        files = log['Filename'][((log['Instrument']=='IRAC') & (log['Channel']==Ch)).nonzero()]
+        for suffix in IRACsuffixList:
+            write_file_list(files, suffix, OutputDIR + PIDname + '.irac.' + str(Ch) + '.' + suffix + '.lst')
+
+    if NIracBands > 0:
+        #make the FIF file lists for IRAC: all BCD data and corrected BCDs
+        files = log['Filename'][(log['Instrument']=='IRAC').nonzero()]
+        write_file_list(files, bcdSuffix, OutputDIR + PIDname + '.irac.FIF.' + bcdSuffix + '.lst')
+        write_file_list(files, corDataSuffix, OutputDIR + PIDname + '.irac.FIF.' + corDataSuffix + '.lst')
+
+    for Ch in range(1, NMipsBands+1):
+        files = log['Filename'][((log['Instrument']=='MIPS') & (log['Channel']==Ch)).nonzero()]
+        for suffix in MIPSsuffixList:
+            write_file_list(files, suffix, OutputDIR + PIDname + '.mips.' + str(Ch) + '.' + suffix + '.lst')
+
+        #make one list per AOR
+        for AOR in list(set(log['AOR'])):
+            files = log['Filename'][((log['Instrument']=='MIPS') & (log['Channel']==Ch) & (log['AOR']==AOR)).nonzero()]
+            for suffix in MIPSsuffixList:
+                write_file_list(files, suffix, OutputDIR + PIDname + '.mips.' + str(AOR) + '.' + str(Ch) + '.' + suffix + '.lst')
+
+    if NMipsBands > 0:
+        files = log['Filename'][(log['Instrument']=='MIPS').nonzero()]
+        np.savetxt(OutputDIR + PIDname + '.mips.FIF.' + bcdSuffix + '.lst', files, fmt='%s')
+
+
+#---------------------------------------------------------------------------------------------------
+# Write Frames.tbl, AORs.tbl (and their binary copies) and the file lists from the frame log
+#---------------------------------------------------------------------------------------------------
+
+def write_frame_tables(log):
+
+    write_log(log)
+
+    AORlog, NIracBands, NMipsBands = make_aor_table(log)
+    write_table(AORlog, AORinfoTable)
+
+    print("Your data consists of:")
+    print("- {:} AORs".format(len(AORlog)))
+    print("- labled with {:} object names".format(len(set(log['Object']))))
+    print("- Observed with {:} Program IDs".format(len(set(log['PID']))))
+    print()
+
+    write_file_lists(log, NIracBands, NMipsBands)
+
+
+#---------------------------------------------------------------------------------------------------
+# Inventory: make the work directories, find the frames, read the headers of the new or changed
+# ones (all of them if rescan), and write the tables
+#---------------------------------------------------------------------------------------------------
+
+def setup_pipeline(Nworkers=1, rescan=False):
+
+    #make the needed directories
+    for directory in (TMPDIR, OutputDIR, AORoutput):
+        if not(os.path.exists(directory)):
+            os.mkdir(directory)
+
+    print('>> Finding BCD Files')
+    BCDfiles = find_bcd_files(RawDataDir)
+    print('>> Found {:} files; read the headers and create an inventory'.format(len(BCDfiles)))
+
+    LogOutput = update_inventory(BCDfiles, Nworkers, rescan)
+
+    print()
+    print(">> Now process the inventory")
+    log = Table(rows=LogOutput, names=LogItems + FootprintItems)
+    write_frame_tables(log)
+
+    #record the frames in the product manifest, with the size and mtime found in the scan, and drop
+    #the rows of the frames gone
+    FileStats = dict((filename, (Size, Mtime)) for (filename, Size, Mtime) in BCDfiles)
+    insert_products('setup_pipeline', [(DCE, Ch, AOR, bcdSuffix, filename) + FileStats[filename] + ('',)
+                                       for (DCE, Ch, AOR, filename) in zip(log['DCE'], log['Channel'], log['AOR'], log['Filename'])])
+    prune_frames(log['DCE'])
+
+    return(log)
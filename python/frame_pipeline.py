@@ -0,0 +1,109 @@
+#---------------------------------------------------------------------------------------------------
+# Overlapped I/O of the per-frame loops of the stages: the inputs of the next frames are read by a
+# few threads while the current frame is computed, and its outputs are written by a thread behind
+# it while the next one is computed.  Both are bounded, by PrefetchFrames frames read ahead and
+# WriteBehindFrames frames waiting to be written: a loop that gets ahead of its writes waits for
+# them.  The file reads and writes release the GIL, so on the network file system they overlap the
+# computation of the job, and the external programs it runs.
+#
+#   for item, frame in prefetch(read_inputs, items):     # read_inputs(item) in the reader threads
+#       ...
+#       queue_write(writer, write_outputs, ...)          # writer from:  with write_behind() as writer
+#
+# A read or write that fails raises in the loop, when its frame is reached or when the writer
+# waits for it.  With PrefetchFrames or WriteBehindFrames 0 the reads or writes are done in line.
+#---------------------------------------------------------------------------------------------------
+
+import collections
+import contextlib
+import concurrent.futures as futures
+
+from supermopex import *
+
+WarmBufferSize = 1 << 20   # bytes read at a time to warm a file
+
+
+#---------------------------------------------------------------------------------------------------
+# Read ahead: yield (item, function(item)) for the items in order, with up to depth of them read or
+# being read by IOThreads threads
+#---------------------------------------------------------------------------------------------------
+
+def prefetch(function, items, depth=None):
+
+    if depth is None:
+        depth = PrefetchFrames
+    if depth <= 0:
+        for item in items:
+            yield((item, function(item)))
+        return
+
+    items = iter(items)
+    pending = collections.deque()
+    pool = futures.ThreadPoolExecutor(max_workers=IOThreads)
+    try:
+        for item in items:
+            pending.append((item, pool.submit(function, item)))
+            if len(pending) > depth:
+                item, future = pending.popleft()
+                yield((item, future.result()))
+        while pending:
+            item, future = pending.popleft()
+            yield((item, future.result()))
+    finally:   #also when the loop stops early: the reads not started are dropped
+        for item, future in pending:
+            future.cancel()
+        pool.shutdown(wait=True)
+
+
+#---------------------------------------------------------------------------------------------------
+# Write behind: a writer thread runs the functions queued to it, in order; queue_write waits while
+# depth of them are pending.  On leaving the block the writes are finished, and the first error of
+# one is raised unless the block itself raised
+#---------------------------------------------------------------------------------------------------
+
+@contextlib.contextmanager
+def write_behind(depth=None):
+
+    if depth is None:
+        depth = WriteBehindFrames
+    writer = {'depth': depth, 'pending': collections.deque(),
+              'pool': futures.ThreadPoolExecutor(max_workers=1) if depth > 0 else None}
+    try:
+        yield(writer)
+    finally:   #all the queued writes are done, even after an error
+        if writer['pool'] is not None:
+            futures.wait(list(writer['pending']))
+            writer['pool'].shutdown(wait=True)
+    flush_writes(writer)
+
+
+def queue_write(writer, function, *args):
+
+    if writer['pool'] is None:
+        function(*args)
+        return
+    while len(writer['pending']) >= writer['depth']:
+        writer['pending'].popleft().result()
+    writer['pending'].append(writer['pool'].submit(function, *args))
+
+
+def flush_writes(writer):
+
+    while writer['pending']:
+        writer['pending'].popleft().result()
+
+
+#---------------------------------------------------------------------------------------------------
+# Read files into the page cache, for the inputs of frames read by external programs (apex)
+#---------------------------------------------------------------------------------------------------
+
+def warm_files(filenames):
+
+    buffer = bytearray(WarmBufferSize)
+    for filename in filenames:
+        try:
+            with open(filename, 'rb', buffering=0) as f:
+                while f.readinto(buffer) == WarmBufferSize:
+                    pass
+        except OSError:   #a missing input is reported by the program that reads it
+            pass
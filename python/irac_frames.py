@@ -0,0 +1,436 @@
+#---------------------------------------------------------------------------------------------------
+# Fast reader and writer of the IRAC frame products (bcd, cbcd, cbunc, bimsk, ffcbcd, stbcd, stmsk,
+# sub, sbunc, rmask): single HDU images of 256x256 pixels.  The header is read as raw 80-character
+# cards and only the keywords asked for are parsed, into a dict; the data block is read with one
+# np.fromfile at the end of the header.  The header goes with the data as the bytes of its cards
+# (header['cards']), so that the outputs are written from the header of their input with a few
+# keywords changed, without building an astropy Header; images without an input header (the
+# backgrounds) get a header template cached by type and shape.  Files not of this simple layout
+# (scaled integers, extensions other than images) are read with astropy.  The frames written as one
+# multi-extension file (a primary image and image extensions, as the SCI, UNC and MASK of a frame)
+# are read and written whole, as a list of (data, header) by read_frames / write_frames.  Tile-
+# compressed files (an empty primary, the images in compressed extensions) are read with astropy,
+# and written by compressed_blocks.
+#
+#   data, header = read_frame(filename, ['FRAMEDLY'])    # header['FRAMEDLY'], header['cards']
+#   write_frame(outfile, data, header, {'CRVAL1': ra})  # atomic, as write_fits_atomic
+#---------------------------------------------------------------------------------------------------
+
+import os
+import numpy as np
+
+BlockSize = 2880   # FITS blocks
+CardSize = 80
+
+# numpy type of each BITPIX, and back
+BitpixTypes = {8: np.dtype('u1'), 16: np.dtype('>i2'), 32: np.dtype('>i4'), 64: np.dtype('>i8'),
+               -32: np.dtype('>f4'), -64: np.dtype('>f8')}
+TypeBitpix = dict((dtype.newbyteorder('='), bitpix) for bitpix, dtype in BitpixTypes.items())
+
+LayoutKeywords = ['SIMPLE', 'XTENSION', 'BITPIX', 'NAXIS', 'NAXIS1', 'NAXIS2', 'PCOUNT', 'GCOUNT', 'BSCALE', 'BZERO']
+#and where a tile-compressed image has them
+CompressedKeywords = {'SIMPLE': 'ZSIMPLE', 'XTENSION': 'ZTENSION', 'BITPIX': 'ZBITPIX', 'NAXIS': 'ZNAXIS',
+                      'NAXIS1': 'ZNAXIS1', 'NAXIS2': 'ZNAXIS2', 'PCOUNT': 'ZPCOUNT', 'GCOUNT': 'ZGCOUNT'}
+
+HeaderTemplates = dict()   #cards of the minimal header of each (BITPIX, shape)
+
+
+#---------------------------------------------------------------------------------------------------
+# Cards of a header: split the bytes up to the END card; position of a keyword among them
+#---------------------------------------------------------------------------------------------------
+
+def split_cards(raw):
+
+    cards = list()
+    for start in range(0, len(raw), CardSize):
+        card = raw[start:start+CardSize]
+        if card[:8] == b'END     ':
+            return(b''.join(cards), True)
+        cards.append(card)
+    return(b''.join(cards), False)
+
+
+def find_card(cards, keyword):
+
+    key = keyword.upper().ljust(8).encode()
+    for start in range(0, len(cards), CardSize):
+        if cards[start:start+8] == key:
+            return(start)
+    return(None)
+
+
+#---------------------------------------------------------------------------------------------------
+# Value of a card: string, logical, integer or float; None for a card without value
+#---------------------------------------------------------------------------------------------------
+
+def card_value(card):
+
+    if card[8:10] != b'= ':
+        return(None)
+    field = card[10:].decode('ascii', errors='replace').strip()
+    if field.startswith("'"):
+        end = 1
+        while True:
+            end = field.find("'", end)
+            if (end < 0) or (field[end+1:end+2] != "'"):
+                break
+            end += 2
+        return(field[1:end].replace("''", "'").rstrip())
+    field = field.split('/')[0].strip()
+    if field in ('T', 'F'):
+        return(field == 'T')
+    try:
+        return(int(field))
+    except ValueError:
+        pass
+    try:
+        return(float(field.replace('D', 'E')))
+    except ValueError:
+        return(None)
+
+
+def header_values(cards, keywords):
+
+    values = dict()
+    for keyword in keywords:
+        position = find_card(cards, keyword)
+        if position is not None:
+            values[keyword] = card_value(cards[position:position+CardSize])
+    return(values)
+
+
+#---------------------------------------------------------------------------------------------------
+# Read the header of a frame: the dict of the keywords asked for, with its cards under 'cards'.
+# read_cards leaves the file at the start of the data.  In a tile-compressed file the layout of the
+# image is in the Z keywords of the table that holds it (ZBITPIX, ZNAXIS1, ...)
+#---------------------------------------------------------------------------------------------------
+
+def read_frame_header(filename, keywords=()):
+
+    with open(filename, 'rb') as f:
+        header = read_cards(f)
+        if header_values(header['cards'], ['NAXIS']).get('NAXIS') == 0:   #empty primary of a compressed file: the image header follows
+            header = read_cards(f)
+    compressed = header_values(header['cards'], ['ZIMAGE']).get('ZIMAGE')
+    names = [CompressedKeywords.get(keyword, keyword) if compressed else keyword for keyword in keywords]
+    values = header_values(header['cards'], names)
+    header.update((keyword, values[name]) for keyword, name in zip(keywords, names) if name in values)
+    return(header)
+
+
+def read_cards(f):
+
+    cards = list()
+    while True:
+        block = f.read(BlockSize)
+        if len(block) < BlockSize:
+            raise IOError("{:}: no END card".format(f.name))
+        blockcards, ended = split_cards(block)
+        cards.append(blockcards)
+        if ended:
+            return({'cards': b''.join(cards)})
+
+
+#---------------------------------------------------------------------------------------------------
+# Read a frame: data and header (the keywords asked for, and the cards).  Images with scaled
+# integers or tile-compressed go through astropy, from the file or its bytes (a file object)
+#---------------------------------------------------------------------------------------------------
+
+def read_frame(filename, keywords=()):
+
+    with open(filename, 'rb') as f:
+        header = read_cards(f)
+        layout = header_values(header['cards'], LayoutKeywords)
+        if simple_layout(layout):
+            shape = (layout['NAXIS2'], layout['NAXIS1'])
+            data = np.fromfile(f, dtype=BitpixTypes[layout['BITPIX']], count=shape[0]*shape[1]).reshape(shape)
+        else:
+            data = None
+    if data is None:
+        return(read_frame_astropy(filename, keywords))
+    header.update(header_values(header['cards'], keywords))
+    return(data, header)
+
+
+def simple_layout(layout):
+
+    return(((layout.get('SIMPLE') is True) or (layout.get('XTENSION') == 'IMAGE')) and (layout.get('NAXIS') == 2) and
+           (layout.get('BITPIX') in BitpixTypes) and (layout.get('PCOUNT', 0) == 0) and (layout.get('GCOUNT', 1) == 1) and
+           (layout.get('BSCALE', 1) == 1) and (layout.get('BZERO', 0) == 0))
+
+
+def read_frame_astropy(filename, keywords):
+
+    from astropy.io import fits
+
+    with fits.open(filename) as HDUlist:
+        HDU = next((HDU for HDU in HDUlist if HDU.data is not None), HDUlist[0])   #the image of a compressed file is in an extension
+        data = np.array(HDU.data)
+        cards = split_cards(HDU.header.tostring().encode('ascii'))[0]
+    header = {'cards': cards}
+    header.update(header_values(cards, keywords))
+    return(data, header)
+
+
+#---------------------------------------------------------------------------------------------------
+# A card with a new value, keeping the comment of the old one
+#---------------------------------------------------------------------------------------------------
+
+def format_value(value):
+
+    if isinstance(value, np.ndarray) and (value.size == 1):   #e.g. an offset from a one-row table selection
+        value = value.item()
+    if isinstance(value, (bool, np.bool_)):
+        return('{:>20}'.format('T' if value else 'F'))
+    if isinstance(value, (int, np.integer)):
+        return('{:>20d}'.format(int(value)))
+    if isinstance(value, (float, np.floating)):
+        text = repr(float(value)).upper()
+        if len(text) > 20:
+            text = '{:.16G}'.format(float(value))
+        if ('.' not in text) and ('E' not in text):
+            text += '.'
+        return('{:>20}'.format(text))
+    return('{:20}'.format("'" + str(value).replace("'", "''").ljust(8) + "'"))
+
+
+def make_card(keyword, value, comment=''):
+
+    card = '{:8}= {:}'.format(keyword.upper(), format_value(value))
+    if comment:
+        card += ' / ' + comment
+    return(card[:CardSize].ljust(CardSize).encode('ascii'))
+
+
+def set_card(cards, keyword, value):
+
+    position = find_card(cards, keyword)
+    if position is None:
+        return(cards + make_card(keyword, value))
+    old = cards[position:position+CardSize].decode('ascii', errors='replace')
+    comment = old.split(' / ', 1)[1].strip() if ' / ' in old[10:] else ''
+    return(cards[:position] + make_card(keyword, value, comment) + cards[position+CardSize:])
+
+
+def remove_card(cards, keyword):
+
+    position = find_card(cards, keyword)
+    if position is None:
+        return(cards)
+    return(cards[:position] + cards[position+CardSize:])
+
+
+#---------------------------------------------------------------------------------------------------
+# Minimal header of an image without input header, as astropy's PrimaryHDU writes it; cached
+#---------------------------------------------------------------------------------------------------
+
+def header_template(bitpix, shape):
+
+    if (bitpix, shape) not in HeaderTemplates:
+        HeaderTemplates[(bitpix, shape)] = (make_card('SIMPLE', True, 'conforms to FITS standard') +
+                                            make_card('BITPIX', bitpix, 'array data type') +
+                                            make_card('NAXIS', 2, 'number of array dimensions') +
+                                            make_card('NAXIS1', shape[1]) + make_card('NAXIS2', shape[0]) +
+                                            make_card('EXTEND', True))
+    return(HeaderTemplates[(bitpix, shape)])
+
+
+#---------------------------------------------------------------------------------------------------
+# Write a frame: the data with the header of its input (or the template), its BITPIX and size set
+# from the data and the updates applied; through a temporary file renamed in place, so that an
+# interrupted job leaves the previous product or none
+#---------------------------------------------------------------------------------------------------
+
+def write_frame(filename, data, header=None, updates=None):
+
+    cards, data = frame_blocks(filename, data, header, updates)
+    tmpfile = filename + '.' + str(os.getpid()) + '.tmp'   #per process: a duplicate job may write it too
+    with open(tmpfile, 'wb') as f:
+        f.write(cards)
+        data.tofile(f)
+        f.write(b'\0' * (-data.nbytes % BlockSize))
+    os.replace(tmpfile, filename)
+
+
+#---------------------------------------------------------------------------------------------------
+# The header blocks of a frame to write, as a primary HDU or an image extension, and its data in
+# FITS byte order
+#---------------------------------------------------------------------------------------------------
+
+def frame_blocks(filename, data, header=None, updates=None, extension=False):
+
+    data = np.asarray(data)
+    if data.dtype == np.bool_:
+        data = data.astype(np.uint8)
+    elif (data.dtype.kind in 'ui') and (data.dtype.newbyteorder('=') not in TypeBitpix):   #unsigned, read through astropy
+        data = data.astype(np.int32 if data.dtype.itemsize < 4 else np.int64)
+    bitpix = TypeBitpix.get(data.dtype.newbyteorder('='))
+    if (bitpix is None) or (data.ndim != 2):
+        raise ValueError("{:}: cannot write {:}-d data of type {:}".format(filename, data.ndim, data.dtype))
+
+    if header is None:
+        cards = convert_cards(header_template(bitpix, data.shape), extension)
+    else:
+        cards = convert_cards(header['cards'], extension)
+        for keyword, value in (('BITPIX', bitpix), ('NAXIS', 2), ('NAXIS1', data.shape[1]), ('NAXIS2', data.shape[0])):
+            cards = set_card(cards, keyword, value)
+        for keyword in ('BSCALE', 'BZERO'):
+            cards = remove_card(cards, keyword)
+        if bitpix < 0:
+            cards = remove_card(cards, 'BLANK')
+    for keyword, value in (updates or {}).items():
+        cards = set_card(cards, keyword, value)
+
+    cards += b'END'.ljust(CardSize)
+    cards += b' ' * (-len(cards) % BlockSize)
+    return(cards, np.ascontiguousarray(data, dtype=BitpixTypes[bitpix]))
+
+
+#---------------------------------------------------------------------------------------------------
+# The cards of a primary header made those of an image extension, or back: the mandatory keywords
+# of the other kind replaced (BITPIX to NAXIS2 follow the first card in both)
+#---------------------------------------------------------------------------------------------------
+
+def convert_cards(cards, extension):
+
+    if (cards[:8] == b'XTENSION') == extension:
+        return(cards)
+    for keyword in ('SIMPLE', 'XTENSION', 'EXTEND', 'PCOUNT', 'GCOUNT', 'EXTNAME'):
+        cards = remove_card(cards, keyword)
+    if not extension:
+        return(make_card('SIMPLE', True, 'conforms to FITS standard') + cards)
+    return(make_card('XTENSION', 'IMAGE', 'Image extension') + cards[:4*CardSize] +
+           make_card('PCOUNT', 0, 'number of parameters') + make_card('GCOUNT', 1, 'number of groups') + cards[4*CardSize:])
+
+
+#---------------------------------------------------------------------------------------------------
+# A frame from the bytes of its FITS file (simple layout only), as read_frame; the data is a
+# writable view of the buffer.  parse_hdu parses the HDU at a given offset, and returns the offset
+# of the next one
+#---------------------------------------------------------------------------------------------------
+
+def parse_frame(buffer, keywords=(), name='frame'):
+
+    return(parse_hdu(buffer, 0, keywords, name)[:2])
+
+
+def parse_hdu(buffer, offset, keywords=(), name='frame'):
+
+    cards = list()
+    for start in range(offset, len(buffer) - BlockSize + 1, BlockSize):
+        blockcards, ended = split_cards(bytes(buffer[start:start+BlockSize]))
+        cards.append(blockcards)
+        if ended:
+            break
+    else:
+        raise IOError("{:}: no END card".format(name))
+    header = {'cards': b''.join(cards)}
+    layout = header_values(header['cards'], LayoutKeywords)
+    if not simple_layout(layout):
+        raise IOError("{:}: not a simple 2-d image".format(name))
+    shape = (layout['NAXIS2'], layout['NAXIS1'])
+    dtype = BitpixTypes[layout['BITPIX']]
+    data = np.frombuffer(buffer, dtype=dtype, count=shape[0]*shape[1], offset=start+BlockSize).reshape(shape)
+    header.update(header_values(header['cards'], keywords))
+    return(data, header, start + BlockSize + data.nbytes + (-data.nbytes % BlockSize))
+
+
+#---------------------------------------------------------------------------------------------------
+# Read and write all the HDUs of a file, as a list of (data, header): the primary and its image
+# extensions, named by EXTNAME.  The file is read with one read; files not of the simple layout go
+# through astropy, which leaves out the HDUs without image (the primary of a compressed file)
+#---------------------------------------------------------------------------------------------------
+
+def read_frames(filename, keywords=()):
+
+    with open(filename, 'rb') as f:
+        buffer = bytearray(os.fstat(f.fileno()).st_size)
+        f.readinto(buffer)
+    try:
+        return(parse_frames(buffer, keywords, filename))
+    except IOError:
+        return(read_frames_astropy(filename, keywords))
+
+
+def parse_frames(buffer, keywords=(), name='frame'):
+
+    keywords = list(keywords) + ['EXTNAME']
+    frames = list()
+    offset = 0
+    while offset < len(buffer):
+        data, header, offset = parse_hdu(buffer, offset, keywords, name)
+        frames.append((data, header))
+    return(frames)
+
+
+def read_frames_astropy(filename, keywords):
+
+    from astropy.io import fits
+
+    keywords = list(keywords) + ['EXTNAME']
+    frames = list()
+    with fits.open(filename) as HDUlist:
+        for HDU in HDUlist:
+            if HDU.data is None:
+                continue
+            cards = split_cards(HDU.header.tostring().encode('ascii'))[0]
+            header = {'cards': cards}
+            header.update(header_values(cards, keywords))
+            frames.append((np.array(HDU.data), header))
+    return(frames)
+
+
+def write_frames(filename, frames, names, updates=None):
+
+    tmpfile = filename + '.' + str(os.getpid()) + '.tmp'
+    with open(tmpfile, 'wb') as f:
+        f.write(frames_blocks(filename, frames, names, updates))
+    os.replace(tmpfile, filename)
+
+
+#---------------------------------------------------------------------------------------------------
+# The bytes of a multi-extension file: the first frame as primary HDU, the others as image
+# extensions, each named; the updates go to all
+#---------------------------------------------------------------------------------------------------
+
+def frames_blocks(filename, frames, names, updates=None):
+
+    blocks = list()
+    for number, ((data, header), name) in enumerate(zip(frames, names)):
+        hduupdates = dict(updates or {})
+        if number == 0:
+            hduupdates['EXTEND'] = True
+        hduupdates['EXTNAME'] = name
+        cards, data = frame_blocks(filename, data, header, hduupdates, extension=(number > 0))
+        blocks += [cards, data.tobytes(), b'\0' * (-data.nbytes % BlockSize)]
+    return(b''.join(blocks))
+
+
+#---------------------------------------------------------------------------------------------------
+# The bytes of a tile-compressed file: an empty primary and the frames as compressed image
+# extensions, named if names are given.  Each frame has its quantize level: None for an image not
+# compressed, 0 for lossless (RICE for integers, GZIP_2 for floats), else floats quantized by RICE
+# in steps of the noise of each tile over the level
+#---------------------------------------------------------------------------------------------------
+
+def compressed_blocks(filename, frames, names, updates=None, levels=None):
+
+    import io
+    from astropy.io import fits
+
+    HDUs = [fits.PrimaryHDU()]
+    for (data, header), name, level in zip(frames, names, levels or [0] * len(frames)):
+        hduupdates = dict(updates or {})
+        if name is not None:
+            hduupdates['EXTNAME'] = name
+        cards, data = frame_blocks(filename, data, header, hduupdates, extension=True)
+        header = fits.Header.fromstring(cards.decode('ascii'))
+        if level is None:
+            HDUs.append(fits.ImageHDU(data, header))
+        elif (level == 0) and (data.dtype.kind == 'f'):
+            HDUs.append(fits.CompImageHDU(data, header, compression_type='GZIP_2', quantize_level=0))
+        else:
+            HDUs.append(fits.CompImageHDU(data, header, compression_type='RICE_1', quantize_level=level))
+    buffer = io.BytesIO()
+    fits.HDUList(HDUs).writeto(buffer)
+    return(buffer.getvalue())
@@ -0,0 +1,408 @@
+#---------------------------------------------------------------------------------------------------
+# Job executor: run the jobs of a stage in a pool of long-lived worker processes.  The stage loads
+# its data (log, index, job list, catalogs, calibration) once in the parent; the workers are forked
+# from it and inherit that data, so a job is a function call rather than a new python that imports
+# astropy/scipy and reads the tables again.  Results stream back as the jobs finish.  Given the
+# predicted memory of the jobs (see job_memory), a job starts only while the running ones fit the
+# memory budget; smaller jobs fill in around the large ones.
+#
+# Each worker runs in its own process group, so a job that fails or overruns its timeout is
+# isolated: its worker and the external tools it started are killed, a fresh worker takes its place,
+# and the job is retried.  Once no job is left to start, the jobs running much longer than expected
+# get a duplicate on an idle worker; the first copy to finish wins and the other is killed.  The
+# peak memory of each job is measured by its worker, for the memory model of the stage.
+#---------------------------------------------------------------------------------------------------
+
+import os, sys, time, traceback, bisect, signal, resource
+import multiprocessing as mp
+from multiprocessing.connection import wait
+
+JobFunction = None   # the job of the stage, set before the workers are forked
+JobPeaks = dict()    # peak memory (GB) of the jobs that ended, by task, as measured by measure_job
+
+WaitInterval = 10.0     # seconds between looks at the running jobs for stragglers
+SpeculateFactor = 2.0   # a job running this many times its expected time gets a duplicate ...
+MinSpeculate = 60.0     # ... if it has run that many seconds
+
+
+#---------------------------------------------------------------------------------------------------
+# Run one job in a worker; a failing job (exception or sys.exit) is reported, not fatal to the worker.
+# Returns (JobNo, status, elapsed seconds, message, value returned by the job)
+#---------------------------------------------------------------------------------------------------
+
+def call_job(JobNo, *args):
+
+    start = time.time()
+    status, message, value = 'ok', '', None
+    try:
+        value = JobFunction(JobNo, *args)
+    except (Exception, SystemExit) as error:
+        status = 'failed'
+        message = traceback.format_exception_only(type(error), error)[-1].strip()
+    sys.stdout.flush()   #workers exit without flushing
+    return(JobNo, status, time.time()-start, message, value)
+
+
+#---------------------------------------------------------------------------------------------------
+# call_job with the peak memory (GB) of the job: the peak resident memory of the process above what
+# it held before the job (the peak is reset with /proc/self/clear_refs), and the largest of the
+# external tools run by the process.  None where /proc gives no memory
+#---------------------------------------------------------------------------------------------------
+
+def process_memory():
+
+    try:
+        with open('/proc/self/status') as f:
+            fields = dict(line.split(':', 1) for line in f if line.startswith(('VmRSS', 'VmHWM')))
+        return(int(fields['VmRSS'].split()[0]), int(fields['VmHWM'].split()[0]))   #kB
+    except (OSError, KeyError):
+        return(None)
+
+
+def measure_job(JobNo, *args):
+
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+    before = process_memory()
+    result = call_job(JobNo, *args)
+    after = process_memory()
+    if (before is None) or (after is None):
+        return(result, None)
+    tools = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss   #kB
+    return(result, (max(after[1] - before[0], 0) + tools) * 1024 / 1e9)
+
+
+def report_failures(results, label):
+
+    failed = [result for result in results if result[1] not in ('ok', 'skipped')]
+    for (JobNo, status, elapsed, message, value) in failed:
+        print("## ERROR: {:} job {:} {:}: {:}".format(label, JobNo, status, message))
+    Nskipped = sum(1 for result in results if result[1] == 'skipped')
+    if Nskipped > 0:
+        print("## ERROR: {:} {:} jobs skipped after failures".format(Nskipped, label))
+    return(failed)
+
+
+#---------------------------------------------------------------------------------------------------
+# Summary table of the jobs that did not succeed: job, status, seconds and message, with the row of
+# the job list when given.  Removed when all the jobs succeeded
+#---------------------------------------------------------------------------------------------------
+
+def write_failures(results, TableName, JobList=None):
+
+    from astropy.io import ascii
+    from astropy.table import Table
+
+    failed = [result for result in results if result[1] != 'ok']
+    if len(failed) == 0:
+        if os.path.exists(TableName):
+            os.remove(TableName)
+        return
+    summary = Table()
+    if isinstance(failed[0][0], tuple):   #tasks of a graph: (stage, JobNo)
+        summary['Stage'] = [task[0] for (task, status, elapsed, message, value) in failed]
+        summary['JobNo'] = [task[1] for (task, status, elapsed, message, value) in failed]
+    else:
+        summary['JobNo'] = [task for (task, status, elapsed, message, value) in failed]
+    summary['Status']  = [status for (task, status, elapsed, message, value) in failed]
+    summary['Seconds'] = [round(elapsed, 1) for (task, status, elapsed, message, value) in failed]
+    summary['Message'] = [(message.replace('|', '/') or '-') for (task, status, elapsed, message, value) in failed]
+    if JobList is not None:
+        names = JobList.dtype.names if hasattr(JobList, 'dtype') else JobList.colnames
+        for name in names:
+            summary[name] = [JobList[name][JobNo] for JobNo in summary['JobNo']]
+    ascii.write(summary, TableName, format="ipac", overwrite=True)
+    print("## {:} failed jobs listed in {:}".format(len(failed), TableName))
+
+
+#---------------------------------------------------------------------------------------------------
+# Position, among the jobs waiting in the order they should start, of the first one whose predicted
+# memory fits in what is left of the budget; with nothing running the first one, even if too large.
+# None if no job fits
+#---------------------------------------------------------------------------------------------------
+
+def admissible(waiting, memory, used, budget, running):
+
+    for position, job in enumerate(waiting):
+        if (running == 0) or (used + memory[job] <= budget):
+            return(position)
+    return(None)
+
+
+#---------------------------------------------------------------------------------------------------
+# Worker processes: each reads (JobNo, argument) from its pipe and sends back the result of call_job
+# with the peak memory of the job (measure_job), until it reads None or its parent is gone (it closes
+# the parent's end of the pipe, so that it sees the end of the pipe then).  The worker leads its own
+# process group so that killing the group also kills the external tools of its job
+#---------------------------------------------------------------------------------------------------
+
+def worker_main(conn, parent):
+
+    os.setpgid(0, 0)
+    parent.close()
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+        try:
+            conn.send(measure_job(*message))
+        except OSError:
+            break   #the parent died during the job
+    conn.close()
+
+
+def start_worker():
+
+    sys.stdout.flush()   #don't let the worker inherit pending output
+    conn, child = mp.Pipe()
+    process = mp.get_context('fork').Process(target=worker_main, args=(child, conn), daemon=True)
+    process.start()
+    child.close()
+    try:
+        os.setpgid(process.pid, process.pid)   #also from the parent, in case it is killed right away
+    except OSError:
+        pass
+    return({'process': process, 'conn': conn, 'task': None, 'start': 0.0, 'deadline': None})
+
+
+def kill_worker(worker):
+
+    try:
+        os.killpg(worker['process'].pid, signal.SIGKILL)
+    except OSError:
+        worker['process'].kill()
+    worker['process'].join()
+    worker['conn'].close()
+
+
+def stop_workers(workers):
+
+    for worker in workers:
+        if worker['task'] is None:
+            try:
+                worker['conn'].send(None)
+            except OSError:
+                pass
+    for worker in workers:
+        if worker['task'] is None:
+            worker['process'].join(5)
+        if worker['process'].is_alive():
+            kill_worker(worker)
+
+
+#---------------------------------------------------------------------------------------------------
+# Run a graph of tasks with function(task, argument), see run_graph.  By task, all optional: memory
+# (GB), timeouts and expected run times (seconds).  A task that fails or runs out of time is run
+# again up to retries times.  With speculate, once no task is waiting, the task furthest beyond
+# SpeculateFactor times its expected time (or the typical time of the tasks done) gets a duplicate.
+# finished(result), if given, is called in the parent as each try of a task ends.  Returns the
+# results of call_job by task, for the tasks that ran
+#---------------------------------------------------------------------------------------------------
+
+def execute(function, tasks, depends, Nworkers, argument=None, memory=None, budget=None,
+            timeouts=None, expected=None, retries=0, speculate=False, label='job', finished=None):
+
+    global JobFunction
+    JobFunction = function
+
+    priority = dict((task, rank) for rank, task in enumerate(tasks))
+    waiting = dict((task, set(depends.get(task, ()))) for task in tasks)
+    dependents = dict((task, list()) for task in tasks)
+    for task in tasks:
+        for before in waiting[task]:
+            dependents[before].append(task)
+
+    ready = sorted(priority[task] for task in tasks if len(waiting[task]) == 0)
+    need = [(memory.get(task, 0.0) if memory is not None else 0.0) for task in tasks]
+    if budget is None:
+        budget = float('inf')
+    values = dict()
+    results = dict()
+    attempts = dict((task, 0) for task in tasks)
+    durations = list()   #run times of the tasks done, to spot stragglers without expected times
+    running = dict()     #workers running each task (two with a duplicate)
+    duplicated = set()   #tasks given a duplicate in their current attempt
+    used = 0.0
+
+    def skip(task, reason):
+        for after in dependents[task]:
+            if after not in results:
+                results[after] = (after, 'skipped', 0.0, reason, None)
+                skip(after, reason)
+
+    def done(task, result):
+        #a copy of the task ended: keep the result, wait for the other copy, or retry
+        if finished is not None:
+            finished(result)
+        if result[1] == 'ok':
+            results[task] = result
+            values[task] = result[4]
+            durations.append(result[2])
+            for after in dependents[task]:
+                waiting[after].discard(task)
+                if (len(waiting[after]) == 0) and (after not in results):
+                    bisect.insort(ready, priority[after])
+        elif task in running:
+            return
+        elif attempts[task] <= retries:
+            print("## {:} job {:} {:}: {:}; retry {:} of {:}".format(label, task, result[1], result[3], attempts[task], retries))
+            bisect.insort(ready, priority[task])
+        else:
+            results[task] = result
+            skip(task, 'after {:} failed'.format(task))
+
+    #without workers: the tasks one after the other in this process, without timeouts
+    if Nworkers <= 1:
+        while ready:
+            task = tasks[ready.pop(0)]
+            attempts[task] += 1
+            result, JobPeaks[task] = measure_job(task, argument(task, values) if argument is not None else None)
+            done(task, result)
+        return(results)
+
+    workers = [start_worker() for i in range(Nworkers)]
+
+    def launch(task, worker):
+        nonlocal used
+        used += need[priority[task]]
+        worker['task'] = task
+        worker['start'] = time.time()
+        worker['deadline'] = None
+        if (timeouts is not None) and (task in timeouts):
+            worker['deadline'] = worker['start'] + timeouts[task]
+        worker['conn'].send((task, argument(task, values) if argument is not None else None))
+        running.setdefault(task, list()).append(worker)
+
+    def release(worker, kill):
+        #the worker is done with its task; a killed worker is replaced by a fresh one
+        nonlocal used
+        task = worker['task']
+        running[task].remove(worker)
+        if len(running[task]) == 0:
+            del running[task]
+        used -= need[priority[task]]
+        worker['task'] = None
+        if kill:
+            kill_worker(worker)
+            workers[workers.index(worker)] = start_worker()
+
+    def straggler(now):
+        #the running task not yet duplicated furthest beyond its expected time, if any is late
+        typical = sorted(durations)[len(durations)//2] if durations else None
+        late = list()
+        for task, copies in running.items():
+            limit = expected[task] if (expected is not None) and (task in expected) else typical
+            elapsed = now - copies[0]['start']
+            if (task not in duplicated) and (limit is not None) and (elapsed > max(SpeculateFactor * limit, MinSpeculate)) and (used + need[priority[task]] <= budget):
+                late.append((elapsed / max(limit, 1e-3), priority[task]))
+        return(tasks[max(late)[1]] if late else None)
+
+    try:
+        while ready or running:
+            idle = [worker for worker in workers if worker['task'] is None]
+            while ready and idle:
+                position = admissible(ready, need, used, budget, len(running))
+                if position is None:
+                    break
+                task = tasks[ready.pop(position)]
+                attempts[task] += 1
+                duplicated.discard(task)
+                launch(task, idle.pop())
+            if speculate and idle and not ready:
+                task = straggler(time.time())
+                if task is not None:
+                    print("## {:} job {:} is late: start a duplicate".format(label, task))
+                    duplicated.add(task)
+                    launch(task, idle.pop())
+
+            #wait for a result, the next deadline, or the next look for stragglers
+            busy = [worker for worker in workers if worker['task'] is not None]
+            timeout = WaitInterval if speculate else None
+            deadlines = [worker['deadline'] for worker in busy if worker['deadline'] is not None]
+            if deadlines:
+                untilnext = max(0.0, min(deadlines) - time.time())
+                timeout = untilnext if timeout is None else min(timeout, untilnext)
+            ended = wait([worker['conn'] for worker in busy], timeout)
+
+            now = time.time()
+            for worker in busy:
+                task = worker['task']
+                if task is None:
+                    continue   #killed above, as the other copy of a task done
+                if worker['conn'] in ended:
+                    try:
+                        result, JobPeaks[task] = worker['conn'].recv()
+                        release(worker, False)
+                    except (EOFError, OSError):
+                        worker['process'].join(5)   #its exit code is known once it is reaped
+                        result = (task, 'failed', now - worker['start'], 'worker died (exit code {:})'.format(worker['process'].exitcode), None)
+                        release(worker, True)
+                elif (worker['deadline'] is not None) and (now >= worker['deadline']):
+                    result = (task, 'timeout', now - worker['start'], 'no result after {:.0f} s'.format(now - worker['start']), None)
+                    release(worker, True)
+                else:
+                    continue
+                if (result[1] == 'ok') and (task in running):
+                    for other in list(running[task]):   #the other copy lost
+                        release(other, True)
+                done(task, result)
+    finally:
+        stop_workers(workers)
+    return(results)
+
+
+#---------------------------------------------------------------------------------------------------
+# Run jobs 0..Njobs-1 of a stage, or those of order, with function(JobNo) on Nworkers processes,
+# started in the given order (default: job order).  By job: memory (GB, within budget), timeouts and expected run times;
+# retries, speculative duplicates and finished as in execute.  Returns the results of call_job in job order
+#---------------------------------------------------------------------------------------------------
+
+def run_jobs(function, Njobs, Nworkers, label='job', order=None, memory=None, budget=None,
+             timeouts=None, expected=None, retries=0, speculate=False, finished=None):
+
+    if order is None:
+        order = range(0,Njobs)
+    order = [int(JobNo) for JobNo in order]
+    def byjob(array):
+        return(dict((JobNo, float(array[JobNo])) for JobNo in order) if array is not None else None)
+
+    start = time.time()
+    results = execute(lambda JobNo, argument: function(JobNo), order, dict(), min(Nworkers, len(order)),
+                      memory=byjob(memory), budget=budget, timeouts=byjob(timeouts), expected=byjob(expected),
+                      retries=retries, speculate=speculate, label=label, finished=finished)
+    results = [results[JobNo] for JobNo in range(0,Njobs) if JobNo in results]
+
+    failed = [result for result in results if result[1] != 'ok']
+    print("## {:} {:} jobs done in {:.1f} s with {:} workers; {:} failed".format(len(order), label, time.time()-start, Nworkers, len(failed)))
+    report_failures(results, label)
+    return(results)
+
+
+#---------------------------------------------------------------------------------------------------
+# Run a graph of tasks with function(task, argument) on Nworkers processes.  A task starts once all
+# the tasks it depends on (depends[task]) succeeded; among the tasks ready, the one first in the
+# list of tasks goes first, among those that fit the memory budget when memory (GB by task) is given.
+# argument(task, values), if given, is called in the parent when the task is started, with the values
+# returned by the tasks done so far.  The tasks after a failed one are skipped.  Timeouts, expected
+# run times, retries, duplicates and finished as in execute.  Returns the results of call_job, one per task,
+# in the order of the list
+#---------------------------------------------------------------------------------------------------
+
+def run_graph(function, tasks, depends, Nworkers, argument=None, label='graph', memory=None, budget=None,
+              timeouts=None, expected=None, retries=0, speculate=False, finished=None):
+
+    start = time.time()
+    results = execute(function, tasks, depends, Nworkers, argument=argument, memory=memory, budget=budget,
+                      timeouts=timeouts, expected=expected, retries=retries, speculate=speculate, label=label,
+                      finished=finished)
+    results = [results.get(task, (task, 'skipped', 0.0, 'dependency cycle', None)) for task in tasks]
+    failed = [result for result in results if result[1] != 'ok']
+    print("## {:} {:} jobs done in {:.1f} s with {:} workers; {:} failed or skipped".format(len(tasks), label, time.time()-start, Nworkers, len(failed)))
+    report_failures(results, label)
+    return(results)
@@ -0,0 +1,97 @@
+#---------------------------------------------------------------------------------------------------
+# Job memory model: the peak memory of a job predicted from its stage, number of frames and number
+# of repeats (make_medians), or from the peaks measured for the jobs of its stage that ran before
+# (the others), and the memory budget of the jobs running together on a node.  The executor starts a
+# job only while the predicted memory of the running jobs fits the budget, filling in with smaller
+# jobs around the large ones, so the number of workers can be raised without the node swapping.
+#---------------------------------------------------------------------------------------------------
+
+import os
+import numpy as np
+
+from supermopex import *
+
+FramePixels = 256*256
+
+# make_medians holds, for all the frames of the AOR.chan, the data as a masked array (8+1 bytes per
+# pixel), the inverse variances (8) and the masks (8); the same again when the frames are
+# reorganised by repeat, and the temporary arrays of the clipping of the frames of one repeat
+MedianCubeBytes = 8 + 1 + 8 + 8
+MedianClipBytes = 32
+
+# per job: the worker itself (the stage data is shared with the parent), and for the stages that
+# treat one frame at a time, a few frames of images and tables, until their jobs were measured
+WorkerGB = 0.3
+StageGB = {'ffcorr': 0.2, 'find_stars': 0.5, 'check_stars': 0.5, 'subtract_stars': 0.5,
+           'subtract_medians': 0.3, 'fix_astrometry': 0.5, 'merge_stars': 1.0, 'find_outliers': 2.0}
+
+
+#---------------------------------------------------------------------------------------------------
+# Fit GB = a + b*NumFrames over the peaks measured, raised so that none of them is above it: the
+# slope of the peaks, and no slope for a single size of job
+#---------------------------------------------------------------------------------------------------
+
+def fit_memory_model(nframes, GB):
+
+    nframes, GB = np.asarray(nframes, dtype=np.double), np.asarray(GB, dtype=np.double)
+    b = 0.0
+    if len(set(nframes.tolist())) > 1:
+        A = np.column_stack([np.ones(len(nframes)), nframes])
+        b = max(np.linalg.lstsq(A, GB, rcond=None)[0][1], 0.0)
+    return((np.max(GB - b*nframes), b))
+
+
+#---------------------------------------------------------------------------------------------------
+# Peak memory (GB) of each job of a job list from the peaks measured for the jobs of the stage
+# recorded in TimingDB (above what their worker held before); None if none was measured
+#---------------------------------------------------------------------------------------------------
+
+def measured_memory(stage, JobList):
+
+    if not os.path.exists(TimingDB):
+        return(None)
+    from job_timing import open_timings, job_features, MaxTimings   #job_timing imports this module
+    db = open_timings()
+    rows = db.execute("SELECT nframes, gb FROM timings WHERE stage = ? AND gb IS NOT NULL ORDER BY rowid DESC LIMIT ?",
+                      [stage, MaxTimings]).fetchall()
+    db.close()
+    if len(rows) == 0:
+        return(None)
+    a, b = fit_memory_model([nframes for (nframes, GB) in rows], [GB for (nframes, GB) in rows])
+    channel, hdr, nframes = job_features(JobList)
+    return(WorkerGB + a + b*nframes)
+
+
+#---------------------------------------------------------------------------------------------------
+# Predicted peak memory (GB) of each job of a job list: the model of make_medians, the peaks measured
+# for the other stages, or StageGB for a stage never measured
+#---------------------------------------------------------------------------------------------------
+
+def predict_memory(stage, JobList):
+
+    Njobs = len(JobList)
+    names = JobList.dtype.names if hasattr(JobList, 'dtype') else JobList.colnames
+    if stage != 'make_medians':
+        measured = measured_memory(stage, JobList)
+        if measured is not None:
+            return(measured)
+        return(np.full(Njobs, WorkerGB + StageGB.get(stage, 0.5)))
+
+    nframes = np.asarray(JobList['NumFrames'], dtype=np.double)
+    if 'Nreps' in names:
+        nreps = np.maximum(np.asarray(JobList['Nreps'], dtype=np.double), 1)
+    else:
+        nreps = np.full(Njobs, 2.0)   #unknown: count the reorganised copy
+    cubes = np.where(nreps > 1, 2, 1) * MedianCubeBytes * nframes + MedianClipBytes * nframes / nreps
+    return(WorkerGB + cubes * FramePixels / 1e9)
+
+
+#---------------------------------------------------------------------------------------------------
+# Memory (GB) the jobs of a node may use together: MemoryBudget, or MemoryFraction of the node memory
+#---------------------------------------------------------------------------------------------------
+
+def memory_budget():
+
+    if MemoryBudget > 0:
+        return(MemoryBudget)
+    return(MemoryFraction * os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1e9)
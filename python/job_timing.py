@@ -0,0 +1,328 @@
+#---------------------------------------------------------------------------------------------------
+# Job timing database: the wall time and peak memory of every job run, with its stage, channel, HDR
+# mode and number of frames, in an SQLite table next to the frame log.  A linear model (seconds = a + b*NumFrames)
+# per stage, channel and HDR mode, fitted on the past runs, predicts the time of new jobs so that
+# they can be started longest first (LPT): then the stage ends close to total work / workers
+# instead of waiting on a large job started last.  The predictions also give the timeouts of the
+# jobs, and the expected times against which the stragglers are spotted.  With TaskQueue the jobs
+# go, in the same order, through a queue that workers of other nodes can join (see task_queue).
+#
+# The number of workers of a stage is tuned on the first run of the stage on a type of node (cores
+# and memory): the first jobs are run with 1, 2, 4, ... workers, and the fewest workers that give
+# nearly the best throughput (frames per second), the knee of the curve, are kept in the database
+# and used from then on.  I/O bound stages stop gaining early, CPU bound ones use the whole node.
+#---------------------------------------------------------------------------------------------------
+
+import os, time
+import sqlite3
+import numpy as np
+
+from supermopex import *
+import job_executor
+from job_executor import run_jobs, write_failures
+from job_memory import predict_memory, memory_budget
+from task_queue import run_queue
+from product_manifest import merge_local_manifest
+
+TimingSchema = """
+CREATE TABLE IF NOT EXISTS timings (
+    stage   TEXT    NOT NULL,
+    channel INTEGER NOT NULL,
+    hdr     TEXT    NOT NULL,
+    nframes INTEGER NOT NULL,
+    seconds REAL    NOT NULL,
+    node    TEXT    NOT NULL,
+    gb      REAL
+);
+CREATE INDEX IF NOT EXISTS timings_stage ON timings (stage, channel, hdr);
+CREATE TABLE IF NOT EXISTS throughput (
+    stage    TEXT    NOT NULL,
+    nodetype TEXT    NOT NULL,
+    workers  INTEGER NOT NULL,
+    fps      REAL    NOT NULL,
+    node     TEXT    NOT NULL
+);
+CREATE TABLE IF NOT EXISTS workers (
+    stage    TEXT    NOT NULL,
+    nodetype TEXT    NOT NULL,
+    workers  INTEGER NOT NULL,
+    PRIMARY KEY (stage, nodetype)
+);
+"""
+
+MaxTimings = 5000   # fit on at most this many recent jobs of a stage
+
+TuneJobsPerWorker = 2   # jobs run per worker at each number of workers tried
+KneeTolerance = 0.1     # keep the fewest workers within this fraction of the best throughput
+
+
+#---------------------------------------------------------------------------------------------------
+# Open the database, creating it if needed
+#---------------------------------------------------------------------------------------------------
+
+def open_timings():
+
+    db = sqlite3.connect(TimingDB, timeout=600)
+    db.executescript(TimingSchema)
+    columns = [row[1] for row in db.execute("PRAGMA table_info(timings)")]
+    if 'gb' not in columns:   #database written before the peak memory
+        with db:
+            db.execute("ALTER TABLE timings ADD COLUMN gb REAL")
+    return(db)
+
+
+#---------------------------------------------------------------------------------------------------
+# Channel, HDR mode and number of frames of each job of a job list; the lists of exposures and
+# tiles lack some of the columns
+#---------------------------------------------------------------------------------------------------
+
+def job_features(JobList):
+
+    Njobs = len(JobList)
+    names = JobList.dtype.names if hasattr(JobList, 'dtype') else JobList.colnames
+    if 'Channel' in names:
+        channel = np.asarray(JobList['Channel'], dtype=np.int64)
+    elif 'ChannelMax' in names:
+        channel = np.asarray(JobList['ChannelMax'], dtype=np.int64)
+    else:
+        channel = np.zeros(Njobs, dtype=np.int64)
+    if 'HDR' in names:
+        hdr = np.array([str(value) for value in JobList['HDR']])
+    else:
+        hdr = np.array(['False']*Njobs)
+    if 'NumFrames' in names:
+        nframes = np.asarray(JobList['NumFrames'], dtype=np.int64)
+    else:
+        nframes = np.ones(Njobs, dtype=np.int64)
+    return(channel, hdr, nframes)
+
+
+#---------------------------------------------------------------------------------------------------
+# Record the wall time and peak memory of jobs: rows are (channel, HDR, NumFrames, seconds, GB), GB
+# None where it was not measured
+#---------------------------------------------------------------------------------------------------
+
+def record_timings(stage, rows):
+
+    if len(rows) == 0:
+        return
+    node = os.uname().nodename.split('.')[0]
+    db = open_timings()
+    with db:
+        db.executemany("INSERT INTO timings VALUES (?,?,?,?,?,?,?)",
+                       [(stage, int(Ch), str(HDR), int(Nframes), float(seconds), node, (float(GB) if GB is not None else None))
+                        for (Ch, HDR, Nframes, seconds, GB) in rows])
+    db.close()
+
+
+#---------------------------------------------------------------------------------------------------
+# Fit seconds = a + b*NumFrames; with a single size of job, the time per frame
+#---------------------------------------------------------------------------------------------------
+
+def fit_time_model(nframes, seconds):
+
+    nframes, seconds = np.asarray(nframes, dtype=np.double), np.asarray(seconds, dtype=np.double)
+    if len(set(nframes.tolist())) < 2:
+        return((0.0, np.sum(seconds) / max(np.sum(nframes), 1.0)))
+    A = np.column_stack([np.ones(len(nframes)), nframes])
+    (a, b), residuals, rank, sv = np.linalg.lstsq(A, seconds, rcond=None)
+    if b <= 0:   #no trend: fall back to the time per frame
+        return((0.0, np.sum(seconds) / max(np.sum(nframes), 1.0)))
+    return((max(a, 0.0), b))
+
+
+#---------------------------------------------------------------------------------------------------
+# Predicted wall time of each job of a job list, from the model of its stage, channel and HDR mode,
+# or of the whole stage if that combination was never run.  Without any timing the number of
+# frames is used, which gives the same order
+#---------------------------------------------------------------------------------------------------
+
+def predict_times(stage, JobList):
+
+    channel, hdr, nframes = job_features(JobList)
+    predicted = nframes.astype(np.double)
+    if not os.path.exists(TimingDB):
+        return(predicted)
+
+    db = open_timings()
+    rows = db.execute("SELECT channel, hdr, nframes, seconds FROM timings WHERE stage = ? ORDER BY rowid DESC LIMIT ?",
+                      [stage, MaxTimings]).fetchall()
+    db.close()
+    if len(rows) == 0:
+        return(predicted)
+
+    past = np.array(rows, dtype=[('channel',np.int64), ('hdr','U8'), ('nframes',np.int64), ('seconds',np.double)])
+    stagemodel = fit_time_model(past['nframes'], past['seconds'])
+    models = dict()
+    for key in set(zip(channel.tolist(), hdr.tolist())):
+        sel = (past['channel'] == key[0]) & (past['hdr'] == key[1])
+        models[key] = fit_time_model(past['nframes'][sel], past['seconds'][sel]) if np.any(sel) else stagemodel
+
+    for JobNo in range(len(predicted)):
+        a, b = models[(channel[JobNo], hdr[JobNo])]
+        predicted[JobNo] = a + b*nframes[JobNo]
+    return(predicted)
+
+
+#---------------------------------------------------------------------------------------------------
+# True if jobs of the stage were timed before, so that predict_times gives seconds
+#---------------------------------------------------------------------------------------------------
+
+def timed_stage(stage):
+
+    if not os.path.exists(TimingDB):
+        return(False)
+    db = open_timings()
+    (count,) = db.execute("SELECT COUNT(*) FROM timings WHERE stage = ?", [stage]).fetchone()
+    db.close()
+    return(count > 0)
+
+
+#---------------------------------------------------------------------------------------------------
+# Timeouts of the jobs: JobTimeoutFactor times their predicted time, at least MinJobTimeout; None
+# (no timeout) for a stage never timed
+#---------------------------------------------------------------------------------------------------
+
+def predict_timeouts(stage, JobList, predicted=None):
+
+    if not timed_stage(stage):
+        return(None)
+    if predicted is None:
+        predicted = predict_times(stage, JobList)
+    return(np.maximum(JobTimeoutFactor * predicted, MinJobTimeout))
+
+
+#---------------------------------------------------------------------------------------------------
+# Type of this node, as cores and memory (GB): the tuned numbers of workers hold for all such nodes
+#---------------------------------------------------------------------------------------------------
+
+def node_type():
+
+    return("{:d}c{:.0f}g".format(os.cpu_count(), os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 2**30))
+
+
+#---------------------------------------------------------------------------------------------------
+# Number of workers tuned for a stage on this (or the given) type of node, None if not tuned yet
+#---------------------------------------------------------------------------------------------------
+
+def tuned_workers(stage, nodetype=None):
+
+    if not os.path.exists(TimingDB):
+        return(None)
+    db = open_timings()
+    row = db.execute("SELECT workers FROM workers WHERE stage = ? AND nodetype = ?", [stage, nodetype or node_type()]).fetchone()
+    db.close()
+    return(row[0] if row is not None else None)
+
+
+#---------------------------------------------------------------------------------------------------
+# The knee of a throughput curve: the fewest workers within KneeTolerance of the best throughput
+#---------------------------------------------------------------------------------------------------
+
+def throughput_knee(levels, fps):
+
+    best = max(fps)
+    return(min(Nworkers for Nworkers, value in zip(levels, fps) if value >= (1 - KneeTolerance) * best))
+
+
+def record_tuning(stage, levels, fps, Nworkers):
+
+    node = os.uname().nodename.split('.')[0]
+    db = open_timings()
+    with db:
+        db.executemany("INSERT INTO throughput VALUES (?,?,?,?,?)",
+                       [(stage, node_type(), int(level), float(value), node) for level, value in zip(levels, fps)])
+        db.execute("INSERT OR REPLACE INTO workers VALUES (?,?,?)", [stage, node_type(), int(Nworkers)])
+    db.close()
+
+
+#---------------------------------------------------------------------------------------------------
+# Cores allocated to this job: the ppn of the PBS job, else those this process may run on
+#---------------------------------------------------------------------------------------------------
+
+def allocated_cores():
+
+    for name in ['PBS_NUM_PPN', 'PBS_NP']:
+        if os.environ.get(name, '').isdigit():
+            return(int(os.environ[name]))
+    return(len(os.sched_getaffinity(0)))
+
+
+#---------------------------------------------------------------------------------------------------
+# Tune the number of workers of a stage on its first jobs: run TuneJobsPerWorker jobs per worker
+# with 1, 2, 4, ... up to MaxWorkers workers, until the throughput stops growing or the jobs run out.
+# The knee is recorded if at least two numbers of workers were tried.  Returns the number of
+# workers, the results of the jobs run and the jobs left
+#---------------------------------------------------------------------------------------------------
+
+def tune_workers(run, stage, JobList, order, MaxWorkers):
+
+    channel, hdr, nframes = job_features(JobList)
+    levels, fps, results = list(), list(), list()
+    Nworkers = 1
+    while True:
+        sample, order = order[:TuneJobsPerWorker*Nworkers], order[TuneJobsPerWorker*Nworkers:]
+        start = time.time()
+        done = run(sample, Nworkers)
+        results += done
+        levels.append(Nworkers)
+        fps.append(sum(nframes[JobNo] for (JobNo, status, elapsed, message, value) in done if status == 'ok') / max(time.time()-start, 1e-3))
+        print("## {:} with {:} workers: {:.2f} frames/s".format(stage, Nworkers, fps[-1]))
+        if (len(order) == 0) or (Nworkers >= MaxWorkers) or ((len(fps) > 1) and (fps[-1] < (1 + KneeTolerance) * fps[-2])):
+            break
+        Nworkers = min(2*Nworkers, MaxWorkers)
+
+    if len(levels) < 2:
+        return(MaxWorkers, results, order)
+    Nworkers = throughput_knee(levels, fps)
+    record_tuning(stage, levels, fps, Nworkers)
+    print("## {:} tuned to {:} workers on {:} nodes".format(stage, Nworkers, node_type()))
+    return(Nworkers, results, order)
+
+
+#---------------------------------------------------------------------------------------------------
+# Run the jobs of a stage longest predicted first, within the memory budget, with timeouts, retries
+# and duplicates of the stragglers (unless speculate is off, for stages whose copies of a job would
+# share files), record their times and peak memory and list the failed jobs in jobs.<stage>.failed.tbl.  With
+# TaskQueue, through the queue of the stage instead (retries and timeouts, but no memory budget).
+# With AutoTuneWorkers, the number tuned for the stage on this type of node (tuned on the first jobs
+# if it was not yet) is used when it is below Nworkers and the cores allocated.  The products the jobs recorded on this node go to the
+# shared manifest as each job ends (and those left by a stage that died here, at the start)
+#---------------------------------------------------------------------------------------------------
+
+def run_timed_jobs(function, JobList, Nworkers, stage, speculate=True):
+
+    merge_local_manifest()
+    job_executor.JobPeaks.clear()
+    predicted = predict_times(stage, JobList)
+    order = np.argsort(-predicted, kind='stable').tolist()
+    timeouts = predict_timeouts(stage, JobList, predicted)
+    if TaskQueue:
+        results = run_queue(function, len(JobList), Nworkers, stage, order=order, timeouts=timeouts)
+    else:
+        memory = predict_memory(stage, JobList)
+        budget = memory_budget()
+        def run(jobs, Nworkers):
+            return(run_jobs(function, len(JobList), Nworkers, stage, order=jobs, memory=memory, budget=budget,
+                            timeouts=timeouts, expected=(predicted if timeouts is not None else None),
+                            retries=JobRetries, speculate=speculate, finished=lambda result: merge_local_manifest()))
+
+        results = list()
+        if AutoTuneWorkers:
+            MaxWorkers = min(Nworkers, allocated_cores())
+            tuned = tuned_workers(stage)
+            if tuned is not None:
+                Nworkers = min(tuned, MaxWorkers)
+                print("## {:} with {:} workers, as tuned on {:} nodes ({:} workers) and allowed here ({:})".format(stage, Nworkers, node_type(), tuned, MaxWorkers))
+            else:
+                Nworkers, results, order = tune_workers(run, stage, JobList, order, MaxWorkers)
+        if len(order) > 0:
+            print("## {:} jobs of {:} with {:} workers".format(len(order), stage, Nworkers))
+            results = sorted(results + run(order, Nworkers))
+
+    channel, hdr, nframes = job_features(JobList)
+    record_timings(stage, [(channel[JobNo], hdr[JobNo], nframes[JobNo], elapsed, job_executor.JobPeaks.get(JobNo))
+                           for (JobNo, status, elapsed, message, value) in results if status == 'ok'])
+    write_failures(results, OutputDIR + 'jobs.' + stage + '.failed.tbl', JobList)
+    merge_local_manifest()
+    return(results)
@@ -9,18 +9,16 @@ import multiprocessing as mp
 
 #Read the log file
 #rawlog = ascii.read(LogFile,format="commented_header",header_start=-1)
-rawlog = ascii.read(LogTable,format="ipac")
-#get just IRAC info
-log = rawlog[:][(rawlog['Instrument']=='IRAC').nonzero()]
+log = read_log()
 
 #Get the size of the array
 Nrows = log['Filename'].size
 
 #read in the AOR properties log
-AORlog = ascii.read(AORinfoTable,format="ipac")
+AORlog = read_table(AORinfoTable)
 
 #genreate a joblist for parallelization
-JobList = make_joblist(log,AORlog)
+JobList = make_joblist(log, AORlog, index=read_group_index(['AORChannel']))
 Njobs = len(JobList)
 
 print(JobList)
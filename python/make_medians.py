@@ -5,33 +5,30 @@ from astropy.io import ascii
 from supermopex import *
 from spitzer_pipeline_functions import *
 import sys,os
-import multiprocessing as mp
-
-def run_makemedians(JobNo):
-    cmd = "cd " + RootDIR + "; " + pythonCMD + " make_medians_function.py " + str(JobNo)
-    os.system(cmd)
+from job_timing import run_timed_jobs
+import make_medians_function
 
 # Read the log file andget just IRAC info
-rawlog = ascii.read(LogTable,format="ipac")
-log = rawlog[:][(rawlog['Instrument']=='IRAC').nonzero()]
+log = read_log()
 
 #Get the size of the array
 Nrows = log['Filename'].size
 
 #read in the AOR properties log
-AORlog = ascii.read(AORinfoTable,format="ipac")
+AORlog = read_table(AORinfoTable)
 
 #genreate a joblist for parallelization
-JobList = make_joblist(log,AORlog)
+index = read_group_index(['AORChannel'])
+JobList = add_median_repeats(make_joblist(log, AORlog, index=index), log, index)
 JobListName = OutputDIR + 'jobs.medians.tbl'
-ascii.write(JobList, JobListName, format="ipac", overwrite=True)
+write_table(JobList, JobListName)
 Njobs = len(JobList)
 
 # Nthred from supermopex
-print("- Launch make_medians_function for {:} jobs with {:} threads.".format(Njobs, Nthred))
+print("- Launch make_medians_function for {:} jobs with up to {:} threads.".format(Njobs, Nthred))
 
-pool = mp.Pool(processes=Nthred)
-results = pool.map(run_makemedians, range(0,Njobs))
+make_medians_function.load_stage_data()
+results = run_timed_jobs(make_medians_function.run_job, JobList, Nthred, 'make_medians')
 
 print("- Done!")
 
@@ -12,47 +12,67 @@ from astropy.table import Table, Column, MaskedColumn
 import sys
 from optparse import OptionParser
 
-#parse the arguments
-usagestring ='%prog Job_Number'
-parser = OptionParser()
-parser = OptionParser(usage=usagestring)
-(options, args) = parser.parse_args()
+debug = 0   # set by the command line
 
-#fail if there aren't enough arguments
-if len(args) < 1:
-    parser.error("Incorrect number of arguments.")
+#---------------------------------------------------------------------------------------------------
+# Load what all the jobs share: the log and its index, the AOR table and the job list written by
+# make_medians.py
+#---------------------------------------------------------------------------------------------------
 
-#read job number
-JobNo=int(args[0])
+def load_stage_data():
 
-# check if debug mode
-if len(args) > 1:
-    debug = 1
-else:
-    debug = 0
+    global log, index, AORlog, JobList
 
-# Read in the log file and extract the IRAC info
-rawlog = ascii.read(LogTable,format="ipac")
-log = rawlog[:][(rawlog['Instrument']=='IRAC').nonzero()]
+    # Read in the log file and extract the IRAC info
+    log = read_log()
+    index = read_group_index(['AORChannel'])
 
-#Get the size of the array
-Nrows = log['Filename'].size
+    #read in the AOR properties log
+    AORlog = read_table(AORinfoTable)
 
-#read in the AOR properties log
-AORlog = ascii.read(AORinfoTable,format="ipac")
+    #read the joblist written by make_medians.py
+    JobListName = OutputDIR + 'jobs.medians.tbl'
+    JobList = read_table(JobListName)
 
-#genreate a joblist for parallelization
-JobList = make_joblist(log,AORlog)
-#JobListName = OutputDIR + 'jobs.medians.tbl'
-#JobList = ascii.read(JobListName, format="ipac")
-Njobs = len(JobList)
+    #make output directory
+    cmd = 'mkdir -p ' + AORoutput
+    os.system(cmd)
 
-if (JobNo > Njobs):
-    die("Requested job number greater than number of jobs available " + str(Njobs) + "!");
 
-#make output directory
-cmd = 'mkdir -p ' + AORoutput
-os.system(cmd)
+#---------------------------------------------------------------------------------------------------
+# One job, once the stage data is loaded
+#---------------------------------------------------------------------------------------------------
 
-make_median_image(JobNo, JobList=JobList, log=log, AORlog=AORlog, debug=debug)
+def run_job(JobNo):
 
+    make_median_image(JobNo, JobList=JobList, log=log, AORlog=AORlog, debug=debug, index=index)
+
+
+if __name__ == '__main__':
+
+    #parse the arguments
+    usagestring ='%prog Job_Number'
+    parser = OptionParser()
+    parser = OptionParser(usage=usagestring)
+    (options, args) = parser.parse_args()
+
+    #fail if there aren't enough arguments
+    if len(args) < 1:
+        parser.error("Incorrect number of arguments.")
+
+    #read job number
+    JobNo=int(args[0])
+
+    # check if debug mode
+    if len(args) > 1:
+        debug = 1
+    else:
+        debug = 0
+
+    load_stage_data()
+    Njobs = len(JobList)
+
+    if (JobNo > Njobs):
+        die("Requested job number greater than number of jobs available " + str(Njobs) + "!");
+
+    run_job(JobNo)
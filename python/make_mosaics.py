@@ -13,7 +13,7 @@ def run_make_mosaics(JobNo):
 
 
 #read in the log file
-log = ascii.read(LogTable,format="ipac")
+log = read_table(LogTable)
 #determine list of channels
 IracChannels = set(log['Channel'][(log['Instrument']=='IRAC')])
 
@@ -24,7 +24,7 @@ if len(args) < 1:
 JobNo=int(args[0])
 
 #WRead in the list of tiles
-JobList = ascii.read(TileListFile,format="ipac")
+JobList = read_table(TileListFile)
 Njobs = len(JobList)
 
 if (JobNo > Njobs):
@@ -10,10 +10,10 @@ from astropy.coordinates import SkyCoord
 from astropy import units as u
 from astropy.table import Table, Column, MaskedColumn
 from supermopex import *
+from spitzer_pipeline_functions import read_log, replace_if_changed
 
 #read the logfile and get IRAC info
-rawlog = ascii.read(LogTable,format="ipac")
-log = rawlog[:][(rawlog['Instrument']=='IRAC').nonzero()]
+log = read_log()
 
 #Get the size of the array
 Nrows = log['Filename'].size
@@ -109,8 +109,10 @@ for i in range(0,len(stars)):
 
 if (len(StarInfo) > 0):
     data = Table(rows=StarInfo,names=['ID','ra','dec','ch1','ch2','ch3','ch4','wRA','wDEC','w1','w2','w3','w4'])
-    ascii.write(data,RefinedStarCat,format="ipac",overwrite=True)
+    ascii.write(data,RefinedStarCat + '.tmp',format="ipac",overwrite=True)
+    replace_if_changed(RefinedStarCat + '.tmp', RefinedStarCat)   #unchanged, it keeps its date and the stbcd stay current
     print(">> Done - wrote Products/stars.refined.tbl with {:} entries".format(len(StarInfo)))
 else: 
     print(">> No bright stars ... write empty stars.refined table")
-    os.system("cp refined.tbl Products/stars.refined.tbl")
+    os.system("cp refined.tbl " + RefinedStarCat + ".tmp")
+    replace_if_changed(RefinedStarCat + '.tmp', RefinedStarCat)
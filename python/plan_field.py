@@ -0,0 +1,226 @@
+#---------------------------------------------------------------------------------------------------
+# Planner of the resources of a field: from the frame inventory and the history of the past runs,
+# the wall time, peak memory and disk space of each stage on the chosen node layout, and the
+# requests (cores, memory, walltime) of the batch jobs that run them.  The job lists are built as
+# the stage scripts build them; the time of each job is predicted by the timing model of its stage
+# (job_timing), or for a stage never timed from a default time per frame, and the stage is
+# simulated as the executor runs it: longest first, within the number of workers (tuned for the
+# stage on this type of node, else one per core) and the memory budget of the node (job_memory).
+# The disk space written by each stage comes from the sizes of its products in the manifest, or
+# from a default size per frame.
+#
+# The requests go to plan.resources, one line per irac.sh module: module, cores, memory (GB) and
+# walltime (hours), read by irac.sh when it writes the job of a module; the plan itself goes to
+# OutputDIR/plan.tbl.  Usage:  python plan_field.py [-c cores] [-m memory] [-N nodes]
+#---------------------------------------------------------------------------------------------------
+
+import os, sys, math, heapq
+import numpy as np
+from astropy.io import ascii
+from astropy.table import Table
+
+from supermopex import *
+from spitzer_pipeline_functions import *
+from product_manifest import manifest_exists, open_manifest
+from job_timing import predict_times, timed_stage, tuned_workers
+from job_memory import predict_memory, FramePixels
+from job_executor import admissible
+
+PlanMargin = 1.5    # walltime requested, as a multiple of the predicted time
+PlanMinHours = 1    # shortest walltime requested
+
+# stages planned, in the order they run, with the irac.sh module that runs them
+PlanStages = [('ffcorr',           'first_frame_corr'),
+              ('find_stars',       'find_stars'),
+              ('merge_stars',      'merge_stars'),
+              ('subtract_stars',   'subtract_stars'),
+              ('make_medians',     'make_medians'),
+              ('fix_astrometry',   'fix_astrometry'),
+              ('subtract_medians', 'subtract_medians'),
+              ('check_stars',      'check_stars'),
+              ('check_astrometry', 'check_astrometry')]
+
+# stages 3 to 9, run together by stage_scheduler
+SchedulerStages = ['ffcorr', 'find_stars', 'merge_stars', 'subtract_stars', 'make_medians', 'fix_astrometry', 'subtract_medians']
+
+# seconds per frame of a job of a stage never timed: the old walltime formulas of irac.sh, which
+# allowed N/R hours for N frames on a 46-core node
+DefaultFrameSeconds = {'ffcorr': 0.8, 'find_stars': 41.0, 'merge_stars': 0.3, 'subtract_stars': 55.0,
+                       'make_medians': 17.0, 'fix_astrometry': 17.0, 'subtract_medians': 5.5,
+                       'check_stars': 33.0, 'check_astrometry': 4.1}
+
+# stage name in the manifest, and MB written per frame / per AOR.channel by a stage never recorded
+ManifestStages = {'ffcorr': 'first_frame_corr'}
+ImageMB = (FramePixels * 4 + 28800) / 1e6
+DefaultFrameMB = {'ffcorr': ImageMB, 'find_stars': 0.05, 'subtract_stars': 2*ImageMB,
+                  'subtract_medians': 2*ImageMB, 'check_stars': 0.02}
+DefaultAORChannelMB = {'make_medians': 4*ImageMB}
+
+
+#---------------------------------------------------------------------------------------------------
+# Job list of a stage as its script builds it, and the number of frames of each job
+#---------------------------------------------------------------------------------------------------
+
+def plan_joblist(stage, log, AORlog, index, Nworkers):
+
+    if stage == 'merge_stars':
+        JobList = Table(rows=[[0, len(log)]], names=['Channel','NumFrames'])
+    elif stage == 'make_medians':
+        JobList = add_median_repeats(make_joblist(log, AORlog, index=index), log, index)
+    elif stage in ['fix_astrometry', 'check_astrometry']:
+        JobList = make_exposure_joblist(log, index)[0]
+        return(JobList, np.array([len(rows) for rows in index['AORExposure'].values()]))
+    else:
+        JobList = make_joblist(log, AORlog, index=index, ChunkFrames=frame_chunk_size(len(log), Nworkers))
+    return(JobList, np.asarray(JobList['NumFrames']))
+
+
+#---------------------------------------------------------------------------------------------------
+# Predicted seconds of each job: the timing model of the stage, or the default time per frame
+#---------------------------------------------------------------------------------------------------
+
+def plan_times(stage, JobList, nframes):
+
+    if timed_stage(stage):
+        return(predict_times(stage, JobList), True)
+    return(DefaultFrameSeconds[stage] * nframes.astype(np.double), False)
+
+
+#---------------------------------------------------------------------------------------------------
+# Wall time of a stage run as the executor runs it: jobs started longest first, each in the first
+# free worker, the first of the waiting jobs whose memory fits what is left of the budget
+#---------------------------------------------------------------------------------------------------
+
+def simulate_stage(seconds, memory, Nworkers, budget):
+
+    waiting = np.argsort(-seconds, kind='stable').tolist()
+    running = list()   #(end, JobNo)
+    now, used = 0.0, 0.0
+    while waiting:
+        position = admissible(waiting, memory, used, budget, len(running)) if len(running) < Nworkers else None
+        if position is None:
+            end, JobNo = heapq.heappop(running)
+            now, used = end, used - memory[JobNo]
+            continue
+        JobNo = waiting.pop(position)
+        heapq.heappush(running, (now + seconds[JobNo], JobNo))
+        used += memory[JobNo]
+    return(max([now] + [end for end, JobNo in running]))
+
+
+#---------------------------------------------------------------------------------------------------
+# Disk space (GB) written by a stage: the sizes of its products in the manifest, per frame and per
+# AOR.channel (products of a whole AOR.channel are recorded with DCE 0), or the defaults
+#---------------------------------------------------------------------------------------------------
+
+def product_sizes():
+
+    sizes = dict()
+    if not manifest_exists():
+        return(sizes)
+    db = open_manifest()
+    for stage, totalsize, count in db.execute("SELECT stage, SUM(size), COUNT(DISTINCT dce) FROM products WHERE dce != 0 GROUP BY stage"):
+        sizes[(stage, True)] = totalsize / 1e9 / count
+    for stage, totalsize, count in db.execute("SELECT stage, SUM(size), COUNT(*) FROM (SELECT stage, SUM(size) AS size FROM products "
+                                              "WHERE dce = 0 GROUP BY stage, aor, channel) GROUP BY stage"):
+        sizes[(stage, False)] = totalsize / 1e9 / count
+    db.close()
+    return(sizes)
+
+
+def plan_disk(stage, Nframes, NAORchannels, sizes):
+
+    name = ManifestStages.get(stage, stage)
+    if ((name, True) in sizes) or ((name, False) in sizes):
+        return(Nframes * sizes.get((name, True), 0.0) + NAORchannels * sizes.get((name, False), 0.0))
+    return((Nframes * DefaultFrameMB.get(stage, 0.0) + NAORchannels * DefaultAORChannelMB.get(stage, 0.0)) / 1e3)
+
+
+#---------------------------------------------------------------------------------------------------
+# The plan: one row per stage, for Nnodes nodes of the given cores and memory (more than one node
+# only through the task queues)
+#---------------------------------------------------------------------------------------------------
+
+def plan_field(log, AORlog, index, cores, memory, Nnodes=1):
+
+    nodetype = "{:d}c{:.0f}g".format(cores, memory)
+    budget = MemoryBudget if MemoryBudget > 0 else MemoryFraction * memory
+    NAORchannels = len(index['AORChannel'])
+    sizes = product_sizes()
+
+    rows = list()
+    disk = 0.0
+    for stage, module in PlanStages:
+        Nworkers = tuned_workers(stage, nodetype) or cores
+        JobList, nframes = plan_joblist(stage, log, AORlog, index, Nworkers)
+        seconds, timed = plan_times(stage, JobList, nframes)
+        jobmemory = predict_memory(stage, JobList)
+        hours = simulate_stage(seconds, jobmemory, Nworkers * Nnodes, budget * Nnodes) / 3600
+        nodeGB = min(np.sum(np.sort(jobmemory)[::-1][:Nworkers]), budget)
+        stagedisk = plan_disk(stage, len(log), NAORchannels, sizes)
+        disk += stagedisk
+        rows.append((stage, module, len(JobList), int(np.sum(nframes)), Nworkers, timed, hours,
+                     float(np.max(jobmemory)), float(nodeGB), stagedisk, disk))
+
+    plan = Table(rows=rows, names=['Stage','Module','NumJobs','NumFrames','Workers','Timed','Hours',
+                                   'JobGB','NodeGB','DiskGB','TotalDiskGB'])
+    plan['Walltime'] = [walltime_request(hours) for hours in plan['Hours']]
+    return(plan)
+
+
+def walltime_request(hours):
+
+    return(int(max(PlanMinHours, math.ceil(hours * PlanMargin))))
+
+
+#---------------------------------------------------------------------------------------------------
+# Requests of the irac.sh modules, in the format of the batch job files: module, cores, memory,
+# walltime.  stage_scheduler runs stages 3 to 9 one after the other at worst
+#---------------------------------------------------------------------------------------------------
+
+def write_resources(plan, cores, ResourceFile):
+
+    requests = [(module, cores, int(math.ceil(nodeGB)), walltime) for (module, nodeGB, walltime) in plan['Module','NodeGB','Walltime']]
+    sel = np.isin(plan['Stage'], SchedulerStages)
+    requests.append(('stage_scheduler', cores, int(math.ceil(np.max(plan['NodeGB'][sel]))), walltime_request(np.sum(plan['Hours'][sel]))))
+
+    with open(ResourceFile + '.tmp', 'w') as f:
+        f.write("# module cores memGB hours - written by plan_field.py\n")
+        for module, ppn, mem, hours in requests:
+            if hours > MaxWalltime:
+                print("## WARNING: {:} needs {:} hours, more than {:}: requested {:}; run it on {:} nodes with TaskQueue".format(
+                      module, hours, MaxWalltime, MaxWalltime, int(math.ceil(hours / MaxWalltime))))
+                hours = MaxWalltime
+            f.write("{:} {:} {:} {:}\n".format(module, ppn, mem, hours))
+    os.replace(ResourceFile + '.tmp', ResourceFile)
+
+
+if __name__ == '__main__':
+
+    from optparse import OptionParser
+
+    usagestring = '%prog [-c cores] [-m memory] [-N nodes] [-o resources]'
+    parser = OptionParser(usage=usagestring)
+    parser.add_option('-c', '--cores', dest='cores', type='int', default=NodeCores, help='cores of a node [%default]')
+    parser.add_option('-m', '--memory', dest='memory', type='float', default=NodeMemory, help='memory (GB) of a node [%default]')
+    parser.add_option('-N', '--nodes', dest='Nnodes', type='int', default=1, help='nodes per stage, with TaskQueue [%default]')
+    parser.add_option('-o', '--output', dest='ResourceFile', default='plan.resources', help='requests of the modules [%default]')
+    (options, args) = parser.parse_args()
+
+    log = read_log()
+    AORlog = read_table(AORinfoTable)
+    index = read_group_index(['AORChannel', 'AORExposure'])
+
+    plan = plan_field(log, AORlog, index, options.cores, options.memory, options.Nnodes)
+    for name in ['Hours','JobGB','NodeGB','DiskGB','TotalDiskGB']:
+        plan[name].format = '.2f'
+    print(">> Plan for {:} frames in {:} AOR.channels on {:} node(s) of {:} cores / {:.0f} GB".format(
+          len(log), len(index['AORChannel']), options.Nnodes, options.cores, options.memory))
+    plan.pprint(max_lines=-1, max_width=-1)
+    untimed = [stage for stage, timed in plan['Stage','Timed'] if not timed]
+    if untimed:
+        print("## No timings yet for {:}: default times per frame used".format(', '.join(untimed)))
+
+    ascii.write(plan, OutputDIR + 'plan.tbl', format='ipac', overwrite=True)
+    write_resources(plan, options.cores, options.ResourceFile)
+    print("Wrote {:} and {:}".format(OutputDIR + 'plan.tbl', options.ResourceFile))
@@ -0,0 +1,330 @@
+#---------------------------------------------------------------------------------------------------
+# Product manifest: an SQLite table with one row per frame and product type (bcd, ffcbcd, stbcd, stmsk,
+# sub, sbunc, rmask, star tables, ...) giving its path, size, mtime and the stage that wrote it.
+# The stages record their outputs as they write them, so counts, completeness checks and file lists
+# are indexed queries rather than walks of the data directories.  With each product goes a hash of
+# what it was made from (input files, calibration, parameters): a rerun of a stage skips the frames
+# whose products are still on disk as recorded and were made from the same inputs.  Sizes and dates
+# are those of product_store, for the products kept in containers as for files.
+#
+# The manifest of the field is shared by the nodes, in OutputDIR.  The jobs record their products
+# in a manifest on the local disk of their node (ManifestLocalDIR), and the parent of the workers,
+# the one writer of the node, moves these rows into the shared one in one transaction as each job
+# ends: the workers do not wait on each other, nor on the other nodes, for the locks of a file on
+# the shared disk, and a stage rerun on another node finds the products of the jobs that ended.
+# Rows of frames gone from the log, and of products found missing (prune), are dropped.  The jobs
+# keep one connection to each manifest per process, for the frames they check and record one by one.
+#---------------------------------------------------------------------------------------------------
+
+import os, sys
+import sqlite3
+import hashlib
+import threading
+
+from supermopex import *
+from product_store import product_stat
+
+ManifestColumns = "dce, channel, aor, product, path, size, mtime, stage, inputs"
+ManifestSchema = """
+CREATE TABLE IF NOT EXISTS products (
+    dce     INTEGER NOT NULL,
+    channel INTEGER NOT NULL,
+    aor     INTEGER NOT NULL,
+    product TEXT    NOT NULL,
+    path    TEXT    NOT NULL,
+    size    INTEGER NOT NULL,
+    mtime   INTEGER NOT NULL,
+    stage   TEXT    NOT NULL,
+    inputs  TEXT    NOT NULL DEFAULT '',
+    PRIMARY KEY (product, path)
+);
+CREATE INDEX IF NOT EXISTS products_dce ON products (dce, product);
+CREATE INDEX IF NOT EXISTS products_aor ON products (product, aor, channel);
+"""
+
+Connections = dict()                 # connections of the jobs, by process and manifest file
+ConnectionLock = threading.Lock()    # used by the read-ahead and write-behind threads of the jobs
+
+
+#---------------------------------------------------------------------------------------------------
+# Open the manifest, or the local one of the node, creating it if needed; jobs write concurrently
+# so wait for the lock
+#---------------------------------------------------------------------------------------------------
+
+def open_manifest(local=False):
+
+    db = sqlite3.connect(local_manifest() if local else ManifestDB, timeout=600, check_same_thread=False)
+    db.executescript(ManifestSchema)
+    columns = [row[1] for row in db.execute("PRAGMA table_info(products)")]
+    if 'inputs' not in columns:   #manifest written before the input hashes
+        with db:
+            db.execute("ALTER TABLE products ADD COLUMN inputs TEXT NOT NULL DEFAULT ''")
+    return(db)
+
+
+#---------------------------------------------------------------------------------------------------
+# The connection of this process to the manifest, or to the local one, opened at first use and
+# again if the file was replaced; a forked worker opens its own.  To be used holding ConnectionLock
+#---------------------------------------------------------------------------------------------------
+
+def manifest_identity(path):
+
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return(None)
+    return((stat.st_dev, stat.st_ino))
+
+
+def manifest_connection(local=False):
+
+    key = (os.getpid(), local_manifest() if local else ManifestDB)
+    if (key not in Connections) or (Connections[key][1] != manifest_identity(key[1])):
+        db = open_manifest(local=local)
+        Connections[key] = (db, manifest_identity(key[1]))
+    return(Connections[key][0])
+
+
+#---------------------------------------------------------------------------------------------------
+# The local manifest of the node, one per field; None without ManifestLocalDIR
+#---------------------------------------------------------------------------------------------------
+
+def local_manifest():
+
+    if not ManifestLocalDIR:
+        return(None)
+    return(os.path.join(ManifestLocalDIR, 'irac_manifest.' + hashlib.sha1(ManifestDB.encode()).hexdigest()[:12] + '.db'))
+
+
+#---------------------------------------------------------------------------------------------------
+# Move the rows of the local manifest of the node into the shared one, in one transaction; run by
+# the parent of the workers as each job ends (and when the stage starts, for the rows of a stage
+# that died).  Returns the number of rows moved
+#---------------------------------------------------------------------------------------------------
+
+def merge_local_manifest():
+
+    if (local_manifest() is None) or not os.path.exists(local_manifest()):
+        return(0)
+    open_manifest(local=True).close()   #the schema, if the file was left empty
+    db = open_manifest()
+    db.execute("ATTACH DATABASE ? AS local", [local_manifest()])
+    with db:
+        db.execute("BEGIN IMMEDIATE")   #the write locks of both files first: then a job writing its rows is waited for, not a deadlock
+        Nrows = db.execute("INSERT OR REPLACE INTO products ({:}) SELECT {:} FROM local.products".format(ManifestColumns, ManifestColumns)).rowcount
+        db.execute("DELETE FROM local.products")
+    db.close()
+    return(Nrows)
+
+
+#---------------------------------------------------------------------------------------------------
+# Record products: rows are (DCE, Channel, AOR, product, path, size, mtime, inputs), written in one
+# transaction, to the shared manifest or the local one of the node
+#---------------------------------------------------------------------------------------------------
+
+def insert_products(stage, rows, local=False):
+
+    if len(rows) == 0:
+        return
+    with ConnectionLock:
+        db = manifest_connection(local=local and (local_manifest() is not None))
+        with db:
+            db.executemany("INSERT OR REPLACE INTO products VALUES (?,?,?,?,?,?,?,?,?)",
+                           [(int(DCE), int(Ch), int(AOR), product, str(path), int(size), int(mtime), stage, inputs)
+                            for (DCE, Ch, AOR, product, path, size, mtime, inputs) in rows])
+
+
+#---------------------------------------------------------------------------------------------------
+# Record the files just written by a job of a stage, in the local manifest: products are (DCE,
+# Channel, AOR, product, path) or (DCE, Channel, AOR, product, path, inputs hash); size and mtime are
+# taken from the file, files that were not written are skipped
+#---------------------------------------------------------------------------------------------------
+
+def record_products(stage, products):
+
+    rows = list()
+    for product in products:
+        (DCE, Ch, AOR, name, path), inputs = product[:5], (product[5] if len(product) > 5 else '')
+        stat = product_stat(path)
+        if stat is None:
+            continue
+        rows.append((DCE, Ch, AOR, name, path, stat[0], stat[1], inputs))
+    insert_products(stage, rows, local=True)
+
+
+#---------------------------------------------------------------------------------------------------
+# Drop rows: of the frames (DCEs) not in the log any more, of a product in a directory (before it
+# is written again there), or of the products that are missing on disk
+#---------------------------------------------------------------------------------------------------
+
+def prune_frames(DCEs):
+
+    db = open_manifest()
+    with db:
+        db.execute("CREATE TEMP TABLE frames (dce INTEGER PRIMARY KEY)")
+        db.executemany("INSERT OR IGNORE INTO frames VALUES (?)", [(int(DCE),) for DCE in DCEs])
+        Nrows = db.execute("DELETE FROM products WHERE dce != 0 AND dce NOT IN (SELECT dce FROM frames)").rowcount
+    db.close()
+    return(Nrows)
+
+
+def forget_products(product, directory):
+
+    directory = os.path.join(directory, '')
+    db = open_manifest()
+    with db:
+        db.execute("DELETE FROM products WHERE product = ? AND substr(path, 1, ?) = ?", [product, len(directory), directory])
+    db.close()
+
+
+def prune_missing(product):
+
+    db = open_manifest()
+    paths = [path for (path,) in db.execute("SELECT path FROM products WHERE product = ?", [product])]
+    gone = [(product, path) for path in paths if product_stat(path) is None]
+    with db:
+        db.executemany("DELETE FROM products WHERE product = ? AND path = ?", gone)
+    db.close()
+    return(len(gone))
+
+
+#---------------------------------------------------------------------------------------------------
+# Hash of the inputs of a product: path, size and mtime of the input files (missing files count
+# too), and the parameters it depends on (supermopex values, offsets, ...) as a tuple
+#---------------------------------------------------------------------------------------------------
+
+def input_hash(files, params=()):
+
+    identity = list()
+    for path in files:
+        stat = product_stat(path)
+        if stat is None:
+            identity.append((str(path), None, None))
+        else:
+            identity.append((str(path), stat[0], stat[1]))
+    return(hashlib.sha1(repr((identity, params)).encode()).hexdigest())
+
+
+#---------------------------------------------------------------------------------------------------
+# True if all the products (paths) are on disk as recorded, made from inputs with the given hash;
+# then a rerun can skip them.  Never with ReuseProducts off
+#---------------------------------------------------------------------------------------------------
+
+def products_current(paths, inputs):
+
+    if not (ReuseProducts and manifest_exists()):
+        return(False)
+    with ConnectionLock:
+        rows = manifest_connection().execute("SELECT path, size, mtime, inputs FROM products WHERE path IN ({:})".format(','.join('?'*len(paths))),
+                                             [str(path) for path in paths]).fetchall()
+    recorded = dict((path, (size, mtime, hash)) for (path, size, mtime, hash) in rows)
+    for path in paths:
+        if recorded.get(str(path), (None, None, None))[2] != inputs:
+            return(False)
+        if product_stat(path) != recorded[str(path)][:2]:
+            return(False)
+    return(True)
+
+
+#---------------------------------------------------------------------------------------------------
+# Queries
+#---------------------------------------------------------------------------------------------------
+
+def manifest_exists():
+
+    return(os.path.exists(ManifestDB))
+
+
+def product_paths(product, Ch=None, AOR=None):
+
+    query = "SELECT path FROM products WHERE product = ?"
+    args = [product]
+    if AOR is not None:
+        query += " AND aor = ?"; args.append(int(AOR))
+    if Ch is not None:
+        query += " AND channel = ?"; args.append(int(Ch))
+    db = open_manifest()
+    paths = [path for (path,) in db.execute(query + " ORDER BY path", args)]
+    db.close()
+    return(paths)
+
+
+def product_dces(product, Ch=None):
+
+    query = "SELECT path, dce FROM products WHERE product = ?"
+    args = [product]
+    if Ch is not None:
+        query += " AND channel = ?"; args.append(int(Ch))
+    db = open_manifest()
+    rows = db.execute(query + " ORDER BY dce, path", args).fetchall()
+    db.close()
+    return(rows)
+
+
+def count_products(product):
+
+    db = open_manifest()
+    rows = db.execute("SELECT aor, channel, COUNT(*) FROM products WHERE product = ? GROUP BY aor, channel ORDER BY aor, channel", [product]).fetchall()
+    db.close()
+    return(rows)
+
+
+#---------------------------------------------------------------------------------------------------
+# Frames (recorded with the reference product, the bcd) that lack the given product
+#---------------------------------------------------------------------------------------------------
+
+def missing_products(product, reference=bcdSuffix):
+
+    db = open_manifest()
+    rows = db.execute("""SELECT ref.path FROM products AS ref
+                         LEFT JOIN products AS prod ON prod.dce = ref.dce AND prod.product = ?
+                         WHERE ref.product = ? AND prod.path IS NULL ORDER BY ref.path""",
+                      [product, reference]).fetchall()
+    db.close()
+    return([path for (path,) in rows])
+
+
+#---------------------------------------------------------------------------------------------------
+# Command line: counts, lists and completeness checks for the shell scripts
+#---------------------------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+
+    from optparse import OptionParser
+
+    usagestring = '%prog count|list|missing|prune product [product ...]'
+    parser = OptionParser(usage=usagestring)
+    parser.add_option('-c', '--channel', dest='Ch', type='int', default=None, help='restrict to one channel')
+    parser.add_option('-r', '--reference', dest='reference', default=bcdSuffix, help='product that every frame should have [%default]')
+    (options, args) = parser.parse_args()
+
+    if len(args) < 2:
+        parser.error("Incorrect number of arguments.")
+    if not manifest_exists():
+        print("## ERROR: no product manifest {:}".format(ManifestDB))
+        sys.exit(1)
+
+    action = args[0]
+    if action == 'count':
+        #one line per AOR, number of products in ch1..4 and total, as countFiles.sh
+        for product in args[1:]:
+            counts = dict()
+            for (AOR, Ch, Nprod) in count_products(product):
+                counts.setdefault(AOR, [0,0,0,0])[Ch-1] = Nprod
+            for AOR in sorted(counts):
+                n = counts[AOR]
+                print("r{:<8d}  {:4d} {:4d} {:4d} {:4d}  {:5d}".format(AOR, n[0], n[1], n[2], n[3], sum(n)))
+    elif action == 'list':
+        for product in args[1:]:
+            for path in product_paths(product, Ch=options.Ch):
+                print(path)
+    elif action == 'missing':
+        for product in args[1:]:
+            for path in missing_products(product, options.reference):
+                print("  PROBLEM: {:} of {:} not found".format(product, path))
+    elif action == 'prune':
+        #the rows of the files deleted outside of the pipeline
+        for product in args[1:]:
+            print("## {:}: dropped {:} rows of missing files".format(product, prune_missing(product)))
+    else:
+        parser.error("Unknown action " + action)
@@ -0,0 +1,441 @@
+#---------------------------------------------------------------------------------------------------
+# Store of the intermediate frame products.  With ProductStore 'fits' each product of a frame is a
+# FITS file next to its bcd, as always.  With 'cube' the products in CubeProducts are kept, for all
+# the frames of an AOR.channel directory, in one container per product, <dir>/<suffix>.cube, with
+# one slot of CubeSlotBytes per frame: the slots are in the order of the stems of the bcd frames of
+# the directory, listed in <dir>/frames.index, then in frames.index.1, .2 ... for the frames added
+# later.  A slot holds a record (length in bytes of the frame, its mtime in ns) and the bytes of the
+# FITS file of the frame; the record is written once the frame is on disk, so that a slot half
+# written is a missing frame.  Unwritten slots take no disk space.
+#
+# The products keep their FITS path as their name, in the manifest and in the code: the stages read
+# and write them with read_product / write_product whatever the store, the manifest takes their
+# size and date from product_stat, and the programs that need files get them from product_fits (a
+# copy in their scratch directory: apex).  The products that mopex reads, MopexProducts, are always
+# FITS files, even when listed in CubeProducts.
+#
+# The image of a frame goes with its uncertainty and mask as a frame set, its sibling products of
+# FrameSets.  With FrameLayout 'mef' an image of MEFProducts is one file (in a container or not), SCI
+# with the UNC or MASK written with it by its stage; the others stay in their files.  read_frame_set
+# takes either layout, whatever FrameLayout; write_frame_set writes that of FrameLayout.
+#
+# With CompressProducts the products of CompressLossless and CompressQuantized (frames, in files or
+# containers, or the mosaics of the tiles) are written as tile-compressed FITS files: read_product
+# and the others read them as the others, product_fits gives a decompressed copy.
+#---------------------------------------------------------------------------------------------------
+
+import os, io, time, shutil
+import numpy as np
+
+from supermopex import *
+from irac_frames import read_frame, write_frame, frame_blocks, parse_frame, read_frames, parse_frames, frames_blocks, BlockSize
+from irac_frames import compressed_blocks, read_frame_astropy, read_frames_astropy, remove_card
+from frame_pipeline import warm_files
+
+CubeSlotBytes = 1 << 22   # bytes per frame in a container: a MEF of three 256x256 float64 frames and headers
+CubeRecord = np.dtype('<i8')   # slot record: length of the frame, mtime (ns)
+CubeRecordBytes = 2 * CubeRecord.itemsize
+FrameIndexName = 'frames.index'
+
+FrameSlots = dict()   #slot of each frame stem, per directory, as far as read
+
+
+#---------------------------------------------------------------------------------------------------
+# Slots of the frames of a directory, with that of the given stem if it is a frame.  The index files
+# are never changed: a frame not yet in them gets its slot in a new one, with the other bcd frames
+# then in the directory and not indexed, written by the first process that needs it
+#---------------------------------------------------------------------------------------------------
+
+def frame_slots(directory, stem):
+
+    ending = '_' + bcdSuffix + '.fits'
+    slots = FrameSlots.get(directory)
+    if (slots is not None) and ((stem in slots) or not os.path.exists(os.path.join(directory, stem + ending))):
+        return(slots)
+    while True:
+        slots, generation = read_frame_index(directory)
+        FrameSlots[directory] = slots
+        if (stem in slots) or not os.path.exists(os.path.join(directory, stem + ending)):
+            return(slots)
+        stems = sorted(name[:-len(ending)] for name in os.listdir(directory) if name.endswith(ending) and (name[:-len(ending)] not in slots))
+        indexfile = frame_index_name(directory, generation)
+        tmpfile = indexfile + '.' + str(os.getpid()) + '.tmp'
+        with open(tmpfile, 'w') as f:
+            f.write(''.join(name + '\n' for name in stems))
+        try:
+            os.link(tmpfile, indexfile)   #only if there is none: the first process to write it wins
+        except FileExistsError:
+            pass   #another process was first: read its stems, and add ours if it missed them
+        os.remove(tmpfile)
+
+
+def frame_index_name(directory, generation):
+
+    if generation == 0:
+        return(os.path.join(directory, FrameIndexName))
+    return(os.path.join(directory, FrameIndexName + '.' + str(generation)))
+
+
+def read_frame_index(directory):
+
+    slots = dict()
+    generation = 0
+    while True:
+        try:
+            with open(frame_index_name(directory, generation)) as f:
+                for line in f:
+                    slots[line.strip()] = len(slots)
+        except FileNotFoundError:
+            return((slots, generation))
+        generation += 1
+
+
+#---------------------------------------------------------------------------------------------------
+# Container and slot of a product, from its path; None if it is a file (other store or product, or
+# a frame not in the index)
+#---------------------------------------------------------------------------------------------------
+
+def cube_slot(path):
+
+    if ProductStore != 'cube':
+        return(None)
+    directory, stem, suffix = split_product(path)
+    if (suffix not in CubeProducts) or (suffix in MopexProducts):
+        return(None)
+    try:
+        slot = frame_slots(directory, stem).get(stem)
+    except OSError:   #no such directory: not a frame product
+        slot = None
+    if slot is None:
+        return(None)
+    return((os.path.join(directory, suffix + '.cube'), slot))
+
+
+def split_product(path):
+
+    directory, name = os.path.split(str(path))
+    if not name.endswith('.fits'):
+        return((directory, name, None))
+    stem, suffix = name[:-5].rsplit('_', 1) if '_' in name else (name[:-5], '')
+    return((directory, stem, suffix))
+
+
+def sibling_path(path, suffix):
+
+    directory, stem, product = split_product(path)
+    return(os.path.join(directory, stem + '_' + suffix + '.fits'))
+
+
+#---------------------------------------------------------------------------------------------------
+# Quantize level of a product written tile-compressed: 0 lossless, None not compressed.  The
+# product is the suffix of a frame product, or the end of the name of a mosaic of a tile
+# (.mosaic_unc, not .median_mosaic_unc); the whole-field mosaics are copied as they are
+#---------------------------------------------------------------------------------------------------
+
+def compression(path):
+
+    if not CompressProducts:
+        return(None)
+    directory, stem, suffix = split_product(path)
+    name = os.path.basename(str(path))
+    for products, level in [(CompressLossless, 0), (CompressQuantized, QuantizeLevel)]:
+        for product in products:
+            if (suffix == product) or ('.irac.tile.' in name and name.endswith('.' + product + '.fits')):
+                return(level)
+    return(None)
+
+
+def read_record(f, slot):
+
+    f.seek(slot * CubeSlotBytes)
+    record = np.frombuffer(f.read(CubeRecordBytes).ljust(CubeRecordBytes, b'\0'), dtype=CubeRecord)
+    return(int(record[0]), int(record[1]))
+
+
+def read_slot(path, location):
+
+    container, slot = location
+    length = 0
+    if os.path.exists(container):
+        with open(container, 'rb') as f:
+            length, mtime = read_record(f, slot)
+            buffer = bytearray(max(length, 0))
+            f.readinto(buffer)
+    if length <= 0:
+        raise FileNotFoundError(2, 'No such product', path)
+    return(buffer)
+
+
+def write_slot(path, location, raw):
+
+    container, slot = location
+    if CubeRecordBytes + len(raw) > CubeSlotBytes:
+        raise ValueError("{:}: {:} bytes, more than a slot of {:}".format(path, len(raw), container))
+    fd = os.open(container, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        os.pwrite(fd, np.zeros(2, dtype=CubeRecord).tobytes(), slot * CubeSlotBytes)   #missing while written
+        os.pwrite(fd, raw, slot * CubeSlotBytes + CubeRecordBytes)
+        os.fsync(fd)   #the frame on disk before its record: a crash leaves it missing, not corrupt
+        os.pwrite(fd, np.array([len(raw), time.time_ns()], dtype=CubeRecord).tobytes(), slot * CubeSlotBytes)
+    finally:
+        os.close(fd)
+
+
+#---------------------------------------------------------------------------------------------------
+# Read and write a product as read_frame / write_frame do
+#---------------------------------------------------------------------------------------------------
+
+def read_product(path, keywords=()):
+
+    location = cube_slot(path)
+    if location is None:
+        return(read_frame(path, keywords))
+    buffer = read_slot(path, location)
+    try:
+        return(parse_frame(buffer, keywords, path))
+    except IOError:   #not of the simple layout: tile-compressed
+        return(read_frame_astropy(io.BytesIO(bytes(buffer)), keywords))
+
+
+def write_product(path, data, header=None, updates=None):
+
+    level = compression(path)
+    if level is not None:
+        write_raw_product(path, compressed_blocks(path, [(data, header)], [None], updates, [level]))
+        return
+    location = cube_slot(path)
+    if location is None:
+        write_frame(path, data, header, updates)
+        return
+    cards, data = frame_blocks(path, data, header, updates)
+    write_slot(path, location, cards + data.tobytes() + b'\0' * (-data.nbytes % BlockSize))
+
+
+def read_product_hdus(path, keywords=()):
+
+    location = cube_slot(path)
+    if location is None:
+        return(read_frames(path, keywords))
+    buffer = read_slot(path, location)
+    try:
+        return(parse_frames(buffer, keywords, path))
+    except IOError:   #tile-compressed
+        return(read_frames_astropy(io.BytesIO(bytes(buffer)), keywords))
+
+
+def write_raw_product(path, raw):
+
+    location = cube_slot(path)
+    if location is None:
+        write_file(path, raw)
+        return
+    write_slot(path, location, raw)
+
+
+def write_file(path, raw):
+
+    tmpfile = path + '.' + str(os.getpid()) + '.tmp'
+    with open(tmpfile, 'wb') as f:
+        f.write(raw)
+    os.replace(tmpfile, path)
+
+
+#---------------------------------------------------------------------------------------------------
+# Make a product from a FITS file as it is (copied, or moved if it is a temporary file); compressed
+# if it is one of the products to compress
+#---------------------------------------------------------------------------------------------------
+
+def copy_product(source, path, move=False):
+
+    if compression(path) is not None:
+        data, header = read_frame(source)
+        write_product(path, data, header)
+        if move:
+            os.remove(source)
+        return
+    location = cube_slot(path)
+    if location is None:
+        tmpfile = path + '.' + str(os.getpid()) + '.tmp'
+        if move:
+            shutil.move(source, tmpfile)
+        else:
+            shutil.copy(source, tmpfile)
+        os.replace(tmpfile, path)
+        return
+    with open(source, 'rb') as f:
+        write_slot(path, location, f.read())
+    if move:
+        os.remove(source)
+
+
+#---------------------------------------------------------------------------------------------------
+# Size and mtime (ns) of a product, or None if it is missing: for the manifest
+#---------------------------------------------------------------------------------------------------
+
+def product_stat(path):
+
+    location = cube_slot(path)
+    try:
+        if location is None:
+            stat = os.stat(path)
+            return((stat.st_size, stat.st_mtime_ns))
+        with open(location[0], 'rb') as f:
+            length, mtime = read_record(f, location[1])
+    except OSError:
+        return(None)
+    if length <= 0:
+        return(None)
+    return((length, mtime))
+
+
+#---------------------------------------------------------------------------------------------------
+# A FITS file of a product for a program that reads files: the product itself if it is a file, else
+# a copy in the given (scratch) directory, with the same name; a compressed product is decompressed
+# there, for apex
+#---------------------------------------------------------------------------------------------------
+
+def product_fits(path, directory):
+
+    location = cube_slot(path)
+    if (location is None) and (compression(path) is None):
+        return(path)
+    copy = os.path.join(directory, os.path.basename(path))
+    if compression(path) is not None:
+        data, header = read_product(path)
+        write_frame(copy, data, header)
+        return(copy)
+    with open(copy, 'wb') as f:
+        f.write(read_slot(path, location))
+    return(copy)
+
+
+#---------------------------------------------------------------------------------------------------
+# Frame sets: an image with its uncertainty and mask, the products of FrameSets.  With the 'mef'
+# layout the images of MEFProducts are one file, with the products written with them by their stage
+# as extensions; the others (inputs of the pipeline, cbunc and bimsk) are not copied but read from
+# their files.  mef_members gives the products put in the file of an image
+#---------------------------------------------------------------------------------------------------
+
+def mef_members(suffix):
+
+    if FrameLayout != 'mef':
+        return([])
+    return(MEFProducts.get(suffix, []))
+
+
+#---------------------------------------------------------------------------------------------------
+# The products read for the image of a path, for the input hashes: the image and its sibling files;
+# the products written by write_frame_set, (suffix, path): the image and the siblings asked for
+# that are not in its file
+#---------------------------------------------------------------------------------------------------
+
+def frame_set_products(path):
+
+    members = mef_members(split_product(path)[2])
+    return([path] + [sibling_path(path, suffix) for suffix in FrameSets[split_product(path)[2]] if suffix not in members])
+
+
+def frame_set_outputs(path, siblings=()):
+
+    members = mef_members(split_product(path)[2])
+    return([(split_product(path)[2], path)] + [(suffix, sibling_path(path, suffix)) for suffix in siblings if suffix not in members])
+
+
+#---------------------------------------------------------------------------------------------------
+# Read a frame set: [(image, header), (unc, header), (mask, header)], each from the extension of the
+# image file named for it (UNC, MASK) if there is one, else from its sibling file; whatever the
+# FrameLayout, so the products of either layout are read.  The planes of a MEF lose its EXTEND and
+# EXTNAME, so that the products made from them are as those made from files
+#---------------------------------------------------------------------------------------------------
+
+def read_frame_set(path, keywords=()):
+
+    frames = read_product_hdus(path, keywords)
+    if len(frames) > 1:
+        frames = [plain_frame(frame) for frame in frames]
+    extensions = dict((header.get('EXTNAME'), (data, header)) for data, header in frames[1:])
+    planes = frames[:1]
+    for name, suffix in zip(FrameMEFNames[1:], FrameSets[split_product(path)[2]]):
+        planes.append(extensions[name] if name in extensions else read_product(sibling_path(path, suffix)))
+    return(planes)
+
+
+def plain_frame(frame):
+
+    data, header = frame
+    cards = header['cards']
+    for keyword in ('EXTEND', 'EXTNAME'):
+        cards = remove_card(cards, keyword)
+    return((data, dict(header, cards=cards)))
+
+
+#---------------------------------------------------------------------------------------------------
+# Write a frame set, from (data, header) or the FITS file of each of image, unc and mask, the
+# updates applied to all: the image and the siblings asked for (the others are inputs of the
+# stage, left as they are), those of mef_members in the file of the image and the others as files;
+# files given are copied as they are.  In a file to compress the UNC is quantized, the MASK lossless
+#---------------------------------------------------------------------------------------------------
+
+def write_frame_set(path, frames, updates=None, siblings=()):
+
+    members = mef_members(split_product(path)[2])
+    names = [FrameMEFNames[0]]
+    planes = [frames[0]]
+    for name, suffix, frame in zip(FrameMEFNames[1:], FrameSets[split_product(path)[2]], frames[1:]):
+        if suffix not in siblings:
+            continue
+        if suffix not in members:
+            target = sibling_path(path, suffix)
+            if isinstance(frame, str):
+                copy_product(frame, target)
+            else:
+                write_product(target, frame[0], frame[1], updates)
+            continue
+        names.append(name)
+        planes.append(frame)
+    if len(planes) == 1:
+        if isinstance(frames[0], str):
+            copy_product(frames[0], path)
+        else:
+            write_product(path, frames[0][0], frames[0][1], updates)
+        return
+    planes = [read_product(frame) if isinstance(frame, str) else frame for frame in planes]
+    level = compression(path)
+    if level is not None:
+        write_raw_product(path, compressed_blocks(path, planes, names, updates, [level] + [QuantizeLevel if name == 'UNC' else 0 for name in names[1:]]))
+        return
+    write_raw_product(path, frames_blocks(path, planes, names, updates))
+
+
+#---------------------------------------------------------------------------------------------------
+# A frame set for apex, which reads the image, unc and mask files.  fetch_frame_set, run ahead,
+# reads the set if the image has members in its file, else warms the files; frame_set_fits gives
+# the files of the image, unc and mask: copies in the given (scratch) directory, with their sibling
+# names, of the image and its members if it has some
+#---------------------------------------------------------------------------------------------------
+
+def fetch_frame_set(path):
+
+    if mef_members(split_product(path)[2]):
+        return(read_frame_set(path))
+    warm_files(frame_set_products(path))
+    return(None)
+
+
+def frame_set_fits(path, directory, frames=None):
+
+    suffixes = FrameSets[split_product(path)[2]]
+    members = mef_members(split_product(path)[2])
+    paths = [path] + [sibling_path(path, suffix) for suffix in suffixes]
+    if not members:
+        return([product_fits(product, directory) for product in paths])
+    if frames is None:
+        frames = read_frame_set(path)
+    copies = list()
+    for product, suffix, (data, header) in zip(paths, [None] + suffixes, frames):
+        if (suffix is not None) and (suffix not in members):
+            copies.append(product_fits(product, directory))
+            continue
+        copies.append(os.path.join(directory, os.path.basename(product)))
+        write_frame(copies[-1], data, header)
+    return(copies)
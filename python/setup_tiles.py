@@ -10,12 +10,11 @@ from astropy.io import ascii
 from astropy import units as u
 from astropy.table import Table, Column, MaskedColumn
 import re, sys, os, shutil
-from functools import partial
-import multiprocessing as mp
+from job_executor import run_jobs
+from frame_footprints import fif_corners, frames_overlapping
 
 #read in the log file and get irac info
-rawlog = ascii.read(LogTable,format="ipac")
-logIRAC = rawlog[:][(rawlog['Instrument']=='IRAC').nonzero()]
+logIRAC = read_log()
 
 # AMo: name of table with all tiles - before discarding those tiles with no data
 AllTiles = TMPDIR + 'AllTiles.tbl'
@@ -141,16 +140,44 @@ else:
     Njobs = len(JobList)
 
 
-# now run mosaic geometry on each tile to see if there are any files in each tile
+# use the frame footprints to skip the tiles that no frame overlaps; frames without a
+# footprint could be anywhere, so then all the tiles of that channel are kept
+Occupied = list(range(0,Njobs))
+SkyIndex = read_sky_index()
+if SkyIndex is not None:
+    TileCorners = dict()
+    UnplacedChannels = set(np.asarray(logIRAC['Channel'])[~np.isfinite(SkyIndex['RA'][:,0])].tolist())
+    Occupied = list()
+    for JobNo in range(0,Njobs):
+        FIF = JobList['FIF'][JobNo]
+        Ch = JobList['Channel'][JobNo]
+        if FIF not in TileCorners:
+            corners = fif_corners(FIF)
+            TileCorners[FIF] = (corners[0::2], corners[1::2])
+        if not np.all(np.isfinite(TileCorners[FIF][0] + TileCorners[FIF][1])):
+            Noverlap = 1   #no WCS for the tile: let mosaic geometry decide
+        else:
+            rows = frames_overlapping(SkyIndex, TileCorners[FIF][0], TileCorners[FIF][1])
+            Noverlap = np.sum(logIRAC['Channel'][rows] == Ch)
+        if (Noverlap > 0) or (Ch in UnplacedChannels):
+            Occupied.append(JobNo)
+    print("# {:} of {:} tile jobs overlap frames".format(len(Occupied), Njobs))
+
+# now run mosaic geometry on each occupied tile to see which files are in each tile
 # and restrict job list to "occupied" tiles
 Nthred = Nproc
 
 print("# Find exposures for each tile with {:} threads".format(Nthred))
-pool = mp.Pool(processes=Nthred)
-results = pool.map(partial(run_mosaic_geometry,JobList=JobList), range(0,Njobs))
-pool.close()
+#the tile list is inherited by the forked workers; the jobs carry only the tile number
+results = run_jobs(lambda JobNo: run_mosaic_geometry(JobNo, JobList=JobList), Njobs, Nthred, 'setup_tiles', order=Occupied)
+if any(result[1] != 'ok' for result in results):
+    print("# ERROR: mosaic geometry failed for some tiles ... quitting")
+    sys.exit(5)
 
-JobList['NumFrames']=results
+NumFrames = np.zeros(Njobs, dtype=int)
+for (JobNo, status, elapsed, message, value) in results:
+    NumFrames[JobNo] = value
+JobList['NumFrames'] = NumFrames
 
 #Find the tiles with frames associated
 GoodTiles = JobList[:][np.where(JobList['NumFrames'] > 0)]
@@ -158,4 +185,4 @@ GoodTiles = JobList[:][np.where(JobList['NumFrames'] > 0)]
 #Write list of tiles with data to an output
 print("")
 print("# Write list of mosaic tiles with data (job list) to {:}".format(TileListFile))
-ascii.write(GoodTiles, TileListFile, format="ipac", overwrite=True)
+write_table(GoodTiles, TileListFile)
@@ -4,23 +4,22 @@
 
 import numpy as np
 import numpy.ma as ma
-import sys, re, os, shutil
+import sys, re, os, shutil, filecmp
 
-from scipy.interpolate import interp1d
-import scipy.ndimage as ndimage
-from statsmodels import robust
-
-from astropy import wcs
-from astropy import units as u
-from astropy.io import fits
-from astropy.io import ascii
-from astropy.coordinates import SkyCoord
-from astropy.table import Table, Column, MaskedColumn, hstack
+# scipy, statsmodels and astropy (io.fits, io.ascii, table, coordinates, units, wcs, time) are
+# imported by the functions that use them, so that the many short job processes that need none of
+# them start quickly: the pipeline tables are read from their numpy binary copies
 
 import warnings
 warnings.filterwarnings("ignore")
 
 from supermopex import *
+from product_manifest import record_products, input_hash, products_current, forget_products
+from frame_footprints import make_sky_index, near_positions, positions_near_frame
+from irac_frames import read_frame, read_frame_header, write_frame
+from product_store import read_product, write_product, copy_product
+from product_store import read_frame_set, write_frame_set, fetch_frame_set, frame_set_fits, frame_set_products, frame_set_outputs, mef_members
+from frame_pipeline import prefetch, write_behind, queue_write
 
 
 #---------------------------------------------------------------------------------------------------
@@ -47,30 +46,324 @@ def scratch_dir_prefix(cluster):
 
 
 #---------------------------------------------------------------------------------------------------
-# Make the list of jobs, one per AOR.chan, from the list of frames and the list of AORs
+# Write the products of a frame through a temporary file next to them and rename it, so that an
+# interrupted job leaves the previous product or none, never a partial one
+#---------------------------------------------------------------------------------------------------
+
+def write_fits_atomic(HDU, filename):
+
+    tmpfile = filename + '.' + str(os.getpid()) + '.tmp'   #per process: another run of the job may write it too
+    HDU.writeto(tmpfile, overwrite=True)
+    os.replace(tmpfile, filename)
+
+
+def move_atomic(source, filename, copy=False):
+
+    tmpfile = filename + '.' + str(os.getpid()) + '.tmp'
+    if copy:
+        shutil.copy(source, tmpfile)
+    else:
+        shutil.move(source, tmpfile)
+    os.replace(tmpfile, filename)
+
+
+#---------------------------------------------------------------------------------------------------
+# Put a newly written shared input (star catalogs, lists of repeats) in place only if it differs
+# from the one there: an unchanged file keeps its date, so the products made from it stay current
+#---------------------------------------------------------------------------------------------------
+
+def replace_if_changed(tmpfile, filename):
+
+    if os.path.exists(filename) and filecmp.cmp(tmpfile, filename, shallow=False):
+        os.remove(tmpfile)
+    else:
+        os.replace(tmpfile, filename)
+
+
+#---------------------------------------------------------------------------------------------------
+# Binary copies of the pipeline tables (Frames, AORs, jobs): numpy structured arrays next to the
+# IPAC files, read memory mapped by the stages.  The IPAC files are kept for humans.
+#---------------------------------------------------------------------------------------------------
+
+def binary_table_name(TableName, subset=None):
+
+    root = re.sub(r'\.tbl$', '', TableName)
+    if subset:
+        root = root + '.' + subset
+    return(root + '.npy')
+
+
+def table_to_array(table):
+
+    from astropy.table import Table
+
+    table = Table(table).filled()
+    for name in table.colnames:
+        #bool columns come back from IPAC as 'True'/'False' strings; store them the same way
+        if table[name].dtype.kind == 'b':
+            table[name] = np.where(table[name], 'True', 'False')
+        #missing values give object columns
+        elif table[name].dtype.kind == 'O':
+            table[name] = [str(value) for value in table[name]]
+    return(table.as_array())
+
+
+def save_binary_table(table, binName):
+
+    tmpfile = binName + '.' + str(os.getpid()) + '.tmp'   #per process: jobs may rebuild a stale copy together
+    with open(tmpfile, 'wb') as binfile:
+        np.save(binfile, table_to_array(table), allow_pickle=False)
+    os.replace(tmpfile, binName)   #atomic, so jobs never see a partial file
+
+
+def load_binary_table(binName):
+
+    try:
+        return(np.load(binName, mmap_mode='r', allow_pickle=False))
+    except ValueError:   #empty tables can't be memory mapped
+        return(np.load(binName, allow_pickle=False))
+
+
+def binary_is_current(binName, TableName):
+
+    if not os.path.exists(binName):
+        return(False)
+    if not os.path.exists(TableName):
+        return(True)
+    return(os.path.getmtime(binName) >= os.path.getmtime(TableName))
+
+
+#---------------------------------------------------------------------------------------------------
+# Write a table as IPAC and binary
+#---------------------------------------------------------------------------------------------------
+
+def write_table(table, TableName):
+
+    from astropy.io import ascii
+
+    ascii.write(table, TableName, format="ipac", overwrite=True)
+    save_binary_table(table, binary_table_name(TableName))
+
+
+#---------------------------------------------------------------------------------------------------
+# Read a table from its binary copy.  If it is missing or older than the IPAC file (edited by hand)
+# parse the IPAC file once and rebuild the binary copy
+#---------------------------------------------------------------------------------------------------
+
+def read_table(TableName):
+
+    from astropy.io import ascii
+
+    binName = binary_table_name(TableName)
+    if not binary_is_current(binName, TableName):
+        save_binary_table(ascii.read(TableName, format="ipac"), binName)
+    return(load_binary_table(binName))
+
+
+#---------------------------------------------------------------------------------------------------
+# Write the frame log: Frames.tbl, its binary copy, and the binary IRAC subset
+#---------------------------------------------------------------------------------------------------
+
+def write_log(log):
+
+    write_table(log, LogTable)
+    logIRAC = log[(log['Instrument']=='IRAC').nonzero()]
+    save_binary_table(logIRAC, binary_table_name(LogTable, 'irac'))
+    write_group_index(logIRAC)
+    write_sky_index(logIRAC)
+
+
+#---------------------------------------------------------------------------------------------------
+# Read the IRAC frames of the log, memory mapped
+#---------------------------------------------------------------------------------------------------
+
+def read_log():
+
+    binName = binary_table_name(LogTable, 'irac')
+    if not binary_is_current(binName, LogTable):
+        rawlog = read_table(LogTable)
+        save_binary_table(rawlog[(rawlog['Instrument']=='IRAC').nonzero()], binName)
+    return(load_binary_table(binName))
+
+
+#---------------------------------------------------------------------------------------------------
+# Group index of the IRAC log.  For each grouping: the sorted unique keys, a stable ordering of the
+# rows by key, and the offsets of each group in it, so the rows of group i are
+# order[offsets[i]:offsets[i+1]], in log order
+#---------------------------------------------------------------------------------------------------
+
+GroupKeys = {'AORChannel':  ('AOR','Channel'),
+             'AORExposure': ('AOR','ExposureID'),
+             'DCE':         ('DCE',)}
+
+def make_group_index(log):
+
+    arrays = dict()
+    for group, columns in GroupKeys.items():
+        keys = np.column_stack([np.asarray(log[name]) for name in columns])
+        order = np.lexsort(keys.T[::-1])   #stable: first column is the primary key
+        keys = keys[order]
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = np.any(keys[1:] != keys[:-1], axis=1)
+        starts = first.nonzero()[0]
+        arrays[group + '.keys'] = keys[starts]
+        arrays[group + '.offsets'] = np.append(starts, len(order))
+        arrays[group + '.order'] = order
+    return(arrays)
+
+
+def write_group_index(log):
+
+    tmpfile = LogIndex + '.' + str(os.getpid()) + '.tmp'   #per process: jobs may rebuild a stale index together
+    with open(tmpfile, 'wb') as indexfile:
+        np.savez(indexfile, **make_group_index(log))
+    os.replace(tmpfile, LogIndex)
+
+
+#---------------------------------------------------------------------------------------------------
+# Turn the index arrays into dictionaries {key: rows}; keys are (AOR, Channel), (AOR, ExposureID)
+# and DCE, in key order
+#---------------------------------------------------------------------------------------------------
+
+def group_index(arrays, groups=GroupKeys):
+
+    index = dict()
+    for group in groups:
+        keys    = arrays[group + '.keys'].tolist()
+        offsets = arrays[group + '.offsets']
+        order   = arrays[group + '.order']
+        if len(GroupKeys[group]) == 1:
+            keys = [key[0] for key in keys]
+        else:
+            keys = [tuple(key) for key in keys]
+        index[group] = dict((key, order[offsets[i]:offsets[i+1]]) for i, key in enumerate(keys))
+    return(index)
+
+
+#---------------------------------------------------------------------------------------------------
+# Read the group index of the IRAC log, rebuilding it if the log changed
+#---------------------------------------------------------------------------------------------------
+
+def read_group_index(groups=GroupKeys):
+
+    log = read_log()
+    if not binary_is_current(LogIndex, binary_table_name(LogTable, 'irac')):
+        write_group_index(log)
+    with np.load(LogIndex) as arrays:
+        return(group_index(arrays, groups))
+
+
+#---------------------------------------------------------------------------------------------------
+# The rows of the log in one group, in log order; empty if there are none
+#---------------------------------------------------------------------------------------------------
+
+def group_rows(index, group, key):
+
+    return(index[group].get(key, np.zeros(0, dtype=int)))
+
+
+#---------------------------------------------------------------------------------------------------
+# The rows of the log of one job of an AOR.chan job list: frames FirstFrame to FirstFrame+NumFrames
+# of the AOR.chan, or all of them for the job lists without FirstFrame (whole AOR.chan jobs)
+#---------------------------------------------------------------------------------------------------
+
+def job_rows(index, JobList, JobNo):
+
+    rows = group_rows(index, 'AORChannel', (JobList['AOR'][JobNo], JobList['Channel'][JobNo]))
+    names = JobList.dtype.names if hasattr(JobList, 'dtype') else JobList.colnames
+    if 'FirstFrame' not in names:
+        return(rows)
+    FirstFrame = int(JobList['FirstFrame'][JobNo])
+    return(rows[FirstFrame:FirstFrame + int(JobList['NumFrames'][JobNo])])
+
+
+#---------------------------------------------------------------------------------------------------
+# Spatial index of the footprints of the IRAC frames (see frame_footprints); the rows it returns are
+# rows of the IRAC log.  Logs made before the footprints were recorded have no index (None)
+#---------------------------------------------------------------------------------------------------
+
+def write_sky_index(log):
+
+    if not set(FootprintItems).issubset(log.dtype.names):
+        if os.path.exists(SkyIndexFile):
+            os.remove(SkyIndexFile)
+        return
+    RAcorners  = np.column_stack([np.asarray(log[name], dtype=np.double) for name in FootprintItems[0::2]])
+    DECcorners = np.column_stack([np.asarray(log[name], dtype=np.double) for name in FootprintItems[1::2]])
+    tmpfile = SkyIndexFile + '.' + str(os.getpid()) + '.tmp'   #per process, as the group index
+    with open(tmpfile, 'wb') as indexfile:
+        np.savez(indexfile, **make_sky_index(RAcorners, DECcorners))
+    os.replace(tmpfile, SkyIndexFile)
+
+
+def read_sky_index():
+
+    log = read_log()
+    if not binary_is_current(SkyIndexFile, binary_table_name(LogTable, 'irac')):
+        write_sky_index(log)
+    if not os.path.exists(SkyIndexFile):
+        return(None)
+    with np.load(SkyIndexFile) as arrays:
+        return(dict(arrays))
+
+
+#---------------------------------------------------------------------------------------------------
+# Which catalog stars (SkyCoord) fall on a frame (row of the log) or within margin (deg) of its
+# footprint, from the sky index; without one, or without a WCS for the frame, those within radius
+# (deg) of the frame centre
+#---------------------------------------------------------------------------------------------------
+
+def stars_near_frame(stars, SkyIndex, row, ImCenter, margin, radius):
+
+    if (SkyIndex is None) or not np.all(np.isfinite(SkyIndex['RA'][row])):
+        return(stars.separation(ImCenter).deg < radius)
+    return(positions_near_frame(SkyIndex, row, stars.ra.deg, stars.dec.deg, margin))
+
+
+#---------------------------------------------------------------------------------------------------
+# Make the list of jobs, one per AOR.chan, from the list of frames and the list of AORs.  With
+# ChunkFrames, the AOR.chans are split in jobs of about ChunkFrames frames (FirstFrame is the first
+# frame of the job in the AOR.chan), for the stages that treat each frame on its own
 #---------------------------------------------------------------------------------------------------
 
-def make_joblist(log, AORlog):
+def make_joblist(log, AORlog, index=None, ChunkFrames=None):
+
+    from astropy.table import Table
+
+    if index is None:
+        index = group_index(make_group_index(log), ['AORChannel'])
 
-    #get a list of AORs
-    AORlist = list(set(log['AOR']))
-    Naor = len(AORlist)
+    #HDR mode of each AOR
+    HDRmode = dict(zip(AORlog['AOR'].tolist(), AORlog['HDR'].tolist()))
 
-    #make a list of channels and AORS
+    #make a list of channels and AORS, and of chunks of them of equal sizes
     JobList=list()
-    for aorIDX in range(0,Naor):
-        ChMax = AORlog['NumChannel'][aorIDX]   #np.max(log['Channel'][(log['AOR']==AORlist[aorIDX]).nonzero()])
-        HDR = AORlog['HDR'][aorIDX]
-        for Ch in range(1,ChMax+1):
-            Nframes =len(log['Channel'][((log['AOR']==AORlist[aorIDX])&(log['Channel']==Ch)).nonzero()])
-            if (Nframes > 0):
-                JobList.append([AORlist[aorIDX],HDR,Ch,Nframes])
+    for (AOR, Ch), rows in index['AORChannel'].items():
+        Nchunks = 1
+        if ChunkFrames:
+            Nchunks = max(1, int(np.ceil(len(rows) / ChunkFrames)))
+        bounds = np.linspace(0, len(rows), Nchunks+1).round().astype(int)
+        for FirstFrame, LastFrame in zip(bounds[:-1], bounds[1:]):
+            JobList.append([AOR, HDRmode[AOR], Ch, FirstFrame, LastFrame - FirstFrame])
 
-    JobList = Table(rows=JobList,names=['AOR','HDR','Channel','NumFrames'])
+    JobList = Table(rows=JobList,names=['AOR','HDR','Channel','FirstFrame','NumFrames'])
 
     return(JobList)
 
 
+#---------------------------------------------------------------------------------------------------
+# Frames per job for the per-frame stages: JobChunkFrames if set, else the frames of the log spread
+# over ChunksPerWorker jobs per worker (the cost of these jobs goes with their number of frames), so
+# that a large AOR does not make the stage wait on one worker
+#---------------------------------------------------------------------------------------------------
+
+def frame_chunk_size(Nframes, Nworkers):
+
+    if JobChunkFrames > 0:
+        return(JobChunkFrames)
+    return(max(MinChunkFrames, int(np.ceil(Nframes / (ChunksPerWorker * max(Nworkers, 1))))))
+
+
 #---------------------------------------------------------------------------------------------------
 # routine to apply proper motoins to GAIA catalog
 #---------------------------------------------------------------------------------------------------
@@ -115,6 +408,8 @@ def applyGAIApm(MJD,StarData):
 #---------------------------------------------------------------------------------------------------
 
 def applyGAIApm_wError(MJD,StarData):
+
+    from astropy.table import Table
     
     PMtime = (MJD-51558.5)/365.25  #time since 2015.5 (GAIA DR2 epoch) for proper motion correction
     
@@ -167,146 +462,183 @@ def applyGAIApm_wError(MJD,StarData):
 # routine to find stars to find star
 #---------------------------------------------------------------------------------------------------
 
-def findstar(JobNo,JobList,log,BrightStars,AstrometryStars):
+def findstar(JobNo,JobList,log,BrightStars,AstrometryStars,index=None,SkyIndex=None):
     
+    from astropy.coordinates import SkyCoord
+    from astropy.time import Time
+    from astropy.io import ascii
+    from astropy.table import Table
+
+    GaiaTime = Time(GaiaEpoch,format='decimalyear')
+
     AOR = JobList['AOR'][JobNo]
     Ch = JobList['Channel'][JobNo]
     Njobs = len(JobList)
     
     #make the list of files for this AOR and Channel
-    LogIDX = ((log['Channel']==Ch) & (log['AOR']==AOR)).nonzero()  # get the indexes of files we should use
+    if index is None:
+        index = read_group_index(['AORChannel'])
+    LogIDX = job_rows(index, JobList, JobNo)  # get the indexes of files we should use
     files  = log['Filename'][LogIDX]
     MJDs   = log['MJD'][LogIDX]
     RAs    = log['RA'][LogIDX]
     DECs   = log['DEC'][LogIDX]
+    DCEs   = log['DCE'][LogIDX]
     
+    #keep only the stars around the frames of this job; the margin covers the proper motions
+    BrightStars = BrightStars[near_positions(BrightStars['ra'], BrightStars['dec'], RAs, DECs, 0.123 + StarMotionMargin)]
+    AstrometryStars = AstrometryStars[near_positions(AstrometryStars['ra'], AstrometryStars['dec'], RAs, DECs, 0.0675 + StarMotionMargin)]
+
     #convert the catalogs to astropy sky-coord format
-    BrightCoords=SkyCoord(BrightStars['ra'], BrightStars['dec'],pm_ra_cosdec=BrightStars['pmra'].filled(),pm_dec=BrightStars['pmdec'].filled(),distance=BrightStars['parallax'].filled(),obstime=GaiaEpoch,frame='icrs', unit="deg")
-    AstrometryCoords=SkyCoord(AstrometryStars['ra'], AstrometryStars['dec'],pm_ra_cosdec=AstrometryStars['pmra'].filled(),pm_dec=AstrometryStars['pmdec'].filled(),distance=AstrometryStars['parallax'].filled(),obstime=GaiaEpoch,frame='icrs', unit="deg")
+    BrightCoords=SkyCoord(BrightStars['ra'], BrightStars['dec'],pm_ra_cosdec=BrightStars['pmra'].filled(),pm_dec=BrightStars['pmdec'].filled(),distance=BrightStars['parallax'].filled(),obstime=GaiaTime,frame='icrs', unit="deg")
+    AstrometryCoords=SkyCoord(AstrometryStars['ra'], AstrometryStars['dec'],pm_ra_cosdec=AstrometryStars['pmra'].filled(),pm_dec=AstrometryStars['pmdec'].filled(),distance=AstrometryStars['parallax'].filled(),obstime=GaiaTime,frame='icrs', unit="deg")
 
     Nframes = len(files)    
     print('## Begin find_stars job {:4d} on {:} - AOR {:8d} Ch {:}, {:3d} frames'.format(JobNo, os.uname().nodename, AOR, Ch, Nframes))
     
-    for fileNo in range(0,Nframes):
-        MJD      = MJDs[fileNo]
-        frameRA  = RAs[fileNo]
-        frameDEC = DECs[fileNo]
-        filename = files[fileNo]
-        
-        #Get the image center for figuring out which objects to consider
-        ImCenter = SkyCoord(frameRA,frameDEC, frame="fk5", unit="deg")
-
-        #Setup file suffixes re replace
-        inputSuffix  = '_' + bcdSuffix + '.fits'  #used in search
-        basename = re.sub(inputSuffix,'',re.split('/',filename)[-1])
-        
-        outputSuffix = '_' + ffSuffix + '.fits'
-        inputData =  re.sub(inputSuffix,outputSuffix,filename)  #use first frame corrected data as input
-        
-        outputSuffix = '_' + corUncSuffix + '.fits'
-        inputSigma =  re.sub(inputSuffix,outputSuffix,filename) #sigma file input
-        
-        outputSuffix = '_' + maskSuffix + '.fits'
-        inputMask =  re.sub(inputSuffix,outputSuffix,filename)  #masked pixel input
-        
-        outputSuffix = '_' + BrightStarInputTableSuffix
-        inputCatBright = re.sub(inputSuffix,outputSuffix,filename)   #table of bright stars as input
-
-        outputSuffix = '_' + BrightStarTableSuffix
-        outputCatBright = re.sub(inputSuffix,outputSuffix,filename)  #table of bright stars in frame as output
-
-        outputSuffix = '_' + StarInputTableSuffix
-        inputCatAstro = re.sub(inputSuffix,outputSuffix,filename)   #table of astrometry stars as input
-
-        outputSuffix = '_' + StarTableSuffix
-        outputCatAstro = re.sub(inputSuffix,outputSuffix,filename)  #table of astrometry stars in frame as output
-        
-        #Check if we are in the Cryo mission
-        if (MJD > WarmMJD):
-            cryo = 0
-        else:
-            cryo = 1
-    
-        #temporary files
-        pid = os.getpid() #get the PID for temp files
-        processTMPDIR = scratch_dir_prefix(cluster) + 'tmpfiles' + str(pid) + '-' + str(fileNo) + '/'
-        os.system('mkdir -p ' + processTMPDIR)
+    Nskipped = 0  #frames already done from the same inputs
+    #apex reads the images of the next frames from the page cache: they are read ahead; the star
+    #tables of a frame are put in place behind it
+    frames = [(files[fileNo], MJDs[fileNo], RAs[fileNo], DECs[fileNo], Ch, str(GaiaTime)) for fileNo in range(0,Nframes)]
+    with write_behind() as writer:
+        for fileNo, ((filename, MJD, frameRA, frameDEC, Ch, GaiaID), frame) in enumerate(prefetch(read_findstar_frame, frames)):
+
+            #Get the image center for figuring out which objects to consider
+            ImCenter = SkyCoord(frameRA,frameDEC, frame="fk5", unit="deg")
+
+            basename, cryo, inputs = frame['basename'], frame['cryo'], frame['inputs']
+            inputData, inputSigma, inputMask = frame['inputData'], frame['inputSigma'], frame['inputMask']
+            inputCatBright, outputCatBright = frame['inputCatBright'], frame['outputCatBright']
+            inputCatAstro, outputCatAstro = frame['inputCatAstro'], frame['outputCatAstro']
+
+            if frame['current']:
+                Nskipped += 1
+                continue
+
+            #temporary files
+            pid = os.getpid() #get the PID for temp files
+            processTMPDIR = scratch_dir_prefix(cluster) + 'tmpfiles' + str(pid) + '-' + str(fileNo) + '/'
+            os.system('mkdir -p ' + processTMPDIR)
 #        print("   Process temp dir is", processTMPDIR)      # DEBUG
+            inputData, inputSigma, inputMask = frame_set_fits(inputData, processTMPDIR, frame['planes'])   #files for apex
 
-        #Cut Bright Star catalog to this frame
-        #Transform GAIA catalog to current epoch
-        #BrightPositions = applyGAIApm(MJD,BrightStars)
-        BrightPositions = BrightCoords.apply_space_motion(Time(MJD,format='mjd'))
+            #Cut Bright Star catalog to this frame
+            #Transform GAIA catalog to current epoch
+            #BrightPositions = applyGAIApm(MJD,BrightStars)
+            BrightPositions = BrightCoords.apply_space_motion(Time(MJD,format='mjd'))
 
-        #Cut catalog to this frame
-        BrightSep = BrightPositions.separation(ImCenter)
-        BrightInFrame = BrightPositions[np.where(BrightSep.deg < 0.123)]
+            #Cut catalog to this frame: its footprint and the margin of the star wings
+            BrightInFrame = BrightPositions[stars_near_frame(BrightPositions, SkyIndex, LogIDX[fileNo], ImCenter, BrightStarMargin, 0.123)]
 
-        #write out catalog for bright stars
-        BrightStarTable = inputCatBright
-        ascii.write(Table([BrightInFrame.ra.deg,BrightInFrame.dec.deg],names=['ra','dec']),BrightStarTable,format="ipac",overwrite=True)
+            #write out catalog for bright stars
+            BrightStarTable = inputCatBright
+            ascii.write(Table([BrightInFrame.ra.deg,BrightInFrame.dec.deg],names=['ra','dec']),BrightStarTable + '.' + str(pid),format="ipac",overwrite=True)
+            os.replace(BrightStarTable + '.' + str(pid), BrightStarTable)   #whole, even with a duplicate job reading it
         
 #        print(' - Frame {:3d}; {:}: find bright stars ...'.format(fileNo +1, inputData.split('/')[-1]), end=' ') # DEBUG
         
-        # do the bright stars for star subtraction
-        command = "apex_user_list_1frame.pl -n find_brightstars.nl  -p " + PRF[cryo][Ch-1] + " -u " + BrightStarTable + " -i " + inputData + " -s " + inputSigma + " -d " + inputMask + " -M " + IRACPixelMasks[Ch-1] + " -O " + processTMPDIR + ' > /dev/null 2>&1'
-        os.system(command)
+            # do the bright stars for star subtraction
+            command = "apex_user_list_1frame.pl -n find_brightstars.nl  -p " + PRF[cryo][Ch-1] + " -u " + BrightStarTable + " -i " + inputData + " -s " + inputSigma + " -d " + inputMask + " -M " + IRACPixelMasks[Ch-1] + " -O " + processTMPDIR + ' > /dev/null 2>&1'
+            os.system(command)
         
-        #move the output to the final location
-        FitTable = processTMPDIR + basename + "_ffcbcd_extract_raw.tbl"
+            #move the output to the final location
+            FitTable = processTMPDIR + basename + "_ffcbcd_extract_raw.tbl"
 #        print("### shutil mv ",FitTable,outputCatBright)      # DEBUG
-        shutil.move(FitTable,outputCatBright)
+            move_atomic(FitTable,outputCatBright)
 
-        #Transform GAIA catalog to current epoch
-        #AstrometryPositions = applyGAIApm(MJD,AstrometryStars)
-        AstrometryPositions = AstrometryCoords.apply_space_motion(Time(MJD,format='mjd'))
+            #Transform GAIA catalog to current epoch
+            #AstrometryPositions = applyGAIApm(MJD,AstrometryStars)
+            AstrometryPositions = AstrometryCoords.apply_space_motion(Time(MJD,format='mjd'))
 
-        #Cut catalog to this frame
-        #AstrometryPositionsCoord = SkyCoord(AstrometryPositions, frame="fk5", unit="deg")
-        AstroSep = AstrometryPositions.separation(ImCenter)
-        AstroInFrame = AstrometryPositions[np.where(AstroSep.deg < 0.0675)]
+            #Cut catalog to this frame
+            #AstrometryPositionsCoord = SkyCoord(AstrometryPositions, frame="fk5", unit="deg")
+            AstroInFrame = AstrometryPositions[stars_near_frame(AstrometryPositions, SkyIndex, LogIDX[fileNo], ImCenter, AstroStarMargin, 0.0675)]
 
-        #write out catalog for Astrometry stars
-        FitStarTable = inputCatAstro
-        ascii.write(Table([AstroInFrame.ra.deg,AstroInFrame.dec.deg],names=['ra','dec']),FitStarTable,format="ipac",overwrite=True)
+            #write out catalog for Astrometry stars
+            FitStarTable = inputCatAstro
+            ascii.write(Table([AstroInFrame.ra.deg,AstroInFrame.dec.deg],names=['ra','dec']),FitStarTable + '.' + str(pid),format="ipac",overwrite=True)
+            os.replace(FitStarTable + '.' + str(pid), FitStarTable)
 
-        #print(' find astrometry stars')
-        #now do the stars for astrometry
-        command = "apex_user_list_1frame.pl -n find_astrostars.nl -m " + PRFmap[cryo][Ch-1] + " -u " + FitStarTable + " -i " + inputData + " -s " + inputSigma + " -d " + inputMask + " -M " + IRACPixelMasks[Ch-1] + " -O " + processTMPDIR + ' > /dev/null 2>&1'
-        os.system(command)
+            #print(' find astrometry stars')
+            #now do the stars for astrometry
+            command = "apex_user_list_1frame.pl -n find_astrostars.nl -m " + PRFmap[cryo][Ch-1] + " -u " + FitStarTable + " -i " + inputData + " -s " + inputSigma + " -d " + inputMask + " -M " + IRACPixelMasks[Ch-1] + " -O " + processTMPDIR + ' > /dev/null 2>&1'
+            os.system(command)
         
-        #move the output to the final location
-        FitTable = processTMPDIR + basename + "_ffcbcd_extract_raw.tbl"
-        shutil.move(FitTable,outputCatAstro)
+            #move the output to the final location, record the tables and clean up, behind the next frame
+            FitTable = processTMPDIR + basename + "_ffcbcd_extract_raw.tbl"
+            queue_write(writer, move_atomic, FitTable, outputCatAstro)
+            queue_write(writer, record_products, 'find_stars', [(DCEs[fileNo], Ch, AOR, BrightStarTableSuffix, outputCatBright, inputs),
+                                                                (DCEs[fileNo], Ch, AOR, StarTableSuffix, outputCatAstro, inputs)])
         
-        #clean up
-        cleanupCMD = 'rm -rf ' + processTMPDIR
-        os.system(cleanupCMD)
+            #clean up
+            cleanupCMD = 'rm -rf ' + processTMPDIR
+            queue_write(writer, os.system, cleanupCMD)
         
-    print('## Finished job {:4d}: AOR {:8d} Ch {:}'.format(JobNo, AOR, Ch))
+    print('## Finished job {:4d}: AOR {:8d} Ch {:}; {:} frames up to date'.format(JobNo, AOR, Ch, Nskipped))
+
+
+#---------------------------------------------------------------------------------------------------
+# File names and input hash of a frame of findstar, and whether its star tables are up to date; if
+# not its images are read (a MEF) or read into the page cache for apex.  Run by the reader threads
+#---------------------------------------------------------------------------------------------------
+
+def read_findstar_frame(item):
+
+    filename, MJD, frameRA, frameDEC, Ch, GaiaID = item
+
+    #Setup file suffixes re replace
+    inputSuffix  = '_' + bcdSuffix + '.fits'  #used in search
+    frame = {'basename':        re.sub(inputSuffix,'',re.split('/',filename)[-1]),
+             'inputData':       re.sub(inputSuffix, '_' + ffSuffix + '.fits', filename),          #use first frame corrected data as input
+             'inputSigma':      re.sub(inputSuffix, '_' + corUncSuffix + '.fits', filename),      #sigma file input
+             'inputMask':       re.sub(inputSuffix, '_' + maskSuffix + '.fits', filename),        #masked pixel input
+             'inputCatBright':  re.sub(inputSuffix, '_' + BrightStarInputTableSuffix, filename),  #table of bright stars as input
+             'outputCatBright': re.sub(inputSuffix, '_' + BrightStarTableSuffix, filename),       #table of bright stars in frame as output
+             'inputCatAstro':   re.sub(inputSuffix, '_' + StarInputTableSuffix, filename),        #table of astrometry stars as input
+             'outputCatAstro':  re.sub(inputSuffix, '_' + StarTableSuffix, filename)}             #table of astrometry stars in frame as output
+
+    #Check if we are in the Cryo mission
+    if (MJD > WarmMJD):
+        frame['cryo'] = 0
+    else:
+        frame['cryo'] = 1
+    cryo = frame['cryo']
+
+    #skip the frame if its star tables were made from the same image, catalogs and PRFs
+    frame['inputs'] = input_hash(frame_set_products(frame['inputData']) + [BrightStarCat, GaiaTable,
+                                  PRF[cryo][Ch-1], PRFmap[cryo][Ch-1], IRACPixelMasks[Ch-1]],
+                                 (MJD, frameRA, frameDEC, GaiaID))
+    frame['current'] = products_current([frame['outputCatBright'], frame['outputCatAstro']], frame['inputs'])
+    if not frame['current']:
+        frame['planes'] = fetch_frame_set(frame['inputData'])
+    return(frame)
 
 
 #---------------------------------------------------------------------------------------------------
 # routine to find stars in order to check the astrometry solution
 #---------------------------------------------------------------------------------------------------
 
-def checkstar(JobNo,JobList,log,AstrometryStars):
+def checkstar(JobNo,JobList,log,AstrometryStars,index=None):
     
     AOR = JobList['AOR'][JobNo]
     Ch = JobList['Channel'][JobNo]
     Njobs = len(JobList)
     
     #make the list of files for this AOR and Channel
-    LogIDX = ((log['Channel']==Ch) & (log['AOR']==AOR)).nonzero()  # get the indexes of files we should use
+    if index is None:
+        index = read_group_index(['AORChannel'])
+    LogIDX = job_rows(index, JobList, JobNo)  # get the indexes of files we should use
     files = log['Filename'][LogIDX]
     MJDs = log['MJD'][LogIDX]
     RAs  = log['RA'][LogIDX]
     DECs = log['DEC'][LogIDX]
+    DCEs = log['DCE'][LogIDX]
     
     Nframes = len(files)
 
     print('## Begin check_stars job {:4d} - AOR {:8d} Ch {:}, {:3d} frames'.format(JobNo, AOR, Ch, Nframes))
  
+    Nskipped = 0  #frames already done from the same inputs
     for fileNo in range(0,Nframes):
         MJD = MJDs[fileNo]
         frameRA = RAs[fileNo]
@@ -338,10 +670,17 @@ def checkstar(JobNo,JobList,log,AstrometryStars):
         else:
             cryo = 1
 
+        #skip the frame if its star table was made from the same image, catalog and PRF
+        inputs = input_hash(frame_set_products(inputData) + [inputCatAstro, PRFmap[cryo][Ch-1], IRACPixelMasks[Ch-1]])
+        if products_current([outputCatAstro], inputs):
+            Nskipped += 1
+            continue
+
         #temporary files
         pid = os.getpid() #get the PID for temp files
         processTMPDIR = scratch_dir_prefix(cluster) + 'tmpfiles' + str(pid) + '-' + str(fileNo) + '/'
         os.system('mkdir -p ' + processTMPDIR)
+        inputData, inputSigma, inputMask = frame_set_fits(inputData, processTMPDIR)   #files for apex
         
         #write out catalog for Astrometry stars
         FitStarTable = inputCatAstro
@@ -353,35 +692,89 @@ def checkstar(JobNo,JobList,log,AstrometryStars):
         
         #move the output to the final location
         FitTable = processTMPDIR + basename + "_sub_extract_raw.tbl"
-        shutil.move(FitTable,outputCatAstro)
+        move_atomic(FitTable,outputCatAstro)
+        record_products('check_stars', [(DCEs[fileNo], Ch, AOR, AstrocheckTableSuffix, outputCatAstro, inputs)])
         
         #clean up
         cleanupCMD = 'rm -rf ' + processTMPDIR
         os.system(cleanupCMD)
 
-    print('## Finished job {:4d}: AOR {:8d} Ch {:}'.format(JobNo, AOR, Ch))
+    print('## Finished job {:4d}: AOR {:8d} Ch {:}; {:} frames up to date'.format(JobNo, AOR, Ch, Nskipped))
     
 
+#---------------------------------------------------------------------------------------------------
+# Astrometry offset of one exposure (AOR, ExposureID), as returned by fix_astrometry / check_astrometry
+#---------------------------------------------------------------------------------------------------
+
+AstroFixType = np.dtype([('JobID',np.int64), ('dRA',np.double), ('dDEC',np.double), ('error_dRA',np.double), ('error_dDEC',np.double), ('Nstars',np.int64)])
+
+
+#---------------------------------------------------------------------------------------------------
+# Jobs of fix_astrometry / check_astrometry, one per exposure (AOR, ExposureID), and the job number
+# of each frame of the log, to join the results back to the frames
+#---------------------------------------------------------------------------------------------------
+
+def make_exposure_joblist(log, index):
+
+    from astropy.table import Table
+
+    JobList=list()
+    FrameJob = np.zeros(len(log),dtype=int)
+    for JobNo, ((AOR, ID), rows) in enumerate(index['AORExposure'].items()):
+        ChMax = np.max(log['Channel'][rows])
+        JobList.append([JobNo,AOR,ID,ChMax])
+        FrameJob[rows] = JobNo
+
+    JobList = Table(rows=JobList,names=['JobNo','AOR','ExposureID','ChannelMax'])
+    return(JobList, FrameJob)
+
+
+#---------------------------------------------------------------------------------------------------
+# Join the offsets of the exposures (AstroFixType array, by job) to their frames: some columns from
+# the log, then the astrometry; for all the frames or the given rows of the log
+#---------------------------------------------------------------------------------------------------
+
+AstroFixLogColumns = ['Filename','DCE','AOR','ExposureID','Channel','RA','DEC']
+
+def astrometry_fix_table(log, results, FrameJob, rows=None):
+
+    from astropy.table import Table, hstack
+
+    if rows is None:
+        rows = np.arange(len(log))
+    return(hstack([Table(log[rows][AstroFixLogColumns]),Table(results[FrameJob[rows]])]))
+
+
 #---------------------------------------------------------------------------------------------------
 #
 #---------------------------------------------------------------------------------------------------
 
-def fix_astrometry(JobNo,log,Nrows,JobList,AstrometryStars):
+def fix_astrometry(JobNo,log,Nrows,JobList,AstrometryStars,index=None):
     
+    from astropy.coordinates import SkyCoord
+    from astropy import units as u
+    from astropy.time import Time
+    from astropy.io import ascii
+
+    GaiaTime = Time(GaiaEpoch,format='decimalyear')
+
     ChMax =  JobList['ChannelMax'][JobNo]
     ID    =  JobList['ExposureID'][JobNo]
     AOR   =  JobList['AOR'][JobNo]
-    MJD   = np.average(log['MJD'][((log['AOR']==AOR)&(log['ExposureID']==ID)).nonzero()])
+    if index is None:
+        index = read_group_index(['AORExposure'])
+    LogIDX = group_rows(index, 'AORExposure', (AOR, ID))  # the frames of this exposure, all channels
+    MJD   = np.average(log['MJD'][LogIDX])
     
     FrameEpoch = Time(MJD,format='mjd')
     
 
     #convert to astropy coords format
-    StarCoords=SkyCoord(AstrometryStars['ra'], AstrometryStars['dec'],pm_ra_cosdec=AstrometryStars['pmra'].filled(),pm_dec=AstrometryStars['pmdec'].filled(),distance=AstrometryStars['parallax'].filled(),obstime=GaiaEpoch,frame='icrs', unit="deg")
+    StarCoords=SkyCoord(AstrometryStars['ra'], AstrometryStars['dec'],pm_ra_cosdec=AstrometryStars['pmra'].filled(),pm_dec=AstrometryStars['pmdec'].filled(),distance=AstrometryStars['parallax'].filled(),obstime=GaiaTime,frame='icrs', unit="deg")
     #make a local copy of the table
-    StarData = AstrometryStars
+    StarData = AstrometryStars.copy()
     
-    PMtime = (FrameEpoch.mjd-GaiaEpoch.mjd)/365.25  #time to GAIA in years for proper motion correction
+    PMtime = (FrameEpoch.mjd-GaiaTime.mjd)/365.25  #time to GAIA in years for proper motion correction
     
     #do the proper motion correction to the MJD
     StarMatch = StarCoords.apply_space_motion(Time(MJD,format='mjd'))
@@ -390,8 +783,8 @@ def fix_astrometry(JobNo,log,Nrows,JobList,AstrometryStars):
     StarData['dec_error'] = np.sqrt(StarData['dec_error']**2 + (StarData['pmdec_error'].filled()*PMtime)**2)
     StarData['ra_error'] = np.sqrt(StarData['ra_error']**2 + (StarData['pmra_error'].filled()*PMtime)**2)
     
-    files = log['Filename'][((log['AOR']==AOR)&(log['ExposureID']==ID)).nonzero()]
-    DCElist = log['DCE'][((log['AOR']==AOR)&(log['ExposureID']==ID)).nonzero()]
+    files = log['Filename'][LogIDX]
+    DCElist = log['DCE'][LogIDX]
     
     #offset and weight values for astrometry
     RAstar = list()
@@ -492,7 +885,7 @@ def fix_astrometry(JobNo,log,Nrows,JobList,AstrometryStars):
     
     print('Process frame {:5d} using {:3d} stars.  Offset is dRA = {:4.2f} +/- {:4.2f}; dDEC = {:5.2f} +/- {:4.2f}'.format(JobNo+1, GoodStars, corrRA*3600, 3600*sig_RA/np.sqrt(GoodStars), corrDEC*3600, 3600*sig_DEC/np.sqrt(GoodStars) ))
     
-    astrofix = np.array([JobNo,corrRA,corrDEC,sig_RA/np.sqrt(GoodStars),sig_DEC/np.sqrt(GoodStars),GoodStars],dtype=np.double)
+    astrofix = np.array((JobNo,corrRA,corrDEC,sig_RA/np.sqrt(GoodStars),sig_DEC/np.sqrt(GoodStars),GoodStars),dtype=AstroFixType)
     return(astrofix)
 
 
@@ -500,25 +893,35 @@ def fix_astrometry(JobNo,log,Nrows,JobList,AstrometryStars):
 #
 #---------------------------------------------------------------------------------------------------
 
-def check_astrometry(JobNo,log,Nrows,JobList,AstrometryStars):
+def check_astrometry(JobNo,log,Nrows,JobList,AstrometryStars,index=None):
     
+    from astropy.coordinates import SkyCoord
+    from astropy import units as u
+    from astropy.time import Time
+    from astropy.io import ascii
+
+    GaiaTime = Time(GaiaEpoch,format='decimalyear')
+
     ChMax =  JobList['ChannelMax'][JobNo]
     ID    =  JobList['ExposureID'][JobNo]
     AOR   =  JobList['AOR'][JobNo]
-    MJD   = np.average(log['MJD'][((log['AOR']==AOR)&(log['ExposureID']==ID)).nonzero()])
+    if index is None:
+        index = read_group_index(['AORExposure'])
+    LogIDX = group_rows(index, 'AORExposure', (AOR, ID))  # the frames of this exposure, all channels
+    MJD   = np.average(log['MJD'][LogIDX])
     
     PMtime = (MJD-51543.0)/365.2422  #time since J2000 for proper motion correction
     
     #convert the catalogs to astropy sky-coord format
-    AstrometryCoords=SkyCoord(AstrometryStars['ra'], AstrometryStars['dec'],pm_ra_cosdec=AstrometryStars['pmra'].filled(),pm_dec=AstrometryStars['pmdec'].filled(),distance=AstrometryStars['parallax'].filled(),obstime=GaiaEpoch,frame='icrs', unit="deg")
+    AstrometryCoords=SkyCoord(AstrometryStars['ra'], AstrometryStars['dec'],pm_ra_cosdec=AstrometryStars['pmra'].filled(),pm_dec=AstrometryStars['pmdec'].filled(),distance=AstrometryStars['parallax'].filled(),obstime=GaiaTime,frame='icrs', unit="deg")
     
 
     #do the proper motion correction to the MJD
     StarMatch = AstrometryCoords.apply_space_motion(Time(MJD,format='mjd'))
     #StarMatch = SkyCoord(AstrometryPositions['RA'],AstrometryPositions['DEC'],frame="fk5", unit="deg")
     
-    files = log['Filename'][((log['AOR']==AOR)&(log['ExposureID']==ID)).nonzero()]
-    DCElist = log['DCE'][((log['AOR']==AOR)&(log['ExposureID']==ID)).nonzero()]
+    files = log['Filename'][LogIDX]
+    DCElist = log['DCE'][LogIDX]
     
     #offset and weight values for astrometry
     RAstar = list()
@@ -618,7 +1021,7 @@ def check_astrometry(JobNo,log,Nrows,JobList,AstrometryStars):
     
     print('Process frame {:5d} using {:3d} stars.  Offset is dRA = {:4.2f} +/- {:4.2f}; dDEC = {:5.2f} +/- {:4.2f}'.format(JobNo+1, GoodStars, corrRA*3600, 3600*sig_RA/np.sqrt(GoodStars), corrDEC*3600, 3600*sig_DEC/np.sqrt(GoodStars) ))
 
-    astrofix = np.array([JobNo,corrRA,corrDEC,sig_RA/np.sqrt(GoodStars),sig_DEC/np.sqrt(GoodStars),GoodStars],dtype=np.double)
+    astrofix = np.array((JobNo,corrRA,corrDEC,sig_RA/np.sqrt(GoodStars),sig_DEC/np.sqrt(GoodStars),GoodStars),dtype=AstroFixType)
     return(astrofix)
 
 
@@ -626,221 +1029,243 @@ def check_astrometry(JobNo,log,Nrows,JobList,AstrometryStars):
 #
 #---------------------------------------------------------------------------------------------------
 
-def subtract_stars(JobNo,JobList,log,StarData,StarMatch):
+def subtract_stars(JobNo,JobList,log,StarData,StarMatch,index=None,SkyIndex=None):
     
+    from astropy.coordinates import SkyCoord
+    from astropy import units as u
+    from astropy import wcs
+    from astropy.io import fits
+    from astropy.io import ascii
+    from astropy.table import Table
+
     AOR = JobList['AOR'][JobNo]
     Ch = JobList['Channel'][JobNo]
     Njobs = len(JobList)
     
     #make the list of files for this AOR and Channel
-    LogIDX = ((log['Channel']==Ch) & (log['AOR']==AOR)).nonzero()  # get the indexes of files we should use
+    if index is None:
+        index = read_group_index(['AORChannel'])
+    LogIDX = job_rows(index, JobList, JobNo)  # get the indexes of files we should use
     files = log['Filename'][LogIDX]
     MJDs = log['MJD'][LogIDX]
     RAs  = log['RA'][LogIDX]
     DECs = log['DEC'][LogIDX]
+    DCEs = log['DCE'][LogIDX]
     
     Nframes = len(files)
     
     print('## Begin sub_stars job {:4d} - AOR {:8d} Ch {:}, {:3d} frames'.format(JobNo, AOR, Ch, Nframes))
 
-    for fileNo in range(0,Nframes):
-#    for fileNo in range(5,6):
-        MJD = MJDs[fileNo]
-        frameRA = RAs[fileNo]
-        frameDEC= DECs[fileNo]
-        BCDfilename = files[fileNo]
+    Nskipped = 0  #frames already done from the same inputs
+    Nfailed = 0   #frames whose subtraction gave no image; the job fails after the others are done
+    #the star table and images of the next frames are read ahead (apex reads the images from the page
+    #cache), the products of a frame are written behind it
+    frames = [(files[fileNo], MJDs[fileNo], RAs[fileNo], DECs[fileNo], Ch) for fileNo in range(0,Nframes)]
+    with write_behind() as writer:
+        for fileNo, ((BCDfilename, MJD, frameRA, frameDEC, Ch), frame) in enumerate(prefetch(read_substar_frame, frames)):
 
-        #Get the image center for figuring out which objects to consider
-        ImCenter = SkyCoord(frameRA,frameDEC, frame="fk5", unit="deg")
+            #Get the image center for figuring out which objects to consider
+            ImCenter = SkyCoord(frameRA,frameDEC, frame="fk5", unit="deg")
 
-        if (MJD > WarmMJD):
-            cryo = 0
-        else:
-            cryo = 1
+            basename, cryo, inputs = frame['basename'], frame['cryo'], frame['inputs']
+            FrameCatFile, ImageFile, SubtractedFile = frame['FrameCatFile'], frame['ImageFile'], frame['SubtractedFile']
 
-        #setup  some file names
-        #Setup file suffixes re replace
-        inputSuffix  = '_' + bcdSuffix + '.fits'  #used in search
-        basename = re.sub(inputSuffix,'',re.split('/',BCDfilename)[-1]) #get the base of the filename
+            if frame['current']:
+                Nskipped += 1
+                continue
 
-        outputSuffix = '_' + BrightStarTableSuffix
-        FrameCatFile = re.sub(inputSuffix,outputSuffix,BCDfilename)   # Make the filename for the star catalogs (bright.tbl)
-        
-        outputSuffix = '_' + ffSuffix + '.fits'
-        ImageFile    = re.sub(inputSuffix,outputSuffix,BCDfilename)   # image file
-        
-        outputSuffix = '_' + corUncSuffix + '.fits'
-        SigmaFile    = re.sub(inputSuffix,outputSuffix,BCDfilename)   # unc file
-        
-        outputSuffix = '_' + maskSuffix + '.fits'
-        MaskFile     = re.sub(inputSuffix,outputSuffix,BCDfilename)   # mask file
-        
-        outputSuffix = '_' + starsubSuffix + '.fits'
-        SubtractedFile = re.sub(inputSuffix,outputSuffix,BCDfilename) # star subtracted image file (stbcd.fits)
-        
-        outputSuffix = '_' + starMaskSuffix + '.fits'
-        SubtractedMask = re.sub(inputSuffix,outputSuffix,BCDfilename) # star subtracted mask file (stmsk.fits)
-        
-        #remove output files
-        rmCMD = 'rm -rf ' + SubtractedFile + ' ' + SubtractedMask
-        os.system(rmCMD)
-        
-        #wait for file to be deleted
-        while os.path.exists(SubtractedMask):
-            wait = 1
-        while os.path.exists(SubtractedFile):
-            wait = 1
-        
-        #temporary files
-        pid = os.getpid() #get the PID for temp files
-        processTMPDIR = scratch_dir_prefix(cluster) + 'tmpfiles' + str(pid) + '-' + str(fileNo) + '/'
-        os.system('mkdir -p ' + processTMPDIR)
+            #temporary files
+            pid = os.getpid() #get the PID for temp files
+            processTMPDIR = scratch_dir_prefix(cluster) + 'tmpfiles' + str(pid) + '-' + str(fileNo) + '/'
+            os.system('mkdir -p ' + processTMPDIR)
 #        print(" DEBUG: processTMPDIR is ",processTMPDIR)
 
-        # build some filenames
-        tmpStars = processTMPDIR + str(pid) + ".stars.tbl"
-        residualImage = processTMPDIR + "Mosaic/residual_" + basename + '_' + ffSuffix + '.fits'  # actually the star-subtracted image
-        bandcorrImage = processTMPDIR + "Mosaic/bandcorr_" + basename + '_' + ffSuffix + '.fits'
+            # build some filenames
+            tmpStars = processTMPDIR + str(pid) + ".stars.tbl"
+            residualImage = processTMPDIR + "Mosaic/residual_" + basename + '_' + ffSuffix + '.fits'  # actually the star-subtracted image
+            bandcorrImage = processTMPDIR + "Mosaic/bandcorr_" + basename + '_' + ffSuffix + '.fits'
 
-        #split the bandcorrImage into directory and file so the corrector doesn't truncate the file name if the name is too long
-        bandcorrDIR = processTMPDIR + "Mosaic/"
-        bandcorrFILE = "bandcorr_" + basename + '_' + ffSuffix + '.fits'
+            #split the bandcorrImage into directory and file so the corrector doesn't truncate the file name if the name is too long
+            bandcorrDIR = processTMPDIR + "Mosaic/"
+            bandcorrFILE = "bandcorr_" + basename + '_' + ffSuffix + '.fits'
+            ImageFile = frame_set_fits(ImageFile, processTMPDIR, frame['planes'])[0]   #a file for apex
         
-        #read in the star data for this frame (frame_bright.tbl)
-        FrameStars = ascii.read(FrameCatFile,format="ipac") #read the data for the single frame catalog
+            #read in the star data for this frame (frame_bright.tbl)
+            FrameStars = frame['FrameStars'] #the data for the single frame catalog
 #        print(" DEBUG:  length frame_bright.tbl: ",len(FrameStars))
 #        print(" DEBUG:  length stars.refined.tbl: ",len(StarMatch))
         
-        #match the frame to the refined
-        FrameMatch = SkyCoord(FrameStars['RA']*u.deg,FrameStars['Dec']*u.deg) #put the catalog into the matching format
-
-        BrightSep = StarMatch.separation(ImCenter)                      # Find stars near the frame
-        BrightInFrameMatch = StarMatch[np.where(BrightSep.deg < 0.123)] # Keep only stars near the frame ??? how could you have anything outside the frame???
-        BrightInFrameData = StarData[np.where(BrightSep.deg < 0.123)]   # Keep data from only stars near the frame from refined.tbl
-        idx,d2d,d3d=FrameMatch.match_to_catalog_sky(BrightInFrameMatch) # do the match
-
-        #make a copy of the data
-        chlabel = 'ch' + str(Ch)
-        if (SubtractBrightStars == False):  # set flux to near 0 in order to subtract a non-star
-            BrightInFrameData[chlabel] = 0.0
-        SubtractData = Table([BrightInFrameData['ID'],BrightInFrameData['ra'],BrightInFrameData['dec'],BrightInFrameData[chlabel]],names=('ID','RA','Dec','flux'))
-
-        #put in the positions from this frame
-        if (len(idx)>0):
-            SubtractData['RA'][idx]=FrameStars['RA']
-            SubtractData['Dec'][idx]=FrameStars['Dec']
-
-        # Save the table - with only the bright stars included
-        ascii.write(SubtractData[idx],tmpStars,format="ipac",overwrite=True)
-        fixunits =  "sed -i -e 's/double/ float/g' " + tmpStars
-        os.system(fixunits)
-
-        ### And now for the actual star subtraction: call the star-subtracted image the "residual" image
-        if (len(idx) > 0):
-            print(">> File {:}: subtract {:} bright stars".format(fileNo, len(idx)))
+            #match the frame to the refined
+            FrameMatch = SkyCoord(FrameStars['RA']*u.deg,FrameStars['Dec']*u.deg) #put the catalog into the matching format
+
+            BrightNear = stars_near_frame(StarMatch, SkyIndex, LogIDX[fileNo], ImCenter, BrightStarMargin, 0.123) # Find stars near the frame
+            BrightInFrameMatch = StarMatch[BrightNear] # Keep only stars near the frame, their wings included
+            BrightInFrameData = StarData[BrightNear]   # Keep data from only stars near the frame from refined.tbl
+            idx,d2d,d3d=FrameMatch.match_to_catalog_sky(BrightInFrameMatch) # do the match
+
+            #make a copy of the data
+            chlabel = 'ch' + str(Ch)
+            if (SubtractBrightStars == False):  # set flux to near 0 in order to subtract a non-star
+                BrightInFrameData[chlabel] = 0.0
+            SubtractData = Table([BrightInFrameData['ID'],BrightInFrameData['ra'],BrightInFrameData['dec'],BrightInFrameData[chlabel]],names=('ID','RA','Dec','flux'))
+
+            #put in the positions from this frame
+            if (len(idx)>0):
+                SubtractData['RA'][idx]=FrameStars['RA']
+                SubtractData['Dec'][idx]=FrameStars['Dec']
+
+            # Save the table - with only the bright stars included
+            ascii.write(SubtractData[idx],tmpStars,format="ipac",overwrite=True)
+            fixunits =  "sed -i -e 's/double/ float/g' " + tmpStars
+            os.system(fixunits)
+
+            ### And now for the actual star subtraction: call the star-subtracted image the "residual" image
+            if (len(idx) > 0):
+                print(">> File {:}: subtract {:} bright stars".format(fileNo, len(idx)))
 #            subtractCMD='apex_qa.pl -n subtract_stars.nl  -T ' + ImageFile + ' -E ' + tmpStars + ' -P ' + PRF[cryo][Ch-1] + ' -O ' + processTMPDIR + ' > /dev/null 2>&1'
-            # or, with logfile:
+                # or, with logfile:
 #            logfile = "{:}substar_{:}-{:}.log".format(TMPDIR, JobNo, fileNo)          # in local temp dir
-            logfile = "{:}substar_{:}-{:}.log".format(processTMPDIR, JobNo, fileNo)    # in tmpfile dir
-            subtractCMD='apex_qa.pl -n subtract_stars.nl  -T ' +ImageFile+ ' -E ' +tmpStars+ ' -P ' +PRF[cryo][Ch-1]+ ' -O ' +processTMPDIR+ ' > '+logfile+' 2>&1'
-            os.system(subtractCMD)
+                logfile = "{:}substar_{:}-{:}.log".format(processTMPDIR, JobNo, fileNo)    # in tmpfile dir
+                subtractCMD='apex_qa.pl -n subtract_stars.nl  -T ' +ImageFile+ ' -E ' +tmpStars+ ' -P ' +PRF[cryo][Ch-1]+ ' -O ' +processTMPDIR+ ' > '+logfile+' 2>&1'
+                os.system(subtractCMD)
 #            # for DEBUG purposes: link original file to tempfiles dir
 #            os.system("ln -s "+ ImageFile +" "+ bandcorrDIR)
-        else: 
-            # Nothing to subtract; copy input image to residual image for later work
-            print("#### File {:}: No stars to subtract - copy input image".format(fileNo))
-            os.system("mkdir " + bandcorrDIR)
-            os.system("cp "+ ImageFile +" "+ residualImage)
-
-        if (not os.path.isfile(residualImage)):
-            print("#### ERROR ### {:} not found".format(residualImage))
-            sys.exit()    # Maybe a bit brutal ....
-        
-        if(Ch <= 2):
-            #read in the star star-subtracted (residual) image, if built, or the original
-            subtractedHDU = fits.open(residualImage)
-            subtractedWCS = wcs.WCS(subtractedHDU[0].header)  #read the WCS
-            # read corrected bright star data
-            SubtractData = ascii.read(tmpStars, format="ipac")  #; print(SubtractData)
+            else: 
+                # Nothing to subtract; copy input image to residual image for later work
+                print("#### File {:}: No stars to subtract - copy input image".format(fileNo))
+                os.system("mkdir " + bandcorrDIR)
+                os.system("cp "+ ImageFile +" "+ residualImage)
+
+            if (not os.path.isfile(residualImage)):
+                print("#### ERROR ### {:} not found; temp dir {:} kept".format(residualImage, processTMPDIR))
+                Nfailed += 1
+                continue
+        
+            if(Ch <= 2):
+                #read in the star star-subtracted (residual) image, if built, or the original
+                subtractedHDU = fits.open(residualImage)
+                subtractedWCS = wcs.WCS(subtractedHDU[0].header)  #read the WCS
+                # read corrected bright star data
+                SubtractData = ascii.read(tmpStars, format="ipac")  #; print(SubtractData)
             
-            # If subtracting bright stars, then put flux values into image at subtracted star positions so bandcorr will work;
-            # otherwise let the band corrector work on the flux of the stars
-            Xpos,Ypos = subtractedWCS.wcs_world2pix(SubtractData['RA'],SubtractData['Dec'],1) #get x,y from wcs
-            if (SubtractBrightStars == True):
-                for starIDX in range(0,len(Xpos)):
-                    for dx in range(-1,2):
-                        for dy in range(-3,4):
-                            ypix = int(round(Xpos[starIDX]+dx))
-                            xpix = int(round(Ypos[starIDX]+dy))
-                            if((xpix>=0) and (xpix<=255) and (ypix>=0) and (ypix<=255)):
-                                subtractedHDU[0].data[xpix,ypix]+=SubtractData['flux'][starIDX]
+                # If subtracting bright stars, then put flux values into image at subtracted star positions so bandcorr will work;
+                # otherwise let the band corrector work on the flux of the stars
+                Xpos,Ypos = subtractedWCS.wcs_world2pix(SubtractData['RA'],SubtractData['Dec'],1) #get x,y from wcs
+                if (SubtractBrightStars == True):
+                    for starIDX in range(0,len(Xpos)):
+                        for dx in range(-1,2):
+                            for dy in range(-3,4):
+                                ypix = int(round(Xpos[starIDX]+dx))
+                                xpix = int(round(Ypos[starIDX]+dy))
+                                if((xpix>=0) and (xpix<=255) and (ypix>=0) and (ypix<=255)):
+                                    subtractedHDU[0].data[xpix,ypix]+=SubtractData['flux'][starIDX]
                             
-            #write out the image for the warm band corrector and do the banding correction
-            subtractedHDU.writeto(bandcorrImage,overwrite='True')
-            subtractedHDU.close()
-            bandCorrCMD='cd ' + bandcorrDIR + '; bandcor_warm -f -t 20.0 -b 1 256 1 256 ' + bandcorrFILE + ' > /dev/null 2>&1'
-            os.system(bandCorrCMD)
-        
-            bandcorrHDU = fits.open(bandcorrImage)
-            # If subtracting bright stars, read back in the bandcorrected image, remove the inserted flux
-            if (SubtractBrightStars == True):
+                #write out the image for the warm band corrector and do the banding correction
+                subtractedHDU.writeto(bandcorrImage,overwrite='True')
+                subtractedHDU.close()
+                bandCorrCMD='cd ' + bandcorrDIR + '; bandcor_warm -f -t 20.0 -b 1 256 1 256 ' + bandcorrFILE + ' > /dev/null 2>&1'
+                os.system(bandCorrCMD)
+                if (not os.path.isfile(bandcorrImage)):
+                    print("#### ERROR ### {:} not found; temp dir {:} kept".format(bandcorrImage, processTMPDIR))
+                    Nfailed += 1
+                    continue
+        
+                bandcorrData, bandcorrHeader = read_frame(bandcorrImage)
+                # If subtracting bright stars, read back in the bandcorrected image, remove the inserted flux
+                if (SubtractBrightStars == True):
+                    for starIDX in range(0,len(Xpos)):
+                        for dx in range(-1,2):
+                            for dy in range(-3,4):
+                                ypix = int(round(Xpos[starIDX]+dx))
+                                xpix = int(round(Ypos[starIDX]+dy))
+                                if((xpix>=0) and (xpix<=255) and (ypix>=0) and (ypix<=255)):
+                                    bandcorrData[xpix,ypix]-=SubtractData['flux'][starIDX]
+
+                #Mask the ghost from the bright star
+                starMask, starMaskHeader = frame['planes'][2]
+                StarIndex=np.indices([255,255]) #make an index vector for mask
                 for starIDX in range(0,len(Xpos)):
-                    for dx in range(-1,2):
-                        for dy in range(-3,4):
-                            ypix = int(round(Xpos[starIDX]+dx))
-                            xpix = int(round(Ypos[starIDX]+dy))
-                            if((xpix>=0) and (xpix<=255) and (ypix>=0) and (ypix<=255)):
-                                bandcorrHDU[0].data[xpix,ypix]-=SubtractData['flux'][starIDX]
-            
-            if (not os.path.isfile(bandcorrImage)):
-                print("#### ERROR ### {:} not found".format(bandcorrImage))
-                sys.exit()
-
-            #Mask the ghost from the bright star
-            starMaskHDU = fits.open(MaskFile)
-            StarIndex=np.indices([255,255]) #make an index vector for mask
-            for starIDX in range(0,len(Xpos)):
-                if((Xpos[starIDX]>=-1*PRFghostR[cryo][Ch-1]) and (Xpos[starIDX]<=(255+1*PRFghostR[cryo][Ch-1])) and (Ypos[starIDX]>=-1*PRFghostR[cryo][Ch-1]) and (Ypos[starIDX]<=(255+1*PRFghostR[cryo][Ch-1]))):
-                    gx = Xpos[starIDX] + PRFghostDx[cryo][Ch-1]
-                    gy = Ypos[starIDX] + PRFghostDy[cryo][Ch-1]
-                    GhostMask =np.sqrt(((StarIndex[1]-gx)**2) + ((StarIndex[0]-gy)**2))
-                    starMaskHDU[0].data[(GhostMask<=PRFghostR[cryo][Ch-1]).nonzero()]=32767
-        
-            bandcorrHDU.writeto(SubtractedFile,overwrite='True')  #write out the final star subtracted image
-            bandcorrHDU.close()
-            starMaskHDU.writeto(SubtractedMask,overwrite='True')  #write out the modified star mask
-            starMaskHDU.close()
-            # and build bandcorr.fits (difference image with correction only)
+                    if((Xpos[starIDX]>=-1*PRFghostR[cryo][Ch-1]) and (Xpos[starIDX]<=(255+1*PRFghostR[cryo][Ch-1])) and (Ypos[starIDX]>=-1*PRFghostR[cryo][Ch-1]) and (Ypos[starIDX]<=(255+1*PRFghostR[cryo][Ch-1]))):
+                        gx = Xpos[starIDX] + PRFghostDx[cryo][Ch-1]
+                        gy = Ypos[starIDX] + PRFghostDy[cryo][Ch-1]
+                        GhostMask =np.sqrt(((StarIndex[1]-gx)**2) + ((StarIndex[0]-gy)**2))
+                        starMask[(GhostMask<=PRFghostR[cryo][Ch-1]).nonzero()]=32767
+        
+                #write out the final star subtracted image and the modified star mask, with the noise
+                queue_write(writer, write_frame_set, SubtractedFile, [(bandcorrData, bandcorrHeader), frame['planes'][1], (starMask, starMaskHeader)],
+                            None, [starMaskSuffix])
+                # and build bandcorr.fits (difference image with correction only)
 #            comm=("/home/moneti/softs/python/imsub.py {:} {:} {:}bandcorr.fits".format(bandcorrImage, residualImage, bandcorrDIR)); print(comm)
 #            os.system(comm)
-        else:
-            shutil.move(residualImage,SubtractedFile)
-            shutil.copy(MaskFile,SubtractedMask)
+            else:
+                queue_write(writer, write_frame_set, SubtractedFile, [residualImage, frame['planes'][1], frame['planes'][2]], None, [starMaskSuffix])
 
 #        print(' DEBUG: Wrote star_subtracted frame {:3d}: {:}'.format(fileNo, SubtractedFile.split('/')[-1]))
 #        os.system("rm " + logfile )
-        error = False
+            error = False
 
-        # clean up
-        #wait for file to be in place
-        while os.path.exists(SubtractedMask) == 'False' :
-            wait = 1
-        while os.path.exists(SubtractedFile) == 'False':
-            wait = 1
+            # record the products and clean up, behind the next frame
+            queue_write(writer, record_products, 'subtract_stars', [(DCEs[fileNo], Ch, AOR, suffix, output, inputs) for suffix, output in frame['outputs']])
 
-        if (error == False):
-            cleanupCMD = 'rm -rf ' + processTMPDIR
-            os.system(cleanupCMD)
+            if (error == False):
+                cleanupCMD = 'rm -rf ' + processTMPDIR
+                queue_write(writer, os.system, cleanupCMD)
 
-    print('## Finished job {:4d}: AOR {:8d} Ch {:}'.format(JobNo, AOR, Ch))
+    print('## Finished job {:4d}: AOR {:8d} Ch {:}; {:} frames up to date'.format(JobNo, AOR, Ch, Nskipped))
+    if Nfailed > 0:   #the retry of the job redoes only these frames
+        raise RuntimeError("sub_stars job {:}: no star subtracted image for {:} of {:} frames".format(JobNo, Nfailed, Nframes))
+
+
+#---------------------------------------------------------------------------------------------------
+# File names and input hash of a frame of subtract_stars, and whether its products are up to date;
+# if not its star table, and its image, noise and mask (for apex, from the page cache, with the
+# 'files' layout) are read.  Run by the reader threads
+#---------------------------------------------------------------------------------------------------
+
+def read_substar_frame(item):
+
+    from astropy.io import ascii
+
+    BCDfilename, MJD, frameRA, frameDEC, Ch = item
+
+    #Setup file suffixes re replace
+    inputSuffix  = '_' + bcdSuffix + '.fits'  #used in search
+    frame = {'basename':       re.sub(inputSuffix,'',re.split('/',BCDfilename)[-1]), #get the base of the filename
+             'FrameCatFile':   re.sub(inputSuffix, '_' + BrightStarTableSuffix, BCDfilename),   # the star catalogs (bright.tbl)
+             'ImageFile':      re.sub(inputSuffix, '_' + ffSuffix + '.fits', BCDfilename),      # image file, with its unc and mask
+             'SubtractedFile': re.sub(inputSuffix, '_' + starsubSuffix + '.fits', BCDfilename)} # star subtracted image file (stbcd.fits), with the star mask (stmsk)
+
+    if (MJD > WarmMJD):
+        frame['cryo'] = 0
+    else:
+        frame['cryo'] = 1
+
+    #skip the frame if it was already done from the same image, star tables and PRF
+    frame['inputs'] = input_hash(frame_set_products(frame['ImageFile']) + [frame['FrameCatFile'], RefinedStarCat,
+                                  PRF[frame['cryo']][Ch-1]], (frameRA, frameDEC, SubtractBrightStars))
+    frame['outputs'] = frame_set_outputs(frame['SubtractedFile'], [starMaskSuffix])
+    frame['current'] = products_current([output for suffix, output in frame['outputs']], frame['inputs'])
+    if not frame['current']:
+        frame['FrameStars'] = ascii.read(frame['FrameCatFile'],format="ipac") #read the data for the single frame catalog
+        frame['planes'] = read_frame_set(frame['ImageFile'])
+    return(frame)
+
+
+#the siblings of the sub written with it: the sbunc, and the stmsk with the 'mef' layout, where it is
+#in the file of the stbcd
+SubtractedSiblings = [ScaledUncSuffix] + mef_members(starsubSuffix)
 
 
 #---------------------------------------------------------------------------------------------------
 #
 #---------------------------------------------------------------------------------------------------
 
-def subtract_median(JobNo,JobList,log,AstroFix):
+def subtract_median(JobNo,JobList,log,AstroFix,index=None):
     
+    import scipy.ndimage as ndimage
+    from statsmodels import robust
+    from astropy.io import ascii
+
     AOR = JobList['AOR'][JobNo]
     Ch = JobList['Channel'][JobNo]
     
@@ -852,130 +1277,209 @@ def subtract_median(JobNo,JobList,log,AstroFix):
     repList = list(set(AORinfo['RepName']))
     Nreps = len(repList)
     medianData=np.zeros([Nreps,256,256],dtype=np.double)
+    medFiles = list()
     for repIDX in range(0,Nreps):
         medFile = AORoutput + BackgroundType +'.' + str(AOR) + '.' + repeats[repIDX] + '.ch.' + str(Ch) + '.fits'
-        medHDU = fits.open(medFile)
-        medianData[repIDX]=medHDU[0].data
+        medianData[repIDX]=read_frame(medFile)[0]
+        medFiles.append(medFile)
     
     #make the list of files for this AOR and Channel
-    LogIDX = ((log['Channel']==Ch) & (log['AOR']==AOR)).nonzero()  # get the indexes of files we should use
+    if index is None:
+        index = read_group_index(['AORChannel'])
+    LogIDX = job_rows(index, JobList, JobNo)  # get the indexes of files we should use
     files = log['Filename'][LogIDX]
     DCElist = log['DCE'][LogIDX]
     Nframes = len(files)
 
     print('## Begin subtr_median job {:4d} - AOR {:8d} Ch {:}, {:3d} frames'.format(JobNo, AOR, Ch, Nframes))
 
+    #the offsets and background of each frame; its files are read ahead and written behind
+    frames = list()
     for frame in range(0,Nframes):
-        BCDfilename = files[frame] 
         DCE = DCElist[frame]
 
         #get the offset in RA/DEC
         dRA = np.double(AstroFix['dRA'][(AstroFix['DCE']==DCE).nonzero()])
         dDEC = np.double(AstroFix['dDEC'][(AstroFix['DCE']==DCE).nonzero()])
-        
-        #Setup file suffixes re replace
-        inputSuffix  = '_' + bcdSuffix + '.fits'  #used
-        
-        #set up the file names
-        outputSuffix = '_' + starsubSuffix + '.fits'
-        ImageFile       = re.sub(inputSuffix,outputSuffix,BCDfilename) #Star Subtracted File
-        
-        outputSuffix = '_' + SubtractedSuffix + '.fits'
-        SubtractedFile  = re.sub(inputSuffix,outputSuffix,BCDfilename) #Background subtracted File
-        
-        outputSuffix = '_' + corUncSuffix + '.fits'
-        NoiseFile  = re.sub(inputSuffix,outputSuffix,BCDfilename) #Uncertanty File
-        
-        outputSuffix = '_' + ScaledUncSuffix + '.fits'
-        ScaledNoiseFile = re.sub(inputSuffix,outputSuffix,BCDfilename) #Uncertanty File
-        
-        outputSuffix = '_' + starMaskSuffix + '.fits'
-        MaskFile   = re.sub(inputSuffix,outputSuffix,BCDfilename) #mask File
-        
+
         #figure out the frame to subtract, if not found subtract the first one
         repIDX = AORinfo['RepIndex'][(AORinfo['DCE']==DCE).nonzero()]
         if not(repIDX):  #test if the value was not found and set it to the first median for HDR frames
             repIDX=0
         else:
             repIDX=int(repIDX)
-        
-        #Read image in, subtract median
-#        print("DEBUG: open image file {:} ".format(ImageFile))   #DEBUG
-        imageHDU = fits.open(ImageFile) #Read image
-        imageData = ma.masked_invalid(imageHDU[0].data)
-        imageData= imageData - medianData[repIDX] #Subtract median image
-        
-        #Read the mask
-        maskHDU = fits.open(MaskFile)
-        maskImage=maskHDU[0].data
-        imageData.mask += maskImage.astype(bool)
-        
-        #do some masking to figure out background to subtract
-        #measure stats to clip object
-        goodData = ma.MaskedArray.compressed(imageData)  #kudge to get rid of lower case nans
-        median = ma.median(goodData[np.logical_not(np.isnan(goodData))])
-        rms = robust.mad(goodData[np.logical_not(np.isnan(goodData))])
-        
-        #mask objects to get background
-        maxval = median + 3.0*rms  #Clip at + 3 sigma
-        minval = median - 3.0*rms  #clip at - 3 sigma
-        
-        #object masking
-        objmask = np.zeros([256,256],dtype=np.bool)  #set up a holding variable for the object mask
-        objmask[(imageData >= maxval).nonzero()]=1  #mask bright objects
-        objmask[(imageData <= minval).nonzero()]=1  #mask negative holes
-        objmask = ndimage.binary_dilation(objmask) #grow the mask
-        objmask = ndimage.binary_dilation(objmask) #grow the mask a second time
-        objmask = ndimage.binary_dilation(objmask) #grow the mask a third time
-        imageData.mask += objmask #add it to bad pixel mask
-        
-        #do some masking to figure out background to subtract
-        #re-measure stats after masking objects
-        goodData = ma.MaskedArray.compressed(imageData)  #kudge to get rid of lower case nans
-        median = ma.median(goodData[np.logical_not(np.isnan(goodData))])
-        rms = robust.mad(goodData[np.logical_not(np.isnan(goodData))])
-        
-        imageHDU[0].data= imageHDU[0].data - medianData[repIDX] #Subtract the background image
-        imageHDU[0].data-=median #subtract the median background level
-        imageHDU[0].header['CRVAL1']+=dRA #fix the astrometry
-        imageHDU[0].header['CRVAL2']+=dDEC
-        goodRA = imageHDU[0].header['CRVAL1']
-        goodDE = imageHDU[0].header['CRVAL2']
-        imageHDU.writeto(SubtractedFile,overwrite='True') #write output image
-#        print("DEBUG: wrote sub file  {:} ".format(SubtractedFile))   # DEBUG
-        
-        #scale the RMS to the correct value due to the incorrect bias pedistle
-        #we want the variance of the background and the noise image to match in an additive fassion
-        #The incorrect scaling is due to an additive factor in the vairance that is incorrect
-        
-        #read the rms data and mask it
-        rmsHDU = fits.open(NoiseFile) #read the noise file
-        #print("DEBUG: open noise file {:} ".format(NoiseFile))
-        rmsImage = ma.masked_invalid(rmsHDU[0].data) #mask bad values
-        rmsImage.mask += imageData.mask #apply same mask as used to measure RMS in image, this removes objects and gets rms of the background
-        
-        #measre the average variance in the noise image ad scale
-        goodRMS = ma.MaskedArray.compressed(rmsImage)  #kudge to get rid of lower case nans
-        var = ma.average(np.power(goodRMS,2)) #calcualte the average variance
-        scaleLevel = var-rms*rms #determine the pedistle level
-        #print("DEBUG: Pedestal level: {:}".format(scaleLevel))
-
-        rmsHDU[0].data = np.sqrt(rmsHDU[0].data*rmsHDU[0].data-scaleLevel) #subtract the pedistle
-        rmsHDU[0].header['CRVAL1'] = goodRA  #+=dRA #fix the astrometry
-        rmsHDU[0].header['CRVAL2'] = goodDE  #+=dDEC
-        rmsHDU.writeto(ScaledNoiseFile,overwrite='True') #write output scaled noise
-        #print("DEBUG: wrote scaled noise {:} ".format(ScaledNoiseFile))
-        #print("DEBUG: =======  Finished with frame {:}  ========".format(frame))
+        frames.append((files[frame], DCE, dRA, dDEC, repIDX, AORsubtractFile, medFiles[repIDX]))
+
+    Nskipped = 0  #frames already done from the same inputs
+    with write_behind() as writer:
+        for (BCDfilename, DCE, dRA, dDEC, repIDX, AORsubtractFile, medFile), frame in prefetch(read_submed_frame, frames):
+
+            if frame['current']:
+                Nskipped += 1
+                continue
+
+            #subtract median
+            (image, imageHeader), (noise, noiseHeader), mask = frame['planes']
+            imageData = ma.masked_invalid(image)
+            imageData= imageData - medianData[repIDX] #Subtract median image
+
+            #apply the mask
+            imageData.mask += mask[0].astype(bool)
+
+            #do some masking to figure out background to subtract
+            #measure stats to clip object
+            goodData = ma.MaskedArray.compressed(imageData)  #kudge to get rid of lower case nans
+            median = ma.median(goodData[np.logical_not(np.isnan(goodData))])
+            rms = robust.mad(goodData[np.logical_not(np.isnan(goodData))])
+
+            #mask objects to get background
+            maxval = median + 3.0*rms  #Clip at + 3 sigma
+            minval = median - 3.0*rms  #clip at - 3 sigma
+
+            #object masking
+            objmask = np.zeros([256,256],dtype=np.bool)  #set up a holding variable for the object mask
+            objmask[(imageData >= maxval).nonzero()]=1  #mask bright objects
+            objmask[(imageData <= minval).nonzero()]=1  #mask negative holes
+            objmask = ndimage.binary_dilation(objmask) #grow the mask
+            objmask = ndimage.binary_dilation(objmask) #grow the mask a second time
+            objmask = ndimage.binary_dilation(objmask) #grow the mask a third time
+            imageData.mask += objmask #add it to bad pixel mask
+
+            #do some masking to figure out background to subtract
+            #re-measure stats after masking objects
+            goodData = ma.MaskedArray.compressed(imageData)  #kudge to get rid of lower case nans
+            median = ma.median(goodData[np.logical_not(np.isnan(goodData))])
+            rms = robust.mad(goodData[np.logical_not(np.isnan(goodData))])
+
+            image= image - medianData[repIDX] #Subtract the background image
+            image-=median #subtract the median background level
+            goodRA = imageHeader['CRVAL1'] + dRA #fix the astrometry
+            goodDE = imageHeader['CRVAL2'] + dDEC
+
+            #scale the RMS to the correct value due to the incorrect bias pedistle
+            #we want the variance of the background and the noise image to match in an additive fassion
+            #The incorrect scaling is due to an additive factor in the vairance that is incorrect
+
+            #mask the rms data
+            rmsImage = ma.masked_invalid(noise) #mask bad values
+            rmsImage.mask += imageData.mask #apply same mask as used to measure RMS in image, this removes objects and gets rms of the background
+
+            #measre the average variance in the noise image ad scale
+            goodRMS = ma.MaskedArray.compressed(rmsImage)  #kudge to get rid of lower case nans
+            var = ma.average(np.power(goodRMS,2)) #calcualte the average variance
+            scaleLevel = var-rms*rms #determine the pedistle level
+            #print("DEBUG: Pedestal level: {:}".format(scaleLevel))
+
+            noise = np.sqrt(noise*noise-scaleLevel) #subtract the pedistle
+            #write output image and scaled noise, with the mask, with the fixed astrometry
+            queue_write(writer, write_frame_set, frame['SubtractedFile'], [(image, imageHeader), (noise, noiseHeader), mask],
+                        {'CRVAL1': goodRA, 'CRVAL2': goodDE}, SubtractedSiblings)
+            queue_write(writer, record_products, 'subtract_medians', [(DCE, Ch, AOR, suffix, output, frame['inputs']) for suffix, output in frame['outputs']])
+
+    print('## Finished job {:4d}: AOR {:8d} Ch {:}; {:} frames up to date'.format(JobNo, AOR, Ch, Nskipped))
 
-    print('## Finished job {:4d}: AOR {:8d} Ch {:}'.format(JobNo, AOR, Ch))
+
+#---------------------------------------------------------------------------------------------------
+# File names and input hash of a frame of subtract_median, whether it is up to date, and its image,
+# noise and mask; run by the reader threads ahead of the subtraction
+#---------------------------------------------------------------------------------------------------
+
+def read_submed_frame(item):
+
+    BCDfilename, DCE, dRA, dDEC, repIDX, AORsubtractFile, medFile = item
+
+    #Setup file suffixes re replace
+    inputSuffix  = '_' + bcdSuffix + '.fits'  #used
+    ImageFile       = re.sub(inputSuffix, '_' + starsubSuffix + '.fits', BCDfilename)    #Star Subtracted File, with its noise and mask
+    SubtractedFile  = re.sub(inputSuffix, '_' + SubtractedSuffix + '.fits', BCDfilename) #Background subtracted File, with its siblings
+
+    #skip the frame if it was already done from the same images, background and astrometry
+    inputs = input_hash(frame_set_products(ImageFile) + [AORsubtractFile, medFile], (dRA, dDEC))
+    outputs = frame_set_outputs(SubtractedFile, SubtractedSiblings)
+    frame = {'SubtractedFile': SubtractedFile, 'outputs': outputs, 'inputs': inputs,
+             'current': products_current([output for suffix, output in outputs], inputs)}
+    if not frame['current']:
+        frame['planes'] = read_frame_set(ImageFile, ['CRVAL1','CRVAL2']) #Read image, noise and mask
+    return(frame)
+
+
+#---------------------------------------------------------------------------------------------------
+# Frames of an AOR.chan used for its backgrounds, and the number of repeats at each position
+#---------------------------------------------------------------------------------------------------
+
+def median_frames(log, LogIDX, HDR):
+
+    #in HDR mode grab all files; in standar mode just drop first few exposures that have shorter exposure time
+    if HDR != 'True':
+        ExptimeNormal = np.max(log['ExpTime'][LogIDX][(log['HDR'][LogIDX]=='False').nonzero()])
+        LogIDX = LogIDX[(log['ExpTime'][LogIDX]==ExptimeNormal).nonzero()]  # get the indexes of files we should use with normal exposure times
+
+    # AMo: For each obs, there are Nreps frames obtained at each of Npos positions. The Nreps have
+    # increasing exp times; we assume that the first and shortest is the same for all positions.
+    # There are cases of missing frames; these are solved by hand, by commenting all the frames at
+    # that position.
+    # Figure out the number of repeat observations
+    if HDR == 'True':
+        #If HDR mode just look for different exposure times ... fails when these are all the same
+        #Exptimes = list(set(log['ExpTime'][LogIDX]))
+        #Nreps = len(Exptimes)
+        # ... rather find num occurrences of minimum time, gives num pos
+        Alltimes = log['ExpTime'][LogIDX]
+        Tmin  = Alltimes.min()  # assume always same for each series of repeats
+        Nposn = list(Alltimes).count(Tmin)  # Number of positions
+        Nreps = int(len(Alltimes)/Nposn)     # Number of repeats
+    else:
+        #In normal mode just find the frames with long frame delays, repeats typically have ~2s delays.
+        LongDelays =  np.where(log['FrameDelay'][LogIDX] > 6)  #Find the long delays
+        NumLongDelay = len(log['FrameDelay'][LongDelays]) #Count them
+        Nreps = int(len(LogIDX)/NumLongDelay) #calculate the number of repeats
+
+    return(LogIDX, Nreps)
+
+
+#---------------------------------------------------------------------------------------------------
+# Add to a job list of whole AOR.chans the number of repeats of each (0 if it cannot be found), for
+# the memory estimate of make_medians
+#---------------------------------------------------------------------------------------------------
+
+def add_median_repeats(JobList, log, index):
+
+    Nreps = np.zeros(len(JobList), dtype=int)
+    for JobNo in range(len(JobList)):
+        rows = group_rows(index, 'AORChannel', (JobList['AOR'][JobNo], JobList['Channel'][JobNo]))
+        try:
+            Nreps[JobNo] = median_frames(log, rows, JobList['HDR'][JobNo])[1]
+        except (ValueError, ZeroDivisionError):
+            Nreps[JobNo] = 0
+    JobList['Nreps'] = Nreps
+    return(JobList)
+
+
+#---------------------------------------------------------------------------------------------------
+# Image, header, noise and mask of a frame of make_median_image, read by the reader threads
+#---------------------------------------------------------------------------------------------------
+
+def read_median_frame(BCDfilename):
+
+    #Setup file suffixes re replace
+    inputSuffix  = '_' + bcdSuffix + '.fits'  #used
+    ImageFile  = re.sub(inputSuffix, '_' + starsubSuffix + '.fits', BCDfilename) #Star Subtracted File, with its noise and mask
+
+    (image, header), (noise, noiseHeader), (mask, maskHeader) = read_frame_set(ImageFile, ['FRAMEDLY'])
+    return(image, header, noise, mask)
 
 
 #---------------------------------------------------------------------------------------------------
 #
 #---------------------------------------------------------------------------------------------------
 
-def make_median_image(JobNo, JobList, log, AORlog, debug):
+def make_median_image(JobNo, JobList, log, AORlog, debug, index=None):
     
+    import scipy.ndimage as ndimage
+    from statsmodels import robust
+    from astropy.io import ascii
+    from astropy.table import Table
+
     if (debug == 1):
         print("### ACTIVATED DEBUG MODE ###")
 
@@ -984,14 +1488,13 @@ def make_median_image(JobNo, JobList, log, AORlog, debug):
     HDR = JobList['HDR'][JobNo]
 
     #make the list of files for this AOR and Channel
+    if index is None:
+        index = read_group_index(['AORChannel'])
+    LogIDX = group_rows(index, 'AORChannel', (AOR, Ch))  # get the indexes of files we should use
+    LogIDX, Nreps = median_frames(log, LogIDX, HDR)  # in standard mode without the short first exposures
     if HDR == 'True':
-        #in HDR mode grab all files
-        LogIDX = ((log['Channel']==Ch) & (log['AOR']==AOR)).nonzero()  # get the indexes of files we should use
         hdrm = "mode HDR"
     else:
-        #in standar mode just drop first few exposures that have shorter exposure time
-        ExptimeNormal = np.max(log['ExpTime'][((log['Channel']==Ch) & (log['AOR']==AOR) & (log['HDR']=='False')).nonzero()])
-        LogIDX = ((log['Channel']==Ch) & (log['AOR']==AOR) & (log['ExpTime']==ExptimeNormal)).nonzero()  # get the indexes of files we should use with normal exposure times
         hdrm = "mode STD"
     
     files = log['Filename'][LogIDX]
@@ -1006,26 +1509,6 @@ def make_median_image(JobNo, JobList, log, AORlog, debug):
     maskImages = np.zeros([Nframes,256,256],dtype=np.int) #image masks
     DelayTimes = np.zeros([Nframes],dtype=np.double) # list of frame delay times
 
-    # AMo: For each obs, there are Nreps frames obtained at each of Npos positions. The Nreps have
-    # increasing exp times; we assume that the first and shortest is the same for all positions.
-    # There are cases of missing frames; these are solved by hand, by commenting all the frames at
-    # that position.
-    # Figure out the number of repeat observations
-    if HDR == 'True':
-        #If HDR mode just look for different exposure times ... fails when these are all the same
-        #Exptimes = list(set(log['ExpTime'][LogIDX]))
-        #Nreps = len(Exptimes)
-        # ... rather find num occurrences of minimum time, gives num pos
-        Alltimes = log['ExpTime'][LogIDX]
-        Tmin  = Alltimes.min()  # assume always same for each series of repeats
-        Nposn = list(Alltimes).count(Tmin)  # Number of positions
-        Nreps = int(len(Alltimes)/Nposn)     # Number of repeats
-    else:
-        #In normal mode just find the frames with long frame delays, repeats typically have ~2s delays.
-        LongDelays =  np.where(log['FrameDelay'][LogIDX] > 6)  #Find the long delays
-        NumLongDelay = len(log['FrameDelay'][LongDelays]) #Count them
-        Nreps = int(Nframes/NumLongDelay) #calculate the number of repeats
-
     NrepFrames = int(Nframes/Nreps) #Calculate the number of repeated frames
 
     if HDR == 'True':
@@ -1045,32 +1528,28 @@ def make_median_image(JobNo, JobList, log, AORlog, debug):
         print('WARNING: Total number of frames {:}, number of repeats {:}, and repeats per frame {:} disagree!'.format(Nframes, NrepFrames, Nreps))
         print('         Found {:} frames, expected {:} '.format(Nframes, NrepFrames*Nreps))
 
+    #skip the job if the backgrounds were already made from the same frames and clipping
+    inputSuffix = '_' + bcdSuffix + '.fits'
+    InputFiles = [product for BCDfilename in files for product in frame_set_products(re.sub(inputSuffix, '_' + starsubSuffix + '.fits', BCDfilename))]
+    inputs = input_hash(InputFiles, (HDR, Nreps, ClipSigmaPos, ClipSigmaNeg, Ndilation))
+    AORsubtractFile = AORoutput + 'files.' + str(AOR) + '.ch.' + str(Ch) + '.tbl'
+    Products = [(0, Ch, AOR, 'repeats', AORsubtractFile, inputs)]
+    for repIDX in range(0,Nreps):
+        for background in ('average', 'median'):
+            Products.append((0, Ch, AOR, background, AORoutput + background + '.' + str(AOR) + '.' + repeats[repIDX] + '.ch.' + str(Ch) + '.fits', inputs))
+    if products_current([product[4] for product in Products], inputs):
+        print('## Finished job {:4d}: AOR {:8d} Ch {:}; backgrounds up to date'.format(JobNo, AOR, Ch))
+        return
+
+    #the files of the next frames are read while one is clipped
+    for frame, (BCDfilename, (image, header, noise, mask)) in enumerate(prefetch(read_median_frame, files)):
 
-    for frame in range(0,Nframes):
-        BCDfilename = files[frame]
-        
-        #Setup file suffixes re replace
-        inputSuffix  = '_' + bcdSuffix + '.fits'  #used
-        
-        outputSuffix = '_' + starsubSuffix + '.fits'
-        ImageFile  = re.sub(inputSuffix,outputSuffix,BCDfilename) #Star Subtracted File
+        imageData[frame]=ma.masked_invalid(image)  #create masked array with NaN's masked
+        DelayTimes[frame]=header['FRAMEDLY'] #get the frame delays to figure out repeats
         
-        outputSuffix = '_' + corUncSuffix + '.fits'
-        NoiseFile  = re.sub(inputSuffix,outputSuffix,BCDfilename) #Uncertanty File
+        ivarImages[frame]=np.power(noise,-2)
         
-        outputSuffix = '_' + starMaskSuffix + '.fits'
-        MaskFile   = re.sub(inputSuffix,outputSuffix,BCDfilename) #mask File
-        
-        #Read image
-        imageHDU = fits.open(ImageFile)
-        imageData[frame]=ma.masked_invalid(imageHDU[0].data)  #create masked array with NaN's masked
-        DelayTimes[frame]=imageHDU[0].header['FRAMEDLY'] #get the frame delays to figure out repeats
-        
-        imageHDU = fits.open(NoiseFile)
-        ivarImages[frame]=np.power(imageHDU[0].data,-2)
-        
-        imageHDU = fits.open(MaskFile)
-        maskImages[frame]=imageHDU[0].data
+        maskImages[frame]=mask
         
         #measure stats
         median = ma.median(np.nan_to_num(imageData[frame]))
@@ -1109,8 +1588,9 @@ def make_median_image(JobNo, JobList, log, AORlog, debug):
             repNameList.append([files[frameIDX],DCElist[frameIDX],AOR,Ch,repeats[repIDX],repIDX])
             frameIDX +=1
     AORsubtractTable=Table(rows=repNameList,names=['Filename','DCE','AOR','Channel','RepName','RepIndex'])
-    AORsubtractFile = AORoutput + 'files.' + str(AOR) + '.ch.' + str(Ch) + '.tbl'
-    ascii.write(AORsubtractTable,AORsubtractFile,format="ipac",overwrite=True)
+    tmpfile = AORsubtractFile + '.' + str(os.getpid()) + '.tmp'   #per process: another run of the job may write it too
+    ascii.write(AORsubtractTable,tmpfile,format="ipac",overwrite=True)
+    replace_if_changed(tmpfile, AORsubtractFile)
 
     if (Nreps > 1):
         #reorder data into repeates
@@ -1156,7 +1636,7 @@ def make_median_image(JobNo, JobList, log, AORlog, debug):
             #write the output file
             outputFile = AORoutput + 'average.' + str(AOR) + '.' + repeats[repIDX] + '.ch.' + str(Ch) + '.fits'
             print(' . Writing ' + outputFile, end=' ... ')
-            fits.writeto(outputFile,output_data,overwrite='True')
+            write_frame(outputFile, output_data)
             
             #make the output background
             output_image=ma.median(ReorgImageData[repIDX],axis=0) #median works better for outliers
@@ -1165,7 +1645,7 @@ def make_median_image(JobNo, JobList, log, AORlog, debug):
             #write the output file
             outputFile = AORoutput + 'median.' + str(AOR) + '.' + repeats[repIDX] + '.ch.' + str(Ch) + '.fits'
             print(outputFile.split('/')[-1])
-            fits.writeto(outputFile,output_data,overwrite='True')
+            write_frame(outputFile, output_data)
     else:
         repIDX=0
         #calculate median images and stdev
@@ -1187,7 +1667,7 @@ def make_median_image(JobNo, JobList, log, AORlog, debug):
         
         #write the output file
         outputAve = AORoutput + 'average.' + str(AOR) + '.' + repeats[repIDX] + '.ch.' + str(Ch) + '.fits'
-        fits.writeto(outputAve,output_data,overwrite='True')
+        write_frame(outputAve, output_data)
         
         #make the output background
         output_image=ma.median(imageData,axis=0) #median works better
@@ -1195,9 +1675,10 @@ def make_median_image(JobNo, JobList, log, AORlog, debug):
         
         #write the output file
         outputMedi = AORoutput + 'median.' + str(AOR) + '.' + repeats[repIDX] + '.ch.' + str(Ch) + '.fits'
-        fits.writeto(outputMedi,output_data,overwrite='True')
+        write_frame(outputMedi, output_data)
         print('==> Wrote {:} and {:} '.format(outputAve, outputMedi.split('/')[-1]))
 
+    record_products('make_medians', Products)
     print('## Finished job {:4d}: AOR {:8d} Ch {:}'.format(JobNo, AOR, Ch))
 
 
@@ -1269,8 +1750,7 @@ def find_outlier_tile(JobNo, JobList, debug):
     if os.path.dirname(processTMPDIR):
         if debug == 1: print("DEBUG: Clean temp dir {:} created".format(processTMPDIR))
     else:
-        print("## ERROR: could not create temp dir {:} .... quitting".format(processTMPDIR))
-        sys.exit(3)
+        raise RuntimeError("could not create temp dir {:}".format(processTMPDIR))
     
     print("## Begin find_outliers job {:} for tile {:}, chan {:}, {:} frames ; tmpdir is {:}".format(JobNo, Tile, Ch, Nframes,  processTMPDIR))
 
@@ -1289,7 +1769,9 @@ def find_outlier_tile(JobNo, JobList, debug):
     os.system(cmd)
     
     #-----------------------------------------------------------------------------
-    # mopex work done, now copy the files to their proper places in the $WRK
+    # mopex work done, now copy the files to their proper places in the $WRK; with
+    # CompressProducts the mosaic_unc and mosaic_std are tile-compressed (not the
+    # mosaic and mosaic_cov that swarp reads, nor the rmasks that mopex reads)
     #-----------------------------------------------------------------------------
     basename = "{:}{:}.irac.tile.{:}.{:}".format(OutputDIR, PIDname, Tile, Ch)
     print(">> Products root name: {:}".format(basename))
@@ -1298,28 +1780,28 @@ def find_outlier_tile(JobNo, JobList, debug):
     inf = processTMPDIR + '/Combine-mosaic/mosaic.fits'; 
     out = basename + '.mosaic.fits'
     if os.path.isfile(inf):  
-        shutil.copy(inf, out)
+        copy_product(inf, out)
     else:
         print("## ERROR: {:} not found".format(inf)); cperrs += 1
     
     inf = processTMPDIR + '/Combine-mosaic/mosaic_unc.fits'
     out = basename + '.mosaic_unc.fits'
     if os.path.isfile(inf):  
-        shutil.copy(inf, out)
+        copy_product(inf, out)
     else:
         print("## ERROR: {:} not found".format(inf)); cperrs += 1
 
     inf = processTMPDIR + '/Combine-mosaic/mosaic_cov.fits'
     out = basename + '.mosaic_cov.fits'
     if os.path.isfile(inf):  
-        shutil.copy(inf, out)
+        copy_product(inf, out)
     else:
         print("## ERROR: {:} not found".format(inf)); cperrs += 1
     
     inf = processTMPDIR + '/Combine-mosaic/mosaic_std.fits'
     out = basename + '.mosaic_std.fits'
     if os.path.isfile(inf):  
-        shutil.copy(inf, out)
+        copy_product(inf, out)
     else:
         print("## ERROR: {:} not found".format(inf)); cperrs += 1
 
@@ -1331,27 +1813,31 @@ def find_outlier_tile(JobNo, JobList, debug):
     #-----------------------------------------------------------------------------
     RMaskOutdir = RMaskDir + 'tile_{:}/'.format(Tile)
     os.system('mkdir -p ' + RMaskOutdir)
+    forget_products(RmaskTileProduct, RMaskOutdir)   #the rows of a previous run: the tile is recorded again once complete
 
     print('>> Look for Rmask files to move')
     RMaskImages = processTMPDIR + '/Rmask-mosaic/'
-    fileList = TMPDIR + "rmasks_to_move_job_{:}.lst".format(JobNo)
-    findCmd  = "find {:} -name '*_rmask.fits' > {:}".format(RMaskImages, fileList)
-    if debug == 1: print("DEBUG: {:}".format(findCmd))
-    os.system(findCmd)
+    log = read_log()
+    FrameStems = frame_stems(log)
+    Products = list()  #rmasks of this tile, with the DCE of their frame, for the manifest
     nmoved = 0
-    with open(fileList, 'r') as file:
-        for line in file:
-            fin = line.strip('\n')
-            fout = fin.split('/')[-1]
-            if debug == 1: print("DEBUG: shutil.copy({:}, {:})".format(fin, RMaskOutdir+fout))
-            shutil.copy(fin, RMaskOutdir + fout)
+    for (dirpath, dirnames, filenames) in os.walk(RMaskImages):
+        for fout in filenames:
+            if not fout.endswith('_' + rmaskSuffix + '.fits'):
+                continue
+            fin = os.path.join(dirpath, fout)
+            if debug == 1: print("DEBUG: copy_product({:}, {:})".format(fin, RMaskOutdir+fout))
+            copy_product(fin, RMaskOutdir + fout)
             nmoved += 1
+            row = frame_row(FrameStems, fout)
+            if row is not None:
+                Products.append((log['DCE'][row], log['Channel'][row], log['AOR'][row], RmaskTileProduct, RMaskOutdir + fout))
+    record_products('find_outliers', Products)
     if (nmoved == 0):
         print("## ERROR: Found no rmask files for tile {:}, chan {:}".format(Tile, Ch))
         cperrs += 1
     else:
         print(">> Copied {:} rmask files from {:} to {:}".format(nmoved, RMaskImages, RMaskOutdir))
-    os.system("rm " + fileList) 
 
     #-----------------------------------------------------------------------------
     # cp the median_mosaic products to the output dir
@@ -1360,14 +1846,14 @@ def find_outlier_tile(JobNo, JobList, debug):
     inf = processTMPDIR + '/Combine-mosaic/median_mosaic.fits'
     out = medmosaic = basename  + '.median_mosaic.fits'
     if os.path.isfile(inf):  
-        shutil.copy(inf, out)
+        copy_product(inf, out)
     else:
         print("## ERROR: {:} not found".format(inf)); cperrs += 1
 
     inf = processTMPDIR + '/Combine-mosaic/median_mosaic_unc.fits'
     out = medmosaicunc = basename + '.median_mosaic_unc.fits'
     if os.path.isfile(inf):  
-        shutil.copy(inf, out)
+        copy_product(inf, out)
     else:
         print("## ERROR: {:} not found".format(inf)); cperrs += 1
     
@@ -1377,7 +1863,7 @@ def find_outlier_tile(JobNo, JobList, debug):
     if cperrs > 0:
         print("## Found {:} ERRORs in find_outliers job {:} ... see {:} for details.".format(cperrs, JobNo, logfile))
         print("## tempdir {:} NOT deleted".format(processTMPDIR))
-        sys.exit(3)
+        raise RuntimeError("find_outliers job {:}: {:} products not found".format(JobNo, cperrs))
     else:
         print(">> Copied  {:}.median_mosaic*.fits to {:}".format(basename, OutputDIR))
         print("## Finished job {:} succesfully; delete its tempdir.".format(JobNo))
@@ -1385,6 +1871,29 @@ def find_outlier_tile(JobNo, JobList, debug):
         os.system(cleanupCMD)
 
 
+#---------------------------------------------------------------------------------------------------
+# Map the files mopex derives from the frames (e.g. the tile rmasks) back to their row in the log by 
+# name: the derived name starts with the frame name stripped of its _bcd.fits ending
+#---------------------------------------------------------------------------------------------------
+
+RmaskTileProduct = 'tile_' + rmaskSuffix  # manifest product name of the per-tile rmasks
+
+def frame_stems(log):
+
+    inputSuffix = '_' + bcdSuffix + '.fits'
+    return(dict((re.sub(inputSuffix, '', filename.split('/')[-1]), row) for row, filename in enumerate(log['Filename'])))
+
+
+def frame_row(FrameStems, filename):
+
+    stem = filename.split('/')[-1]
+    while stem:
+        if stem in FrameStems:
+            return(FrameStems[stem])
+        stem = stem.rpartition('_')[0]
+    return(None)
+
+
 #---------------------------------------------------------------------------------------------------
 #used to flag rmask files in multiple outlier rejection tiles above
 #---------------------------------------------------------------------------------------------------
@@ -1393,9 +1902,7 @@ def get_rmask_dce(FileNo, RmaskFileList):
 
     RmaskFile = RmaskFileList['Filename'][FileNo] #get the file name
     
-    imageHDU = fits.open(RmaskFile) #Read image
-    DCEnumber = imageHDU[0].header.get('DCEID') #Read the DCE number
-    imageHDU.close()
+    DCEnumber = read_frame_header(RmaskFile, ['DCEID']).get('DCEID') #Read the DCE number
     return(DCEnumber)
 
 
@@ -1403,12 +1910,12 @@ def get_rmask_dce(FileNo, RmaskFileList):
 # used to combine the rmaks together into single files and copy them back to the data directory
 #---------------------------------------------------------------------------------------------------
 
-def combine_rmasks(JobNo, RmaskFileList, log):
+def combine_rmasks(JobNo, RmaskFiles, log):
 
     DCE =  log['DCE'][JobNo]
     Ch = log['Channel'][JobNo]
     basefilename = log['Filename'][JobNo]
-    RMaskFiles = list(set(RmaskFileList['Filename'][(RmaskFileList['DCE']==DCE).nonzero()]))
+    RMaskFiles = sorted(RmaskFiles.get(DCE, ()))   #the rmask files of the tiles, by DCE
     Nfiles = len(RMaskFiles)
 #    print("## Begin job {:} with {:} files".format(JobNo, Nfiles))
     
@@ -1422,16 +1929,15 @@ def combine_rmasks(JobNo, RmaskFileList, log):
         
         Rmask_data = np.zeros([256,256], dtype=np.uint8)
         for rmask in RMaskFiles: # here we do the actual combination
-            imageHDU = fits.open(rmask)
-            Rmask_data = Rmask_data | imageHDU[0].data #copy over the mask data in the overlapping area, set rest to 0
+            data, header = read_product(rmask)
+            Rmask_data = Rmask_data | data #copy over the mask data in the overlapping area, set rest to 0
 
-        imageHDU[0].data = Rmask_data
-        imageHDU.writeto(outputRMask,overwrite='True')
-        imageHDU.close()
+        write_product(outputRMask, Rmask_data, header)
         # check that array is not null everywhere
         if (Rmask_data.max() == 0):
             print("PROBLEM: max is null for frame {:}".format(Rmask_data))
         print("## Finished job {:} with {:} tiles - wrote combined Rmask to {:}".format(JobNo, Nfiles, outputRMask))
+        return((DCE, Ch, log['AOR'][JobNo], rmaskSuffix, outputRMask))
 
 #---------------------------------------------------------------------------------------------------
 #
@@ -1489,28 +1995,28 @@ def build_mosaic(Ch):
     inf = processTMPDIR + 'Combine-mosaic/mosaic.fits'
     out = basename + '.mosaic.fits'
     if os.path.isfile(inf):  
-        shutil.copy(inf, out)
+        copy_product(inf, out)
     else:
         print("## ERROR: {:} not found".format(inf)); cperrs = 1
 
     inf = processTMPDIR + 'Combine-mosaic/mosaic_unc.fits'
     out = basename + '.mosaic_unc.fits'
     if os.path.isfile(inf):  
-        shutil.copy(inf, out)
+        copy_product(inf, out)
     else:
         print("## ERROR: {:} not found".format(inf)); cperrs = 1
 
     inf = processTMPDIR + 'Combine-mosaic/mosaic_cov.fits'
     out = basename + '.mosaic_cov.fits'
     if os.path.isfile(inf):  
-        shutil.copy(inf, out)
+        copy_product(inf, out)
     else:
         print("## ERROR: {:} not found".format(inf)); cperrs = 1
 
     inf = processTMPDIR + 'Combine-mosaic/mosaic_std.fits'
     out = basename + '.mosaic_std.fits'
     if os.path.isfile(inf):  
-        shutil.copy(inf, out)
+        copy_product(inf, out)
     else:
         print("## ERROR: {:} not found".format(inf)); cperrs = 1
 
@@ -1518,14 +2024,14 @@ def build_mosaic(Ch):
     inf = processTMPDIR + 'Combine-mosaic/median_mosaic.fits'
     out = basename + '.median_mosaic.fits'
     if os.path.isfile(inf):
-        shutil.copy(inf, out)
+        copy_product(inf, out)
     else:
         print("## WARNING: optional {:} not found.".format(inf))  #; cperrs = 1
 
     inf = processTMPDIR + 'Combine-mosaic/median_mosaic_unc.fits'
     out = basename + '.median_mosaic_unc.fits'
     if os.path.isfile(inf):
-        shutil.copy(inf, out)
+        copy_product(inf, out)
     else:
         print("## WARNING: optional {:} not found.".format(inf))  #; cperrs = 1
     
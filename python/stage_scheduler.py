@@ -0,0 +1,297 @@
+#-----------------------------------------------------------------------------
+# module stage_scheduler.py (par)
+#-----------------------------------------------------------------------------
+# Run the frame stages, from the first frame correction to the median
+# subtraction, as one graph of jobs on one pool of workers.  Each job waits
+# only for what it really needs:
+#   ffcorr(chunk) -> find_stars(chunk) -> [merge_stars] -> subtract_stars(chunk)
+#     -> make_medians(AOR.ch, all chunks) -> subtract_medians(chunk)
+#   find_stars(AOR, all chunks) -> fix_astrometry(AOR.exposure) -> subtract_medians(chunk)
+# where the chunks are the jobs of frames of an AOR.ch (see make_joblist);
+# make_medians needs the whole AOR.ch.  merge_stars is the only barrier, so an
+# AOR can be in make_medians while another is still in ffcorr.  The jobs on the longest predicted paths start
+# first (see job_timing).  The job lists and AstrometryFixFile are written
+# as by the stage scripts, so single stages can still be rerun with them.
+# Failed or timed out tasks are retried, late ones duplicated (not
+# merge_stars), and those that failed in the end are listed in
+# jobs.stage_scheduler.failed.tbl.
+#-----------------------------------------------------------------------------
+
+from supermopex import *
+from spitzer_pipeline_functions import *
+
+import sys, os
+import numpy as np
+from astropy.table import Table
+from optparse import OptionParser
+
+import job_executor
+from job_executor import run_graph, write_failures
+from job_timing import predict_times, predict_timeouts, job_features, record_timings
+from product_manifest import merge_local_manifest
+from job_memory import predict_memory, memory_budget
+import first_frame_corr_function, find_stars_function, subtract_stars_function
+import make_medians_function, fix_astrometry_function, subtract_medians_function
+
+# stages run as jobs: module with load_stage_data / run_job, and the job list of the AOR.channel ones;
+# all but make_medians run on chunks of frames
+StageModules = {'ffcorr':           first_frame_corr_function,
+                'find_stars':       find_stars_function,
+                'subtract_stars':   subtract_stars_function,
+                'make_medians':     make_medians_function,
+                'fix_astrometry':   fix_astrometry_function,
+                'subtract_medians': subtract_medians_function}
+
+StageJobLists = {'ffcorr':           OutputDIR + 'jobs.ffcorr.tbl',
+                 'find_stars':       OutputDIR + 'jobs.find_stars.tbl',
+                 'subtract_stars':   OutputDIR + 'jobs.sub_stars.tbl',
+                 'make_medians':     OutputDIR + 'jobs.medians.tbl',
+                 'subtract_medians': OutputDIR + 'jobs.subtract_medians'}
+
+StageOptions = {'subtract_medians': {'astrometry': False}}
+
+# global stages, run as scripts
+BarrierScripts = {'merge_stars': 'merge_stars.py'}
+
+# stages whose data exists before the graph runs: loaded once by the scheduler, before the workers
+# are forked; subtract_stars reads the catalog of merge_stars, so its workers load it themselves
+PreloadStages = ['ffcorr', 'find_stars', 'make_medians', 'fix_astrometry', 'subtract_medians']
+
+LoadedStages = set()   # stage data loaded in this (worker) process
+
+
+def load_stage(stage):
+
+    if stage not in LoadedStages:
+        StageModules[stage].load_stage_data(**StageOptions.get(stage, {}))
+        LoadedStages.add(stage)
+
+
+#---------------------------------------------------------------------------------------------------
+# One task (stage, JobNo) in a worker: load the stage data if not inherited, then run the job.
+# For subtract_medians the astrometry corrections of the AOR come with the task
+#---------------------------------------------------------------------------------------------------
+
+def run_task(task, AstroFix=None):
+
+    stage, JobNo = task
+    if stage in BarrierScripts:
+        status = os.system(pythonCMD + ' ' + BarrierScripts[stage])
+        if status != 0:
+            raise RuntimeError("{:} exited with status {:}".format(BarrierScripts[stage], status))
+        return(None)
+
+    module = StageModules[stage]
+    load_stage(stage)
+    if AstroFix is not None:
+        module.AstroFix = AstroFix
+    return(module.run_job(JobNo))
+
+
+#---------------------------------------------------------------------------------------------------
+# The job lists of the stages, by stage: chunks of AOR.channel, AOR.channel jobs for make_medians,
+# exposures, and one job for merge_stars
+#---------------------------------------------------------------------------------------------------
+
+def stage_joblists(ChunkJobs, JobList, ExposureJobs):
+
+    joblists = dict((stage, ChunkJobs) for stage in StageJobLists)
+    joblists['make_medians'] = JobList
+    joblists['fix_astrometry'] = ExposureJobs
+    joblists['merge_stars'] = Table(rows=[[0, np.sum(JobList['NumFrames'])]], names=['Channel','NumFrames'])
+    return(joblists)
+
+
+#---------------------------------------------------------------------------------------------------
+# Build the graph: the tasks each one waits for, and the tasks in the order they should start.
+# That is by decreasing rank, the predicted time of the task plus the longest predicted chain of
+# tasks after it, so the longest remaining paths start first (LPT over the graph)
+#---------------------------------------------------------------------------------------------------
+
+def make_graph(ChunkJobs, JobList, ExposureJobs):
+
+    depends = dict()
+    AORfind = dict()    #find_stars tasks of each AOR
+    AORfix = dict()     #fix_astrometry tasks of each AOR
+    ChunkSub = dict()   #subtract_stars tasks of each AOR.channel
+    for JobNo, (AOR, Ch) in enumerate(zip(ChunkJobs['AOR'], ChunkJobs['Channel'])):
+        depends[('ffcorr', JobNo)] = []
+        depends[('find_stars', JobNo)] = [('ffcorr', JobNo)]
+        depends[('subtract_stars', JobNo)] = [('merge_stars', 0)]
+        AORfind.setdefault(AOR, list()).append(('find_stars', JobNo))
+        ChunkSub.setdefault((AOR, Ch), list()).append(('subtract_stars', JobNo))
+    depends[('merge_stars', 0)] = [('find_stars', JobNo) for JobNo in range(len(ChunkJobs))]
+    AORmedian = dict()  #make_medians task of each AOR.channel
+    for JobNo, (AOR, Ch) in enumerate(zip(JobList['AOR'], JobList['Channel'])):
+        depends[('make_medians', JobNo)] = ChunkSub.get((AOR, Ch), [])
+        AORmedian[(AOR, Ch)] = ('make_medians', JobNo)
+    for JobNo, AOR in enumerate(ExposureJobs['AOR']):
+        depends[('fix_astrometry', JobNo)] = AORfind.get(AOR, [])
+        AORfix.setdefault(AOR, list()).append(('fix_astrometry', JobNo))
+    for JobNo, (AOR, Ch) in enumerate(zip(ChunkJobs['AOR'], ChunkJobs['Channel'])):
+        depends[('subtract_medians', JobNo)] = [AORmedian[(AOR, Ch)]] + AORfix.get(AOR, [])
+
+    predicted = dict()
+    for stage, joblist in stage_joblists(ChunkJobs, JobList, ExposureJobs).items():
+        for JobNo, seconds in enumerate(predict_times(stage, joblist)):
+            predicted[(stage, JobNo)] = seconds
+
+    dependents = dict((task, list()) for task in depends)
+    for task, before in depends.items():
+        for other in before:
+            dependents[other].append(task)
+    rank = dict()
+    def task_rank(task):
+        if task not in rank:
+            rank[task] = predicted[task] + max([task_rank(after) for after in dependents[task]] + [0.0])
+        return(rank[task])
+
+    tasks = sorted(depends, key=lambda task: -task_rank(task))
+    return(tasks, depends)
+
+
+#---------------------------------------------------------------------------------------------------
+# Predicted peak memory of each task
+#---------------------------------------------------------------------------------------------------
+
+def task_memory(ChunkJobs, JobList, ExposureJobs):
+
+    memory = dict()
+    for stage, joblist in stage_joblists(ChunkJobs, JobList, ExposureJobs).items():
+        for JobNo, GB in enumerate(predict_memory(stage, joblist)):
+            memory[(stage, JobNo)] = GB
+    return(memory)
+
+
+#---------------------------------------------------------------------------------------------------
+# Timeouts and expected run times of the tasks of the stages timed before; the barrier scripts are
+# never duplicated
+#---------------------------------------------------------------------------------------------------
+
+def task_timeouts(ChunkJobs, JobList, ExposureJobs):
+
+    timeouts, expected = dict(), dict()
+    for stage, joblist in stage_joblists(ChunkJobs, JobList, ExposureJobs).items():
+        predicted = predict_times(stage, joblist)
+        stagetimeouts = predict_timeouts(stage, joblist, predicted)
+        if stagetimeouts is None:
+            continue
+        for JobNo in range(len(joblist)):
+            timeouts[(stage, JobNo)] = stagetimeouts[JobNo]
+            expected[(stage, JobNo)] = predicted[JobNo]
+    for stage in BarrierScripts:
+        expected[(stage, 0)] = float('inf')
+    return(timeouts, expected)
+
+
+#---------------------------------------------------------------------------------------------------
+# Record the wall times and peak memory of the tasks that ran, by stage
+#---------------------------------------------------------------------------------------------------
+
+def record_graph_timings(results, ChunkJobs, JobList, ExposureJobs):
+
+    for stage, joblist in stage_joblists(ChunkJobs, JobList, ExposureJobs).items():
+        channel, hdr, nframes = job_features(joblist)
+        record_timings(stage, [(channel[JobNo], hdr[JobNo], nframes[JobNo], elapsed, job_executor.JobPeaks.get((stage, JobNo)))
+                               for ((name, JobNo), status, elapsed, message, value) in results if (name == stage) and (status == 'ok')])
+
+
+#---------------------------------------------------------------------------------------------------
+# Offsets of the exposures done so far, as an AstroFixType array by job (zero if not done); with
+# tasks, only those of the fix_astrometry tasks among them are filled in, in the given array
+#---------------------------------------------------------------------------------------------------
+
+def exposure_offsets(values, Njobs, tasks=None, results=None):
+
+    if results is None:
+        results = np.zeros(Njobs, dtype=AstroFixType)
+    for (stage, JobNo) in (values if tasks is None else tasks):
+        if (stage == 'fix_astrometry') and ((stage, JobNo) in values):
+            results[JobNo] = values[(stage, JobNo)]
+    return(results)
+
+
+#---------------------------------------------------------------------------------------------------
+# Run the graph on Nworkers processes, with the stage data loaded before they are forked and within
+# the memory budget; record the timings and list the failures.  The products the tasks recorded on
+# this node go to the shared manifest as each task ends.  Returns the results of run_graph, one per task
+#---------------------------------------------------------------------------------------------------
+
+def run_stages(tasks, depends, ChunkJobs, JobList, ExposureJobs, Nworkers, argument=None):
+
+    #the workers inherit the stage data
+    for stage in PreloadStages:
+        load_stage(stage)
+    job_executor.JobPeaks.clear()
+    print(">> Running {:} tasks for {:} AOR.channels in {:} chunks and {:} exposures with {:} workers".format(len(tasks), len(JobList), len(ChunkJobs), len(ExposureJobs), Nworkers))
+    timeouts, expected = task_timeouts(ChunkJobs, JobList, ExposureJobs)
+    results = run_graph(run_task, tasks, depends, Nworkers, argument=argument, label='stage',
+                        memory=task_memory(ChunkJobs, JobList, ExposureJobs), budget=memory_budget(),
+                        timeouts=timeouts, expected=expected, retries=JobRetries, speculate=True,
+                        finished=lambda result: merge_local_manifest())
+    record_graph_timings(results, ChunkJobs, JobList, ExposureJobs)
+    write_failures(results, OutputDIR + 'jobs.stage_scheduler.failed.tbl')
+    return(results)
+
+
+#---------------------------------------------------------------------------------------------------
+# Exit status of the scheduler: 1 if any task failed or was skipped, so that irac.sh stops there
+#---------------------------------------------------------------------------------------------------
+
+def exit_status(results):
+
+    return(1 if any(result[1] != 'ok' for result in results) else 0)
+
+
+if __name__ == '__main__':
+
+    #parse the arguments
+    usagestring ='%prog [-n Nworkers]'
+    parser = OptionParser(usage=usagestring)
+    parser.add_option("-n", "--nworkers", dest="Nworkers", type="int", default=Nthred,
+                      help="number of worker processes [default: %default]")
+    (options, args) = parser.parse_args()
+
+    #Read the log file and get just IRAC info, the AOR properties and the frame groups
+    log = read_log()
+    AORlog = read_table(AORinfoTable)
+    index = read_group_index(['AORChannel', 'AORExposure'])
+
+    #the job lists, as written by the stage scripts: chunks of frames, but whole AOR.channels for make_medians
+    ChunkJobs = make_joblist(log, AORlog, index=index, ChunkFrames=frame_chunk_size(len(log), options.Nworkers))
+    JobList = add_median_repeats(make_joblist(log, AORlog, index=index), log, index)
+    for stage, JobListName in StageJobLists.items():
+        write_table(JobList if stage == 'make_medians' else ChunkJobs, JobListName)
+    ExposureJobs, FrameJob = make_exposure_joblist(log, index)
+    write_table(ExposureJobs, OutputDIR + 'jobs.fix_astrometry.tbl')
+
+    #output directory of make_medians / subtract_medians, and the star table for find_stars
+    os.system('mkdir -p ' + AORoutput)
+    find_stars_function.write_bright_star_catalog()
+
+    #the astrometry corrections of the frames of each subtract_medians task, once known: those of the
+    #exposures it waited for, the only ones its frames need
+    Offsets = np.zeros(len(ExposureJobs), dtype=AstroFixType)
+    def task_argument(task, values):
+        stage, JobNo = task
+        if stage != 'subtract_medians':
+            return(None)
+        rows = job_rows(index, ChunkJobs, JobNo)
+        exposure_offsets(values, len(ExposureJobs), depends[task], Offsets)
+        return(table_to_array(astrometry_fix_table(log, Offsets, FrameJob, rows)))
+
+    merge_local_manifest()   #rows left on this node by a run that died
+    tasks, depends = make_graph(ChunkJobs, JobList, ExposureJobs)
+    results = run_stages(tasks, depends, ChunkJobs, JobList, ExposureJobs, options.Nworkers, argument=task_argument)
+
+    #write the astrometry corrections of all the frames, as fix_astrometry.py, if all were measured
+    values = dict((task, value) for (task, status, elapsed, message, value) in results if status == 'ok')
+    Nfixed = sum(1 for (stage, JobNo) in values if stage == 'fix_astrometry')
+    if Nfixed == len(ExposureJobs):
+        print("Writing astrometry corrections to " + str(AstrometryFixFile))
+        write_table(astrometry_fix_table(log, exposure_offsets(values, len(ExposureJobs)), FrameJob), AstrometryFixFile)
+    else:
+        print("## ERROR: astrometry measured for {:} of {:} exposures; {:} not written".format(Nfixed, len(ExposureJobs), AstrometryFixFile))
+
+    print("Done!")
+    sys.exit(exit_status(results))
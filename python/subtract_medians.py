@@ -5,48 +5,37 @@ import numpy as np
 from astropy.io import ascii
 from supermopex import *
 from spitzer_pipeline_functions import *
-import multiprocessing as mp
+from job_timing import run_timed_jobs
+import subtract_medians_function
 import pickle
 
-def run_subtractmedians(JobNo):
-    cmd = "cd " + RootDIR + "; " + pythonCMD + " subtract_medians_function.py " + str(JobNo)
-    os.system(cmd)
-
 #Read the log file and get just IRAC info
-rawlog = ascii.read(LogTable,format="ipac")
-log = rawlog[:][(rawlog['Instrument']=='IRAC').nonzero()]
+log = read_log()
 
 #Get the size of the array
 Nrows = log['Filename'].size
 
 #read in the AOR properties log
-AORlog = ascii.read(AORinfoTable,format="ipac")
+AORlog = read_table(AORinfoTable)
 
 #genreate a joblist for parallelization
-JobList = make_joblist(log,AORlog)
+JobList = make_joblist(log, AORlog, index=read_group_index(['AORChannel']), ChunkFrames=frame_chunk_size(Nrows, Nthred))
 Njobs = len(JobList)
 
 # AMo: write out the joblist
 JobListName = OutputDIR + 'jobs.subtract_medians'
-ascii.write(JobList, JobListName, format="ipac",overwrite=True)    
+write_table(JobList, JobListName)    
 print("Wrote job list {} with {} jobs".format(JobListName, Njobs))
 
-### would be good to write it also in some internal format that can be read quickly
-### BUT file written with pickle is larger that ascii file!!!!!
-### And not yet clear how to read it back; so skip for now.
-
-#JobListName = OutputDIR + PIDname + '.jobs_subtract_medians.dat'
-#with open(JobListName, 'wb') as ff:
-#    pickle.dump(JobList, ff)
-#print("Wrote job list to binary file {}".format(JobListName))
+# write_table also writes the binary copy (jobs.subtract_medians.npy) read by the jobs
 
 #sys.exit()
 #-----------------------------------------------------------------------------
 
-print("Subtracting medians with " + str(Nproc) + " threads.")
+print("Subtracting medians with up to " + str(Nthred) + " threads.")
 
-pool = mp.Pool(processes=Nthred)
-results = pool.map(run_subtractmedians, range(0,Njobs))
+subtract_medians_function.load_stage_data()
+results = run_timed_jobs(subtract_medians_function.run_job, JobList, Nthred, 'subtract_medians')
 
 print("Done!")
 
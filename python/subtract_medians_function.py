@@ -11,53 +11,64 @@ import pickle
 import sys
 from optparse import OptionParser
 
-#parse the arguments
-usagestring ='%prog Job_Number'
-parser = OptionParser()
-parser = OptionParser(usage=usagestring)
-(options, args) = parser.parse_args()
+#---------------------------------------------------------------------------------------------------
+# Load what all the jobs share: the log and its index, the astrometry corrections and the job list
+# written by subtract_medians.py.  The stage scheduler passes the corrections of each AOR with its
+# job instead (astrometry=False)
+#---------------------------------------------------------------------------------------------------
 
-#fail if there aren't enough arguments
-if len(args) < 1:
-    parser.error("Incorrect number of arguments.")
+def load_stage_data(astrometry=True):
 
-#read job number
-JobNo=int(args[0])
+    global log, index, AstroFix, JobList
 
-#read in the log file and get just IRAC info
-rawlog = ascii.read(LogTable,format="ipac")
-log = rawlog[:][(rawlog['Instrument']=='IRAC').nonzero()]
-#print("Read {} and extracted IRAC info".format(LogTable))   # debug
+    #read in the log file and get just IRAC info
+    log = read_log()
+    index = read_group_index(['AORChannel'])
+    #print("Read {} and extracted IRAC info".format(LogTable))   # debug
 
-#read the astrometry corrections
-AstroFix = ascii.read(AstrometryFixFile,format="ipac")
-#print("Read astrometry corrections")                        # debug   
+    #read the astrometry corrections
+    if astrometry:
+        AstroFix = read_table(AstrometryFixFile)
+    #print("Read astrometry corrections")                        # debug   
 
-#Get the size of the array
-Nrows = log['Filename'].size
+    #make output directory
+    cmd = 'mkdir -p ' + AORoutput
+    os.system(cmd)
 
-#make output directory
-cmd = 'mkdir -p ' + AORoutput
-os.system(cmd)
+    # AMo: read the job list rather than re-building it
+    JobListName = OutputDIR + 'jobs.subtract_medians'
+    JobList = read_table(JobListName)
+    #print("Read binary jobs list table")                        # debug
 
-###read in the AOR properties log
-##AORlog = ascii.read(AORinfoTable,format="ipac")
-###genreate a joblist for parallelization
-##JobList = make_joblist(log,AORlog)
 
-# AMo: read the job list rather than re-building it
-JobListName = OutputDIR + 'jobs.subtract_medians'
-JobList = ascii.read(JobListName, format="ipac")
-#print("Read ascii jobs list table")                         # debug
+#---------------------------------------------------------------------------------------------------
+# One job, once the stage data is loaded
+#---------------------------------------------------------------------------------------------------
 
-#JobListName = OutputDIR + PIDname + '.jobs_subtract_medians.dat'
-#with (open(JobListName, 'rb')) as f:
-#    pickle.load(f)
-#print("Read binary jobs list table")                        # debug
+def run_job(JobNo):
 
-Njobs = len(JobList)
+    subtract_median(JobNo,JobList=JobList,log=log,AstroFix=AstroFix,index=index)
 
-if (JobNo > Njobs):
-    die("Requested job number greater than number of jobs available " + str(Njobs) + "!");
 
-subtract_median(JobNo,JobList=JobList,log=log,AstroFix=AstroFix)
+if __name__ == '__main__':
+
+    #parse the arguments
+    usagestring ='%prog Job_Number'
+    parser = OptionParser()
+    parser = OptionParser(usage=usagestring)
+    (options, args) = parser.parse_args()
+
+    #fail if there aren't enough arguments
+    if len(args) < 1:
+        parser.error("Incorrect number of arguments.")
+
+    #read job number
+    JobNo=int(args[0])
+
+    load_stage_data()
+    Njobs = len(JobList)
+
+    if (JobNo > Njobs):
+        die("Requested job number greater than number of jobs available " + str(Njobs) + "!");
+
+    run_job(JobNo)
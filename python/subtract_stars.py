@@ -7,11 +7,8 @@ import numpy as np
 from astropy.io import ascii
 from supermopex import *
 from spitzer_pipeline_functions import *
-import multiprocessing as mp
-
-def run_subtractstars(JobNo):
-    cmd = "cd " + RootDIR + "; " + pythonCMD + " subtract_stars_function.py " + str(JobNo)
-    os.system(cmd)
+from job_timing import run_timed_jobs
+import subtract_stars_function
 
 #------------------------------------------------------------------
 
@@ -24,22 +21,21 @@ else:
 
 #-----------------------------------------------------------------------------
 #Read the log file and extract the IRAC info
-rawlog = ascii.read(LogTable,format="ipac")
-log = rawlog[:][(rawlog['Instrument']=='IRAC').nonzero()]
+log = read_log()
 
 #read in the AOR properties log, generate a joblist and write it to file
+Nthred  = Nproc  #fails for COSMOS on ppn=48 machines - TBC; use Nproc/2 or so
 JobListName = OutputDIR + 'jobs.sub_stars.tbl'
-AORlog = ascii.read(AORinfoTable,format="ipac")
-JobList = make_joblist(log, AORlog)
-ascii.write(JobList, JobListName, format="ipac",overwrite=True)    
+AORlog = read_table(AORinfoTable)
+JobList = make_joblist(log, AORlog, index=read_group_index(['AORChannel']), ChunkFrames=frame_chunk_size(len(log), Nthred))
+write_table(JobList, JobListName)    
 
 Njobs = len(JobList)
-Nthred  = Nproc  #fails for COSMOS on ppn=48 machines - TBC; use Nproc/2 or so
 
 print("Built job list {:} with {:} jobs".format(JobListName, Njobs))
-print("- Launch subtract_stars_function with {:} threads".format(Nthred))
+print("- Launch subtract_stars_function with up to {:} threads".format(Nthred))
 
-pool = mp.Pool(processes=Nthred)
-results = pool.map(run_subtractstars, range(0,Njobs))
+subtract_stars_function.load_stage_data()
+results = run_timed_jobs(subtract_stars_function.run_job, JobList, Nthred, 'subtract_stars')
 
 print("Done!")
@@ -5,44 +5,67 @@
 import sys
 import numpy as np
 from astropy.io import ascii
-#from astropy import units as u
-#from astropy.coordinates import SkyCoord
+from astropy import units as u
+from astropy.coordinates import SkyCoord
 
 from supermopex import *
 from spitzer_pipeline_functions import *
 
 from optparse import OptionParser
 
-#parse the arguments
-usagestring ='%prog Job_Number'
-parser = OptionParser()
-parser = OptionParser(usage=usagestring)
-(options, args) = parser.parse_args()
+#---------------------------------------------------------------------------------------------------
+# Load what all the jobs share: the log and its indexes, the job list written by subtract_stars.py,
+# and the refined star catalog
+#---------------------------------------------------------------------------------------------------
 
-#fail if there aren't enough arguments
-if len(args) < 1:
-    parser.error("Incorrect number of arguments.")
+def load_stage_data():
 
-#read job number
-JobNo=int(args[0])
+    global log, index, SkyIndex, JobList, StarData, StarMatch
 
-#print("-- Read the log file and get the IRAC info")  ##DEUG
-rawlog = ascii.read(LogTable,format="ipac")
-log = rawlog[:][(rawlog['Instrument']=='IRAC').nonzero()]
+    #print("-- Read the log file and get the IRAC info")  ##DEUG
+    log = read_log()
+    index = read_group_index(['AORChannel'])
+    SkyIndex = read_sky_index()   #the frame footprints, for the stars of each frame
 
-# Joblist is generated in find_stars.py
-#print("-- Read job list written find_stars")  ##DEUG
-JobListName = OutputDIR + 'jobs.sub_stars.tbl'
-JobList = ascii.read(JobListName, format="ipac")
-Njobs = len(JobList)
+    # Joblist is generated in subtract_stars.py
+    JobListName = OutputDIR + 'jobs.sub_stars.tbl'
+    JobList = read_table(JobListName)
 
-if (JobNo > Njobs):
-    die("Requested job number greater than number of jobs available " + str(Njobs) + "!");
+    # Read the refined fluxes and postions
+    StarData = ascii.read(RefinedStarCat, format="ipac") #read the data
+    StarMatch = SkyCoord(StarData['ra']*u.deg, StarData['dec']*u.deg)
 
-# Read the refined fluxes and postions
-StarData = ascii.read(RefinedStarCat, format="ipac") #read the data
-StarMatch = SkyCoord(StarData['ra']*u.deg, StarData['dec']*u.deg)
+    #print(">> length stars.refined.tbl", len(StarMatch), len(StarData)) ; sys.exit()   # DEBUG
 
-#print(">> length stars.refined.tbl", len(StarMatch), len(StarData)) ; sys.exit()   # DEBUG
 
-subtract_stars(JobNo, JobList=JobList, log=log, StarData=StarData, StarMatch=StarMatch)
+#---------------------------------------------------------------------------------------------------
+# One job, once the stage data is loaded
+#---------------------------------------------------------------------------------------------------
+
+def run_job(JobNo):
+
+    subtract_stars(JobNo, JobList=JobList, log=log, StarData=StarData, StarMatch=StarMatch, index=index, SkyIndex=SkyIndex)
+
+
+if __name__ == '__main__':
+
+    #parse the arguments
+    usagestring ='%prog Job_Number'
+    parser = OptionParser()
+    parser = OptionParser(usage=usagestring)
+    (options, args) = parser.parse_args()
+
+    #fail if there aren't enough arguments
+    if len(args) < 1:
+        parser.error("Incorrect number of arguments.")
+
+    #read job number
+    JobNo=int(args[0])
+
+    load_stage_data()
+    Njobs = len(JobList)
+
+    if (JobNo > Njobs):
+        die("Requested job number greater than number of jobs available " + str(Njobs) + "!");
+
+    run_job(JobNo)
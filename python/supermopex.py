@@ -17,7 +17,6 @@
 #-----------------------------------------------------------------------------
 
 import numpy as np
-from astropy.time import Time
 
 RootNode   = '@NODE@'                 # node on which to work (not used by python)
 RootDIR    = '@ROOTDIR@/'             # root directory
@@ -36,9 +35,42 @@ cluster    = '@CLUSTER@'              # cluster name for setting temp files.  Cu
 
 LogFile    = OutputDIR + 'Frames.log'     # ex test.log / .tbl
 LogTable   = OutputDIR + 'Frames.tbl'     # the log file containing frame info
+InventoryCache = OutputDIR + 'Frames.cache.npy'  # headers of all frames found, keyed on file size and mtime
+LogIndex   = OutputDIR + 'Frames.index.npz' # row groups of the IRAC frames by (AOR,Channel), (AOR,ExposureID) and DCE
+ManifestDB = OutputDIR + 'Products.manifest.db' # SQLite list of the products of each frame: path, size, mtime, stage
+ManifestLocalDIR = '/tmp/' # node-local directory where the jobs record their products until each job ends; '' to record in ManifestDB
+ReuseProducts = True   # reruns skip the frames whose products were made from the same inputs
+SkyIndexFile = OutputDIR + 'Frames.sky.npz'  # spatial index of the IRAC frame footprints
+TimingDB   = OutputDIR + 'Jobs.timing.db'  # SQLite wall times of the jobs of each stage, to predict new ones
+QueueDIR   = OutputDIR + 'Queues/'        # task queues of the stages, shared by the workers of all the nodes
 RMaskDir   = RawDataDir + 'Rmasks/'       # output dir for RMASK files
 AORinfoTable = OutputDIR + 'AORs.tbl'
 
+JobChunkFrames  = 0    # frames per job of the per-frame stages; 0: from the number of frames and threads
+ChunksPerWorker = 4    # jobs per thread when JobChunkFrames is 0, for load balance
+MinChunkFrames  = 20   # fewest frames per job when JobChunkFrames is 0
+MemoryBudget    = 0    # GB the jobs running together on a node may use; 0: MemoryFraction of the node memory
+MemoryFraction  = 0.8
+JobRetries      = 1    # times a failed or timed out job is run again
+JobTimeoutFactor = 5.0 # a job is killed after this many times its predicted time (once the stage was timed) ...
+MinJobTimeout   = 600  # ... and not before this many seconds
+BatchBackend    = 'pbs' # how irac.sh runs its jobs: pbs (job arrays of bundles) or local (processes of this machine)
+NodeCores       = 46   # cores and memory (GB) of a node, to pack the jobs into bundles of one node
+NodeMemory      = 180
+LocalNodes      = 1    # bundles run at a time by the local backend
+MaxWalltime     = 48   # longest walltime (hours) a job may ask
+TaskQueue       = False # stages run their jobs from a queue that other nodes can join (python task_queue.py join <stage>)
+LeaseTimeout    = 120  # seconds without heartbeat after which the job of a queue worker is given to another
+AutoTuneWorkers = False # stages use the number of workers tuned (on their first run) for the type of node, if fewer than Nthred;
+                        # off, as that first run starts with 1, 2, 4 ... workers and a node shared with other jobs skews the tuning
+PrefetchFrames  = 4    # frames whose inputs the per-frame loops read ahead, in IOThreads threads; 0: read in line
+WriteBehindFrames = 4  # frames whose outputs may wait to be written while the next are computed; 0: write in line
+IOThreads       = 2    # reader threads of a job
+ProductStore    = 'fits' # intermediate frame products: 'fits', a file per frame, or 'cube', a container per AOR.channel (CubeProducts)
+FrameLayout     = 'files' # images of a frame: 'files', image, unc and mask in sibling files, or 'mef', those of MEFProducts one file with their new unc or mask
+CompressProducts = False # write the products of CompressLossless and CompressQuantized as tile-compressed FITS
+QuantizeLevel   = 16     # quantization of CompressQuantized: steps of the noise of a tile / QuantizeLevel (fpack -q)
+
 pythonCMD  = "python"                      # python command
 
 #---------------------- END PARAMETERS ----------------------
@@ -56,8 +88,9 @@ GaiaStarTable = OutputDIR + 'gaia-wise.tbl'
 TwomassStarTable = OutputDIR + '2mass-wise.tbl'
 
 #Epoch for astrometry
-GaiaEpoch = Time(2015.5,format='decimalyear')  #GAIA DR2 epoch
-AstrometryEpoch = Time(2015.5,format='decimalyear') #Desired epoch for astrometry, setting to Gaia since that is what Ultra-Vista is set to
+#(decimal years; made astropy Times where used, so that reading this file does not load astropy)
+GaiaEpoch = 2015.5        #GAIA DR2 epoch
+AstrometryEpoch = 2015.5  #Desired epoch for astrometry, setting to Gaia since that is what Ultra-Vista is set to
 
 #Column to use for starID
 StarIDcol = 'wise_id'
@@ -117,6 +150,28 @@ flatFeildSuffix =  'fbcd' # corrected uncertanty data
 IRACsuffixList = [bcdSuffix,UncSuffix,corDataSuffix,corUncSuffix,ffSuffix,starsubSuffix,starMaskSuffix,SubtractedSuffix,ScaledUncSuffix,rmaskSuffix]
 MIPSsuffixList = [bcdSuffix,UncSuffix,MipsMaskSuffix,flatFeildSuffix]
 
+#products kept in one container per AOR.channel with ProductStore 'cube', and those that mopex
+#reads, which stay FITS files whatever the store
+CubeProducts   = [ffSuffix,starsubSuffix]
+MopexProducts  = [starMaskSuffix,SubtractedSuffix,ScaledUncSuffix]
+
+#the uncertainty and mask of each image, its sibling files.  With FrameLayout 'mef' the images of
+#MEFProducts are one file per frame, SCI with the siblings written by the same stage as extensions
+#(UNC, MASK): the stbcd with its stmsk.  The inputs (cbunc, bimsk) are not copied, and the sub stays
+#files, as mopex reads it with its sbunc and stmsk: subtract_medians writes the stmsk from the stbcd
+FrameSets = {ffSuffix:         [corUncSuffix,maskSuffix],
+             starsubSuffix:    [corUncSuffix,starMaskSuffix],
+             SubtractedSuffix: [ScaledUncSuffix,starMaskSuffix]}
+FrameMEFNames = ['SCI','UNC','MASK']
+MEFProducts = {starsubSuffix: [starMaskSuffix]}
+
+#products written tile-compressed with CompressProducts: lossless (frame images, with the MASK of a
+#MEF of the 'mef' layout), and quantized (the unc and std of the mosaics of the tiles; the whole-field
+#mosaics are not compressed).  Only the products that the pipeline alone reads: mopex reads the sub,
+#sbunc, stmsk and rmask, and swarp the mosaic and mosaic_cov of the tiles, so keep them out
+CompressLossless  = [starsubSuffix]
+CompressQuantized = ['mosaic_unc','mosaic_std']
+
 #first frame delay files
 FrameDelayFile = './cal/frame-delay.txt'
 
@@ -155,6 +210,9 @@ ClipSigmaNeg=5.0
 
 #number of dilations around objects
 Ndilation = 2
+StarMotionMargin = 0.05   # deg added to the catalog cuts around frames to cover proper motions since the Gaia epoch
+BrightStarMargin = 0.06    # deg around the footprint of a frame within which bright stars are fitted (their wings reach in)
+AstroStarMargin = 0.006    # deg around the footprint of a frame within which Gaia stars are used for its astrometry
 
 #Use median or average image for background subtraction
 #BackgroundType = "median"
@@ -166,6 +224,9 @@ HeaderItems=("INSTRUME","CHNLNUM","AORKEY","DCEID","DCENUM","AOT_TYPE","HDRMODE"
 #Give the header key words these names in the log files
 LogItems=("Filename","Instrument","Channel","AOR","DCE","FrameNumber","ObsType","HDR","PID","MJD","ExpTime","Object","RA","DEC","PA","FluxConv","Gain","Zody_Bkg_Est","ISM_Bkg_Est","FOVID","ExposureID","FrameDelay")
 
+#Sky corners of each frame from the header WCS, recorded in the log after the LogItems
+FootprintItems=("RA1","DEC1","RA2","DEC2","RA3","DEC3","RA4","DEC4")
+
 # Wise magnitude offsets for checking in star merging
 WISEchannel=["w1","w2","w2","w2"]
 WISEratio=[0.8924,1.075,0.7832,0.4884]
@@ -0,0 +1,323 @@
+#---------------------------------------------------------------------------------------------------
+# Task queue in the shared work directory, so that the jobs of a stage can be run by workers on any
+# number of nodes.  The queue of a stage is a directory, QueueDIR/<stage>/, with the jobs in the
+# order they should start, and one file per job in leases/ (the job is being run: created with
+# O_EXCL, so only one worker gets it, and touched every few seconds by its worker), tries/ (how many
+# times it was started) and done/ (its result).  A lease not touched for LeaseTimeout seconds is that
+# of a dead worker: the next worker renames it away, which only one can do, and runs the job again.
+# A worker runs each job in a child process, killed when the job runs past its timeout (the file
+# timeouts, when the stage was timed before), and a worker that dies is replaced.
+#
+# The stage script creates the queue and runs Nthred workers on its node (see run_timed_jobs when
+# TaskQueue is set); any other node can add workers while it runs with
+#   python task_queue.py join <stage> [-n Nworkers]
+# The workers of a node are forked after the stage data is loaded, as in job_executor.
+#---------------------------------------------------------------------------------------------------
+
+import os, sys, time, pickle, shutil, threading, importlib
+import multiprocessing as mp
+from multiprocessing.connection import wait
+
+from supermopex import *
+import job_executor
+from product_manifest import merge_local_manifest
+
+HeartbeatInterval = 10   # seconds between touches of a lease
+PollInterval = 10        # seconds between looks at a queue whose jobs are all leased
+
+# modules (load_stage_data / run_job) of the stages that can be queued
+QueueModules = {'ffcorr':           'first_frame_corr_function',
+                'find_stars':       'find_stars_function',
+                'check_stars':      'check_stars_function',
+                'subtract_stars':   'subtract_stars_function',
+                'make_medians':     'make_medians_function',
+                'fix_astrometry':   'fix_astrometry_function',
+                'subtract_medians': 'subtract_medians_function',
+                'check_astrometry': 'check_astrometry_function',
+                'combine_rmasks':   'combine_rmasks_function',
+                'find_outliers':    'find_outliers_function'}
+
+
+#---------------------------------------------------------------------------------------------------
+# Files of a queue
+#---------------------------------------------------------------------------------------------------
+
+def queue_dir(stage):
+
+    return(QueueDIR + stage + '/')
+
+
+def write_atomic(filename, text):
+
+    tmpfile = filename + '.' + worker_id() + '.tmp'
+    with open(tmpfile, 'w') as f:
+        f.write(text)
+    os.replace(tmpfile, filename)
+
+
+def worker_id():
+
+    return(os.uname().nodename.split('.')[0] + '.' + str(os.getpid()))
+
+
+#---------------------------------------------------------------------------------------------------
+# Create the queue of a stage: jobs 0..Njobs-1, started in the given order, with their timeouts in
+# seconds by job if given.  Any previous queue of the stage is removed
+#---------------------------------------------------------------------------------------------------
+
+def create_queue(stage, Njobs, order=None, timeouts=None):
+
+    if order is None:
+        order = range(0,Njobs)
+    queue = queue_dir(stage)
+    shutil.rmtree(queue, ignore_errors=True)
+    for subdir in ['leases', 'tries', 'done']:
+        os.makedirs(queue + subdir)
+    if timeouts is not None:
+        write_atomic(queue + 'timeouts', ' '.join('{:.0f}'.format(seconds) for seconds in timeouts) + '\n')
+    write_atomic(queue + 'jobs', ' '.join(str(int(JobNo)) for JobNo in order) + '\n')
+    return(queue)
+
+
+def queue_jobs(queue):
+
+    return([int(JobNo) for JobNo in open(queue + 'jobs').read().split()])
+
+
+def queue_timeouts(queue):
+
+    if not os.path.exists(queue + 'timeouts'):
+        return(None)
+    return([float(seconds) for seconds in open(queue + 'timeouts').read().split()])
+
+
+def queue_done(queue):
+
+    return(set(int(name) for name in os.listdir(queue + 'done') if name.isdigit()))
+
+
+#---------------------------------------------------------------------------------------------------
+# The time of the file server, to compare with the dates of the leases whatever the clock of the node
+#---------------------------------------------------------------------------------------------------
+
+def server_time(queue):
+
+    clock = queue + 'leases/clock.' + worker_id()
+    with open(clock, 'w'):
+        pass
+    now = os.stat(clock).st_mtime
+    os.remove(clock)
+    return(now)
+
+
+#---------------------------------------------------------------------------------------------------
+# Take the lease of the first job not done and not leased, or whose lease expired.  Returns (JobNo,
+# number of the try), or None if no job can be taken now.  A job started JobRetries+1 times already,
+# the last by a worker that died, is done as failed
+#---------------------------------------------------------------------------------------------------
+
+def claim_job(queue, retries):
+
+    done = queue_done(queue)
+    now = server_time(queue)
+    for JobNo in queue_jobs(queue):
+        if JobNo in done:
+            continue
+        lease = queue + 'leases/' + str(JobNo)
+        if os.path.exists(lease):
+            try:
+                if now - os.stat(lease).st_mtime < LeaseTimeout:
+                    continue
+                os.rename(lease, lease + '.expired.' + worker_id())   #only one worker gets to do this
+            except OSError:
+                continue
+            print("## {:} job {:}: lease of {:} expired".format(queue, JobNo, open(lease + '.expired.' + worker_id()).read().strip()))
+            os.remove(lease + '.expired.' + worker_id())
+        try:
+            fd = os.open(lease, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            continue
+        os.write(fd, (worker_id() + '\n').encode())
+        os.close(fd)
+        if os.path.exists(queue + 'done/' + str(JobNo)):   #done since the listing: its lease was just given up
+            release_lease(queue, JobNo)
+            continue
+
+        tries = queue + 'tries/' + str(JobNo)
+        Ntries = int(open(tries).read()) if os.path.exists(tries) else 0
+        if Ntries > retries:
+            finish_job(queue, JobNo, (JobNo, 'failed', 0.0, 'worker died ({:} tries)'.format(Ntries), None))
+            continue
+        write_atomic(tries, str(Ntries + 1))
+        return((JobNo, Ntries + 1))
+    return(None)
+
+
+#---------------------------------------------------------------------------------------------------
+# Record the result of a job and give up its lease (if it is still ours)
+#---------------------------------------------------------------------------------------------------
+
+def finish_job(queue, JobNo, result):
+
+    if result is not None:
+        tmpfile = queue + 'done/' + str(JobNo) + '.' + worker_id() + '.tmp'
+        with open(tmpfile, 'wb') as f:
+            pickle.dump(result, f)
+        os.replace(tmpfile, queue + 'done/' + str(JobNo))
+    release_lease(queue, JobNo)
+
+
+def release_lease(queue, JobNo):
+
+    lease = queue + 'leases/' + str(JobNo)
+    try:
+        if open(lease).read().strip() == worker_id():
+            os.remove(lease)
+    except OSError:
+        pass
+
+
+def heartbeat(lease, stop):
+
+    while not stop.wait(HeartbeatInterval):
+        try:
+            os.utime(lease)
+        except OSError:
+            pass
+
+
+#---------------------------------------------------------------------------------------------------
+# Run a job in the child process of a worker (see job_executor.start_worker), waiting at most timeout
+# seconds (None: no limit).  A child that timed out is killed, one that died is reaped, and either
+# is replaced.  Returns the child for the next job and the result of call_job
+#---------------------------------------------------------------------------------------------------
+
+def run_in_child(child, JobNo, timeout):
+
+    start = time.time()
+    child['conn'].send((JobNo, None))
+    if child['conn'].poll(timeout):
+        try:
+            result, peak = child['conn'].recv()
+            return(child, result)
+        except (EOFError, OSError):
+            child['process'].join(5)
+            status, message = 'failed', 'worker died (exit code {:})'.format(child['process'].exitcode)
+    else:
+        status, message = 'timeout', 'no result after {:.0f} s'.format(time.time()-start)
+    job_executor.kill_worker(child)
+    return(job_executor.start_worker(), (JobNo, status, time.time()-start, message, None))
+
+
+#---------------------------------------------------------------------------------------------------
+# One worker: take jobs from the queue and run them with function(JobNo) until all are done.  A
+# failed or timed out job goes back in the queue until it was tried JobRetries+1 times
+#---------------------------------------------------------------------------------------------------
+
+def work(queue, function, retries=JobRetries):
+
+    job_executor.JobFunction = lambda JobNo, argument: function(JobNo)
+    Njobs = len(queue_jobs(queue))
+    timeouts = queue_timeouts(queue)
+    child = None
+    while len(queue_done(queue)) < Njobs:
+        claimed = claim_job(queue, retries)
+        if claimed is None:
+            time.sleep(PollInterval)   #all leased: wait for them, or for a lease to expire
+            continue
+        JobNo, Ntries = claimed
+        if child is None:
+            child = job_executor.start_worker()
+        stop = threading.Event()
+        beat = threading.Thread(target=heartbeat, args=(queue + 'leases/' + str(JobNo), stop), daemon=True)
+        beat.start()
+        child, result = run_in_child(child, JobNo, timeouts[JobNo] if timeouts is not None else None)
+        stop.set()
+        beat.join()
+        if (result[1] != 'ok') and (Ntries <= retries):
+            print("## {:} job {:} {:}: {:}; back in the queue (try {:} of {:})".format(queue, JobNo, result[1], result[3], Ntries, retries+1))
+            result = None
+        finish_job(queue, JobNo, result)
+    if child is not None:
+        job_executor.stop_workers([child])
+
+
+#---------------------------------------------------------------------------------------------------
+# Run Nworkers workers of the queue on this node, forked so that they share the stage data.  A worker
+# that dies while jobs remain is replaced (its job goes to another once its lease expires), up to
+# once per try of each job.  The products they recorded go to the shared manifest as their jobs end,
+# at the next look at the workers
+#---------------------------------------------------------------------------------------------------
+
+def run_workers(queue, function, Nworkers):
+
+    sys.stdout.flush()
+    context = mp.get_context('fork')
+    Njobs = len(queue_jobs(queue))
+    workers = [context.Process(target=work, args=(queue, function)) for i in range(Nworkers)]
+    for worker in workers:
+        worker.start()
+    Nreplaced = 0
+    while workers:
+        wait([worker.sentinel for worker in workers], PollInterval)   #the children of a killed worker may hold its sentinel
+        merge_local_manifest()
+        for worker in [worker for worker in workers if not worker.is_alive()]:
+            worker.join()
+            workers.remove(worker)
+            if (worker.exitcode != 0) and (len(queue_done(queue)) < Njobs) and (Nreplaced < Njobs*(JobRetries+1)):
+                Nreplaced += 1
+                print("## {:} worker {:} died (exit code {:}); replaced".format(queue, worker.pid, worker.exitcode))
+                sys.stdout.flush()
+                workers.append(context.Process(target=work, args=(queue, function)))
+                workers[-1].start()
+    merge_local_manifest()
+
+
+#---------------------------------------------------------------------------------------------------
+# Run the jobs of a stage through its queue, with Nworkers workers on this node and those that join
+# from other nodes, and the timeouts of the jobs if given.  Returns the results of call_job in job
+# order, as run_jobs
+#---------------------------------------------------------------------------------------------------
+
+def run_queue(function, Njobs, Nworkers, stage, order=None, timeouts=None):
+
+    start = time.time()
+    queue = create_queue(stage, Njobs, order, timeouts)
+    print("## Queue {:} of {:} jobs: other nodes can join with  python task_queue.py join {:}".format(queue, Njobs, stage))
+    run_workers(queue, function, min(Nworkers, Njobs))
+
+    results = list()
+    for JobNo in range(0,Njobs):
+        with open(queue + 'done/' + str(JobNo), 'rb') as f:
+            results.append(pickle.load(f))
+    failed = [result for result in results if result[1] != 'ok']
+    print("## {:} {:} jobs done in {:.1f} s from queue {:}; {:} failed".format(Njobs, stage, time.time()-start, queue, len(failed)))
+    job_executor.report_failures(results, stage)
+    return(results)
+
+
+if __name__ == '__main__':
+
+    from optparse import OptionParser
+
+    usagestring = '%prog join stage [-n Nworkers]'
+    parser = OptionParser(usage=usagestring)
+    parser.add_option("-n", "--nworkers", dest="Nworkers", type="int", default=Nthred,
+                      help="number of worker processes [default: %default]")
+    (options, args) = parser.parse_args()
+
+    if (len(args) != 2) or (args[0] != 'join'):
+        parser.error("Incorrect arguments.")
+    stage = args[1]
+    if stage not in QueueModules:
+        parser.error("Unknown stage " + stage)
+    queue = queue_dir(stage)
+    if not os.path.exists(queue + 'jobs'):
+        print("## ERROR: no queue {:}".format(queue))
+        sys.exit(1)
+
+    module = importlib.import_module(QueueModules[stage])
+    module.load_stage_data()
+    print("## Joining queue {:} with {:} workers on {:}".format(queue, options.Nworkers, os.uname().nodename))
+    run_workers(queue, module.run_job, options.Nworkers)
+    print("Done!")
@@ -0,0 +1,37 @@
+#---------------------------------------------------------------------------------------------------
+# Test setup: the work directory of the tests is a temporary directory, with its supermopex.py
+# written from the template as irac.sh writes it, and found before the template itself
+#---------------------------------------------------------------------------------------------------
+
+import os, sys, tempfile
+
+import pytest
+
+PythonDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WorkDIR = tempfile.mkdtemp(prefix='irac_tests_')
+
+Substitutions = {'@ROOTDIR@': WorkDIR, '@NPROC@': '2', '@NTHRED@': '2', '@NODE@': 'local',
+                 '@PID@': 'test', '@CLUSTER@': 'none', '@INFO@': 'for the tests'}
+
+
+def write_supermopex():
+
+    with open(os.path.join(PythonDIR, 'supermopex.py')) as f:
+        text = f.read()
+    for key, value in Substitutions.items():
+        text = text.replace(key, value)
+    with open(os.path.join(WorkDIR, 'supermopex.py'), 'w') as f:
+        f.write(text)
+
+
+write_supermopex()
+sys.path[:0] = [WorkDIR, PythonDIR]
+for directory in ['Data', 'Products', 'temp', 'medians']:
+    os.makedirs(os.path.join(WorkDIR, directory), exist_ok=True)
+
+
+@pytest.fixture
+def workdir(monkeypatch):
+
+    monkeypatch.chdir(WorkDIR)
+    return(WorkDIR)
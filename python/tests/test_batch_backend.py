@@ -0,0 +1,70 @@
+#---------------------------------------------------------------------------------------------------
+# Batch backends: the packing of the jobs into bundles, the local backend with failed and lost jobs,
+# and the PBS arrays of the bundles grouped by the resources they ask for
+#---------------------------------------------------------------------------------------------------
+
+import os, subprocess
+import numpy as np
+from astropy.table import Table
+
+from supermopex import *
+import batch_backend
+
+
+def make_jobs(rows):
+
+    return(Table(rows=rows, names=['Output','Cores','MemGB','Hours','Command'],
+                 dtype=[str, np.int64, np.double, np.double, str]))
+
+
+def test_pack_jobs():
+
+    jobs = make_jobs([('a.out', 4, 10.0, 2.0, 'true'), ('b.out', 4, 10.0, 5.0, 'true'), ('c.out', 2, 40.0, 1.0, 'true'),
+                      ('d.out', 16, 1.0, 1.0, 'true'), ('e.out', 1, 1.0, 3.0, 'true')])
+    bundles = batch_backend.pack_jobs(jobs, 8, 50.0)
+    assert sorted(sum(bundles, [])) == list(range(len(jobs)))
+    assert bundles[0][0] == 1                                        #longest first
+    assert [3] in bundles                                            #larger than a node: alone
+    for bundle in bundles:
+        if len(bundle) > 1:
+            assert sum(jobs['Cores'][bundle]) <= 8
+            assert sum(jobs['MemGB'][bundle]) <= 50.0
+    assert len(bundles) == 3
+
+
+def test_local_backend(workdir, monkeypatch):
+
+    monkeypatch.setattr(batch_backend, 'PollInterval', 0.1)
+    monkeypatch.setattr(batch_backend, 'LocalNodes', 2)
+    monkeypatch.setitem(batch_backend.Backends['local'], 'capacity', lambda: (2, 100.0))
+    jobs = make_jobs([('ok1.out', 1, 1.0, 1.0, 'echo one'), ('ok2.out', 1, 1.0, 1.0, 'echo two'),
+                      ('bad.out', 1, 1.0, 1.0, 'echo bad; exit 3'), ('lost.out', 2, 1.0, 1.0, 'kill -9 $PPID'),
+                      ('ok3.out', 1, 1.0, 1.0, 'sleep 0.3; echo three')])
+    for output in jobs['Output']:
+        with open(output, 'w') as f:
+            f.write('EXIT STATUS: 0\n')   #left by a previous run
+
+    status = batch_backend.run_batch('test', jobs, 'local')
+    assert status == [0, 0, 3, batch_backend.LostStatus, 0]
+    assert open('ok3.out').read() == 'three\nEXIT STATUS: 0\n'
+    assert 'killed or lost' in open('lost.out').read()
+    assert not any(os.path.exists(output + '.tmp') for output in jobs['Output'] if output != 'lost.out')
+
+
+def test_pbs_arrays_by_resources(workdir, monkeypatch):
+
+    submitted = list()
+    def run(command, **options):
+        if command[0] == 'qsub':
+            submitted.append(open(command[1]).read())
+            return(subprocess.CompletedProcess(command, 0, '{:d}[].server\n'.format(100 + len(submitted)), ''))
+        return(subprocess.CompletedProcess(command, 0, '101[0].server  tile  user  0  R batch\n102[2].server  tile  user  0  Q batch\n', ''))
+    monkeypatch.setattr(batch_backend.subprocess, 'run', run)
+    jobs = make_jobs([('a.out', 8, 0.0, 2.0, 'true'), ('b.out', 8, 0.0, 2.0, 'true'), ('c.out', 2, 0.0, 1.0, 'true')])
+    handle = {'name': 'test', 'jobs': jobs, 'bundles': [[0], [1], [2]]}
+
+    batch_backend.pbs_submit(handle)
+    assert handle['jobids'] == ['101', '102']
+    assert '#PBS -l nodes=1:ppn=8,walltime=2:00:00\n#PBS -t 0,1\n' in submitted[0]
+    assert '#PBS -l nodes=1:ppn=2,walltime=1:00:00\n#PBS -t 2\n' in submitted[1]
+    assert batch_backend.pbs_poll(handle) == {1}
@@ -0,0 +1,91 @@
+#---------------------------------------------------------------------------------------------------
+# Frame inventory: the parallel mode gives the log of the serial one, and a refresh reads only the
+# headers of the new or changed frames
+#---------------------------------------------------------------------------------------------------
+
+import os, shutil
+import numpy as np
+from astropy.io import fits
+
+from supermopex import *
+import frame_inventory
+
+
+def write_bcd(AOR, Ch, DCE, framedelay=1.0, missing=()):
+
+    directory = os.path.join(RawDataDir, 'r{:d}'.format(AOR), 'ch{:d}'.format(Ch), 'bcd')
+    os.makedirs(directory, exist_ok=True)
+    stem = os.path.join(directory, 'SPITZER_I{:d}_{:d}_{:04d}_0000_1'.format(Ch, AOR, DCE))
+    header = fits.Header()
+    values = ['IRAC', Ch, AOR, 1000*AOR + DCE, DCE, 'IRACMAP', False, 80000, 55000.0 + DCE/1e4, 100.0,
+              'TESTFIELD', 150.0 + DCE*0.01, 2.2, 10.0, 0.1, 3.7, 0.05, 0.5, 74, DCE, framedelay]
+    for item, value in zip(HeaderItems, values):
+        if item not in missing:
+            header[item] = value
+    for key, value in [('CTYPE1','RA---TAN'), ('CTYPE2','DEC--TAN'), ('CRPIX1',128.5), ('CRPIX2',128.5),
+                       ('CD1_1',-0.00034), ('CD1_2',0.0), ('CD2_1',0.0), ('CD2_2',0.00034)]:
+        header[key] = value
+    data = np.zeros((256,256), dtype=np.float32)
+    fits.PrimaryHDU(data, header).writeto(stem + '_' + bcdSuffix + '.fits', overwrite=True)
+    fits.PrimaryHDU(data).writeto(stem + '_' + UncSuffix + '.fits', overwrite=True)
+    return(stem + '_' + bcdSuffix + '.fits')
+
+
+def counting_reader(monkeypatch):
+
+    reads = list()
+    read_frame_info = frame_inventory.read_frame_info
+    def reader(filename):
+        reads.append(filename)
+        return(read_frame_info(filename))
+    monkeypatch.setattr(frame_inventory, 'read_frame_info', reader)
+    return(reads)
+
+
+def test_inventory_parallel_and_refresh(workdir, monkeypatch):
+
+    shutil.rmtree(RawDataDir, ignore_errors=True)
+    if os.path.exists(InventoryCache):
+        os.remove(InventoryCache)
+    files = [write_bcd(AOR, Ch, DCE) for AOR in (11, 22) for Ch in (1, 2) for DCE in range(3)]
+    bad = write_bcd(33, 1, 0, framedelay=0.0)
+
+    serial = frame_inventory.setup_pipeline(Nworkers=1, rescan=True)
+    parallel = frame_inventory.setup_pipeline(Nworkers=3, rescan=True)
+    assert list(serial['Filename']) == sorted(files)
+    assert bad not in list(serial['Filename'])
+    for name in serial.colnames:
+        assert np.array_equal(serial[name], parallel[name]), name
+    assert np.all(np.isfinite(serial['RA1']))
+
+    #the rows stream back, in file order, as the workers read them
+    rows = frame_inventory.read_frame_headers(sorted(files), Nworkers=2)
+    assert next(rows)[0][LogItems.index('Filename')] == sorted(files)[0]
+    assert [LogLine[LogItems.index('Filename')] for LogLine, good in rows] == sorted(files)[1:]
+
+    #a refresh reads only the frames added or changed, and drops those removed
+    reads = counting_reader(monkeypatch)
+    added = write_bcd(44, 1, 0)
+    os.utime(files[0], ns=(0, 0))
+    removed = files[-1]
+    os.remove(removed)
+    os.remove(removed.replace(bcdSuffix + '.fits', UncSuffix + '.fits'))
+    log = frame_inventory.setup_pipeline(Nworkers=1)
+    assert sorted(reads) == sorted([added, files[0]])
+    assert list(log['Filename']) == sorted(files[:-1] + [added])
+    assert os.path.exists(OutputDIR + PIDname + '.irac.1.' + bcdSuffix + '.lst')
+
+
+def test_inventory_cache_keeps_missing_values(workdir):
+
+    shutil.rmtree(RawDataDir, ignore_errors=True)
+    if os.path.exists(InventoryCache):
+        os.remove(InventoryCache)
+    files = [write_bcd(55, 1, DCE, missing=(('ZODY_EST',) if DCE == 1 else ())) for DCE in range(3)]
+
+    scanned = frame_inventory.setup_pipeline(Nworkers=1)
+    cached = frame_inventory.read_inventory_cache()
+    assert cached[files[1]][3][LogItems.index('Zody_Bkg_Est')] is None
+    assert cached[files[0]][3][LogItems.index('Zody_Bkg_Est')] == 0.05
+    refreshed = frame_inventory.setup_pipeline(Nworkers=1)
+    assert list(refreshed['Zody_Bkg_Est']) == list(scanned['Zody_Bkg_Est']) == [0.05, None, 0.05]
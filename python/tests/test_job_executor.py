@@ -0,0 +1,117 @@
+#---------------------------------------------------------------------------------------------------
+# Job executor: the jobs of a stage run in forked workers that inherit the data loaded by the stage,
+# and a failing job is reported without stopping the others
+#---------------------------------------------------------------------------------------------------
+
+import os, sys, time, subprocess
+import numpy as np
+from astropy.io import ascii
+from astropy.table import Table
+
+from supermopex import *
+import job_executor
+
+StageData = None   #loaded by the stage before its workers are forked
+
+
+def job(JobNo):
+
+    with open('ran.{:}'.format(JobNo), 'w') as f:
+        f.write(str(os.getpid()))
+    if JobNo == 2:
+        raise ValueError('bad frame')
+    elif JobNo == 3:
+        sys.exit(1)
+    return(StageData[JobNo])
+
+
+def test_jobs_in_workers(workdir):
+
+    global StageData
+    StageData = [10*JobNo for JobNo in range(6)]
+
+    results = job_executor.run_jobs(job, 6, 3, 'testjob')
+    assert [result[0] for result in results] == list(range(6))
+    assert [result[1] for result in results] == ['ok', 'ok', 'failed', 'failed', 'ok', 'ok']
+    assert 'bad frame' in results[2][3]
+    pids = set(int(open('ran.{:}'.format(JobNo)).read()) for JobNo in range(6))
+    assert (os.getpid() not in pids) and (len(pids) <= 3)
+
+
+#---------------------------------------------------------------------------------------------------
+# Failures: a job past its timeout is killed with the tools it started, a failed job is retried, a
+# worker that dies is replaced, a late job gets a duplicate of which the first copy to end wins, and
+# the jobs that did not succeed are listed in a table
+#---------------------------------------------------------------------------------------------------
+
+def attempt(name):
+
+    count = int(open(name).read()) + 1 if os.path.exists(name) else 1
+    with open(name, 'w') as f:
+        f.write(str(count))
+    return(count)
+
+
+def failing_job(JobNo):
+
+    count = attempt('tries.{:}'.format(JobNo))
+    if JobNo == 1:
+        tool = subprocess.Popen(['sleep', '600'])   #an external tool of the job
+        with open('tool.1', 'w') as f:
+            f.write(str(tool.pid))
+        time.sleep(600)
+    elif (JobNo == 2) and (count < 3):
+        raise ValueError('not yet')
+    elif JobNo == 3:
+        raise ValueError('bad frame')
+    elif (JobNo == 4) and (count == 1):
+        os._exit(3)
+    elif (JobNo == 5) and (count == 1):
+        time.sleep(600)   #a straggler: its duplicate ends first
+    return(JobNo)
+
+
+def process_gone(pid):
+
+    try:
+        with open('/proc/{:}/stat'.format(pid)) as f:
+            return(f.read().split(')')[-1].split()[0] == 'Z')
+    except OSError:
+        return(True)
+
+
+def test_job_failures(workdir, monkeypatch):
+
+    monkeypatch.setattr(job_executor, 'WaitInterval', 0.2)
+    monkeypatch.setattr(job_executor, 'MinSpeculate', 1.0)
+    for name in os.listdir('.'):
+        if name.startswith('tries.') or name.startswith('tool.'):
+            os.remove(name)
+
+    start = time.time()
+    results = job_executor.run_jobs(failing_job, 6, 3, 'testjob', timeouts=[60, 1, 60, 60, 60, 60],
+                                    expected=[0.1]*6, retries=2, speculate=True)
+    assert time.time() - start < 30
+    assert [result[1] for result in results] == ['ok', 'timeout', 'ok', 'failed', 'ok', 'ok']
+    assert [result[4] for result in results if result[1] == 'ok'] == [0, 2, 4, 5]
+    assert 'bad frame' in results[3][3]
+    assert [int(open('tries.{:}'.format(JobNo)).read()) for JobNo in range(6)] == [1, 3, 3, 3, 2, 2]
+    assert results[5][2] < 10
+
+    #the tool of the job killed with it
+    pid = int(open('tool.1').read())
+    for wait in range(50):
+        if process_gone(pid):
+            break
+        time.sleep(0.1)
+    assert process_gone(pid)
+
+    #the failures listed, with their row of the job list; none left once all succeeded
+    JobList = Table([np.arange(6), np.arange(6)*10], names=['JobNo','FirstRow'])
+    job_executor.write_failures(results, 'failures.tbl', JobList)
+    failures = ascii.read('failures.tbl', format='ipac')
+    assert list(failures['JobNo']) == [1, 3]
+    assert list(failures['Status']) == ['timeout', 'failed']
+    assert list(failures['FirstRow']) == [10, 30]
+    job_executor.write_failures([result for result in results if result[1] == 'ok'], 'failures.tbl', JobList)
+    assert not os.path.exists('failures.tbl')
@@ -0,0 +1,39 @@
+#---------------------------------------------------------------------------------------------------
+# Job memory: the peak memory of the jobs is measured by their workers and recorded with their
+# times, and predicts that of the next jobs of the stage
+#---------------------------------------------------------------------------------------------------
+
+import os
+import numpy as np
+from astropy.table import Table
+
+from supermopex import *
+import job_memory, job_timing
+
+JobFrames = None   #frames of each job, inherited by the workers
+
+
+def memory_job(JobNo):
+
+    data = np.ones(JobFrames[JobNo] * 50*1000*1000 // 8)   #50 MB a frame
+    return(float(data[-1]))
+
+
+def test_measured_memory(workdir):
+
+    global JobFrames
+    if os.path.exists(TimingDB):
+        os.remove(TimingDB)
+    JobFrames = [1, 2, 4, 4]
+    unmeasured = job_memory.predict_memory('memstage', Table([[8]], names=['NumFrames']))
+    assert np.allclose(unmeasured, job_memory.WorkerGB + 0.5)
+
+    results = job_timing.run_timed_jobs(memory_job, Table([JobFrames], names=['NumFrames']), 2, 'memstage')
+    assert [result[1] for result in results] == ['ok']*4
+    predicted = job_memory.predict_memory('memstage', Table([[1, 8]], names=['NumFrames']))
+    assert (0.04 <= predicted[0] - job_memory.WorkerGB < 0.15) and (0.35 <= predicted[1] - job_memory.WorkerGB < 0.6)
+
+    #the fit goes through the highest peaks
+    assert job_memory.fit_memory_model([2, 2, 2], [1.0, 3.0, 2.0]) == (3.0, 0.0)
+    a, b = job_memory.fit_memory_model([1, 2, 3], [1.0, 2.5, 3.0])
+    assert np.isclose(b, 1.0) and np.isclose(a, 0.5)
@@ -0,0 +1,36 @@
+#---------------------------------------------------------------------------------------------------
+# Job timing: the number of workers of a stage is tuned on its first jobs, at the knee of the
+# throughput, and kept for the type of node
+#---------------------------------------------------------------------------------------------------
+
+import os, time
+import numpy as np
+from astropy.table import Table
+
+from supermopex import *
+import job_timing
+
+
+def test_tune_workers(workdir):
+
+    if os.path.exists(TimingDB):
+        os.remove(TimingDB)
+    JobList = Table([np.full(20, 5)], names=['NumFrames'])
+
+    #jobs of 0.1 s, of which the node runs two at a time whatever the workers
+    tried = list()
+    def run(jobs, Nworkers):
+        tried.append(Nworkers)
+        time.sleep(0.1 * np.ceil(len(jobs) / min(Nworkers, 2)))
+        return([(JobNo, 'ok', 0.1, '', None) for JobNo in jobs])
+
+    Nworkers, results, order = job_timing.tune_workers(run, 'tunestage', JobList, list(range(20)), 8)
+    assert tried == [1, 2, 4]
+    assert Nworkers == 2
+    assert [result[0] for result in results] == list(range(14)) and order == list(range(14, 20))
+    assert job_timing.tuned_workers('tunestage') == 2
+    assert job_timing.tuned_workers('tunestage', 'othernode') is None
+
+    #the fewest workers within KneeTolerance of the best throughput
+    assert job_timing.throughput_knee([1, 2, 4, 8], [10.0, 19.0, 20.0, 19.5]) == 2
+    assert job_timing.throughput_knee([1, 2, 4], [10.0, 15.0, 20.0]) == 4
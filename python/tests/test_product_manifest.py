@@ -0,0 +1,120 @@
+#---------------------------------------------------------------------------------------------------
+# Product manifest: the jobs record in the local manifest of the node through one connection per
+# process, the stage merges the rows into the shared manifest, and reruns skip the current products
+#---------------------------------------------------------------------------------------------------
+
+import os, time
+import multiprocessing as mp
+from astropy.table import Table
+
+from supermopex import *
+import product_manifest, job_timing
+
+
+def write_products(directory, DCEs):
+
+    os.makedirs(directory, exist_ok=True)
+    products = list()
+    for DCE in DCEs:
+        path = os.path.join(directory, 'frame_{:d}_{:}.fits'.format(DCE, SubtractedSuffix))
+        with open(path, 'w') as f:
+            f.write(str(DCE))
+        products.append((DCE, 1, 11, SubtractedSuffix, path, 'inputs{:d}'.format(DCE)))
+    return(products)
+
+
+def record_job(products):
+
+    for product in products:
+        product_manifest.record_products('subtract_medians', [product])
+    return([key for key in product_manifest.Connections if key[0] == os.getpid()])
+
+
+def test_manifest_local_records_and_merge(workdir):
+
+    for db in (ManifestDB, product_manifest.local_manifest()):
+        if os.path.exists(db):
+            os.remove(db)
+    products = write_products(os.path.join(workdir, 'Products', 'manifest'), range(1, 13))
+
+    #forked jobs of two processes record their frames one by one, each on its own connection
+    with mp.get_context('fork').Pool(2) as pool:
+        keys = pool.map(record_job, [products[0:6], products[6:12]])
+    for key in keys:
+        assert key == [(key[0][0], product_manifest.local_manifest())]
+    assert not product_manifest.manifest_exists()
+
+    #the stage moves them into the shared manifest
+    assert product_manifest.merge_local_manifest() == 12
+    assert product_manifest.merge_local_manifest() == 0
+    assert sorted(product_manifest.product_dces(SubtractedSuffix)) == sorted((path, DCE) for (DCE, Ch, AOR, name, path, inputs) in products)
+
+    #a rerun skips the frames recorded from the same inputs, whose files did not change
+    DCE, Ch, AOR, name, path, inputs = products[0]
+    assert product_manifest.products_current([path], inputs)
+    assert not product_manifest.products_current([path], 'other inputs')
+    with open(path, 'a') as f:
+        f.write('changed')
+    assert not product_manifest.products_current([path], inputs)
+    assert len([key for key in product_manifest.Connections if key[0] == os.getpid()]) == 1
+
+
+#---------------------------------------------------------------------------------------------------
+# The rows of a job reach the shared manifest as the job ends, while the stage still runs: a stage
+# that dies and is rerun on another node skips the frames of the jobs that ended
+#---------------------------------------------------------------------------------------------------
+
+StageProducts = None   #the products of each job, inherited by the workers
+
+
+def stage_job(JobNo):
+
+    product_manifest.record_products('subtract_medians', [StageProducts[JobNo]])
+    if JobNo == 2:
+        #the last job runs once the first two ended: their rows are in the shared manifest by then
+        for wait in range(100):
+            if all(product_manifest.products_current([path], inputs) for (DCE, Ch, AOR, name, path, inputs) in StageProducts[:2]):
+                return(None)
+            time.sleep(0.1)
+        raise RuntimeError('rows of the jobs that ended not in the shared manifest')
+    return(None)
+
+
+def test_manifest_merged_as_jobs_end(workdir):
+
+    global StageProducts
+    for db in (ManifestDB, product_manifest.local_manifest()):
+        if os.path.exists(db):
+            os.remove(db)
+    StageProducts = write_products(os.path.join(workdir, 'Products', 'stage'), range(21, 24))
+    product_manifest.open_manifest().close()
+
+    results = job_timing.run_timed_jobs(stage_job, Table([[1, 1, 1]], names=['NumFrames']), 2, 'teststage', speculate=False)
+    assert [result[1] for result in results] == ['ok', 'ok', 'ok']
+
+
+def write_rows(products):
+
+    for product in products:
+        product_manifest.record_products('subtract_medians', [product])
+
+
+def test_manifest_merge_while_jobs_write(workdir):
+
+    for db in (ManifestDB, product_manifest.local_manifest()):
+        if os.path.exists(db):
+            os.remove(db)
+    products = write_products(os.path.join(workdir, 'Products', 'concurrent'), range(1000, 1900))
+
+    #the parent merges while its workers write their rows: it waits for them, without deadlock
+    workers = [mp.get_context('fork').Process(target=write_rows, args=(products[start:start+300],)) for start in (0, 300, 600)]
+    for worker in workers:
+        worker.start()
+    Nrows = 0
+    while any(worker.is_alive() for worker in workers):
+        Nrows += product_manifest.merge_local_manifest()
+    for worker in workers:
+        worker.join()
+    Nrows += product_manifest.merge_local_manifest()
+    assert [worker.exitcode for worker in workers] == [0, 0, 0]
+    assert Nrows == 900
@@ -0,0 +1,100 @@
+#---------------------------------------------------------------------------------------------------
+# Product store: the frame products in the containers of their directory, with slots for the frames
+# added after the index was written, and the products mopex reads always written as files
+#---------------------------------------------------------------------------------------------------
+
+import os
+import numpy as np
+
+from supermopex import *
+import product_store
+from irac_frames import read_frame_header
+
+
+def add_frames(directory, stems):
+
+    for stem in stems:
+        open(os.path.join(directory, stem + '_' + bcdSuffix + '.fits'), 'w').close()
+    return([os.path.join(directory, stem + '_' + ffSuffix + '.fits') for stem in stems])
+
+
+def test_cube_frames_added_later(workdir, monkeypatch):
+
+    monkeypatch.setattr(product_store, 'ProductStore', 'cube')
+    monkeypatch.setattr(product_store, 'FrameSlots', dict())
+    directory = os.path.join(workdir, 'Data', 'cube', 'ch1', 'bcd')
+    os.makedirs(directory, exist_ok=True)
+
+    paths = add_frames(directory, ['SPITZER_I1_0001', 'SPITZER_I1_0003'])
+    for number, path in enumerate(paths):
+        product_store.write_product(path, np.full((4, 4), number, dtype=np.float32))
+
+    #a frame added once the index is written gets a slot of its own
+    paths += add_frames(directory, ['SPITZER_I1_0002'])
+    product_store.write_product(paths[2], np.full((4, 4), 2, dtype=np.float32))
+    for number, path in enumerate(paths):
+        assert not os.path.exists(path)
+        assert product_store.cube_slot(path) == (os.path.join(directory, ffSuffix + '.cube'), number)
+        assert np.all(product_store.read_product(path)[0] == number)
+    assert sorted(name for name in os.listdir(directory) if name.startswith('frames.index')) == ['frames.index', 'frames.index.1']
+
+    #as seen by a process that read none of the index
+    monkeypatch.setattr(product_store, 'FrameSlots', dict())
+    assert product_store.frame_slots(directory, 'SPITZER_I1_0002') == {'SPITZER_I1_0001': 0, 'SPITZER_I1_0003': 1, 'SPITZER_I1_0002': 2}
+
+    #the products that mopex reads stay files, even when listed in CubeProducts
+    monkeypatch.setattr(product_store, 'CubeProducts', CubeProducts + MopexProducts)
+    sub = os.path.join(directory, 'SPITZER_I1_0001_' + SubtractedSuffix + '.fits')
+    assert product_store.cube_slot(sub) is None
+    product_store.write_product(sub, np.zeros((4, 4), dtype=np.float32))
+    assert os.path.isfile(sub)
+
+
+def test_mef_frame_set(workdir, monkeypatch):
+
+    monkeypatch.setattr(product_store, 'FrameLayout', 'mef')
+    directory = os.path.join(workdir, 'Data', 'mef', 'ch1', 'bcd')
+    os.makedirs(directory, exist_ok=True)
+    ffcbcd = add_frames(directory, ['SPITZER_I1_0001'])[0]
+    stbcd = product_store.sibling_path(ffcbcd, starsubSuffix)
+    image, unc, mask = [np.full((4, 4), value, dtype=np.float32) for value in (1, 2, 3)]
+    product_store.write_product(product_store.sibling_path(ffcbcd, corUncSuffix), unc)
+
+    #the stbcd is one file with its new stmsk; the cbunc, an input, is read from its file
+    product_store.write_frame_set(stbcd, [(image, None), product_store.sibling_path(ffcbcd, corUncSuffix), (mask, None)], None, [starMaskSuffix])
+    assert [header['EXTNAME'] for data, header in product_store.read_product_hdus(stbcd)] == ['SCI', 'MASK']
+    assert product_store.frame_set_products(stbcd) == [stbcd, product_store.sibling_path(ffcbcd, corUncSuffix)]
+    assert product_store.frame_set_outputs(stbcd, [starMaskSuffix]) == [(starsubSuffix, stbcd)]
+    assert not os.path.exists(product_store.sibling_path(ffcbcd, starMaskSuffix))
+    planes = product_store.read_frame_set(stbcd)
+    assert [float(data[0, 0]) for data, header in planes] == [1, 2, 3]
+    assert not any(b'EXTNAME' in header['cards'] for data, header in planes)
+
+    #the sub is files, with the stmsk, for mopex
+    sub = product_store.sibling_path(ffcbcd, SubtractedSuffix)
+    product_store.write_frame_set(sub, planes, None, [ScaledUncSuffix, starMaskSuffix])
+    for suffix, value in ((SubtractedSuffix, 1), (ScaledUncSuffix, 2), (starMaskSuffix, 3)):
+        data, header = product_store.read_product(product_store.sibling_path(ffcbcd, suffix))
+        assert float(data[0, 0]) == value
+
+
+def test_compressed_products(workdir, monkeypatch):
+
+    monkeypatch.setattr(product_store, 'CompressProducts', True)
+    directory = os.path.join(workdir, 'Data', 'compressed', 'ch1', 'bcd')
+    os.makedirs(directory, exist_ok=True)
+    stbcd = os.path.join(directory, 'SPITZER_I1_0001_' + starsubSuffix + '.fits')
+
+    #only the products read by the pipeline alone: not the mopex and swarp inputs, nor the whole field
+    assert product_store.compression(stbcd) == 0
+    assert product_store.compression(product_store.sibling_path(stbcd, SubtractedSuffix)) is None
+    assert product_store.compression(os.path.join(directory, PIDname + '.irac.tile.3.1.mosaic_unc.fits')) == QuantizeLevel
+    for mosaic in ['.irac.tile.3.1.mosaic_cov.fits', '.irac.tile.3.1.median_mosaic_unc.fits', '.irac.1.mosaic_unc.fits']:
+        assert product_store.compression(os.path.join(directory, PIDname + mosaic)) is None
+
+    #the header gives the layout of the image, not of the table that holds it
+    image = np.arange(256*256, dtype=np.float32).reshape(256, 256)
+    product_store.write_product(stbcd, image)
+    header = read_frame_header(stbcd, ['BITPIX', 'NAXIS', 'NAXIS1', 'NAXIS2'])
+    assert [header[keyword] for keyword in ['BITPIX', 'NAXIS', 'NAXIS1', 'NAXIS2']] == [-32, 2, 256, 256]
+    assert np.all(product_store.read_product(stbcd)[0] == image)
@@ -0,0 +1,54 @@
+#---------------------------------------------------------------------------------------------------
+# Stage scheduler: each task of the graph starts after those it depends on, a failed task skips
+# only the tasks after it, and the scheduler then exits with status 1
+#---------------------------------------------------------------------------------------------------
+
+import os, sys, types
+import numpy as np
+from astropy.table import Table
+
+from supermopex import *
+import stage_scheduler
+
+
+def stub_stage(stage):
+
+    def run_job(JobNo):
+        with open('tasks.log', 'a') as f:
+            f.write('{:} {:}\n'.format(stage, JobNo))
+        if (stage == 'make_medians') and (JobNo == 1):
+            raise ValueError('bad median')
+        return(None)
+    return(types.SimpleNamespace(load_stage_data=lambda **options: None, run_job=run_job))
+
+
+def test_stage_graph(workdir, monkeypatch):
+
+    monkeypatch.setattr(stage_scheduler, 'StageModules', dict((stage, stub_stage(stage)) for stage in stage_scheduler.StageModules))
+    monkeypatch.setattr(stage_scheduler, 'LoadedStages', set())
+    with open('merge_stub.py', 'w') as f:
+        f.write("open('tasks.log', 'a').write('merge_stars 0\\n')\n")
+    monkeypatch.setattr(stage_scheduler, 'BarrierScripts', {'merge_stars': 'merge_stub.py'})
+    if os.path.exists('tasks.log'):
+        os.remove('tasks.log')
+
+    #two AORs of one channel, in two chunks each, with an exposure each
+    ChunkJobs = Table([[11, 11, 22, 22], [1, 1, 1, 1], [5, 5, 5, 5]], names=['AOR','Channel','NumFrames'])
+    JobList = Table([[11, 22], [1, 1], [10, 10]], names=['AOR','Channel','NumFrames'])
+    ExposureJobs = Table([[11, 22], [10, 10]], names=['AOR','NumFrames'])
+    tasks, depends = stage_scheduler.make_graph(ChunkJobs, JobList, ExposureJobs)
+    results = stage_scheduler.run_stages(tasks, depends, ChunkJobs, JobList, ExposureJobs, 3)
+
+    #every task that ran started after those it waited for
+    ran = [(stage, int(JobNo)) for stage, JobNo in (line.split() for line in open('tasks.log'))]
+    for task in ran:
+        assert all(before in ran[:ran.index(task)] for before in depends[task]), task
+
+    #the failed make_medians of the second AOR skips only its subtract_medians
+    status = dict((task, status) for (task, status, elapsed, message, value) in results)
+    assert status[('make_medians', 1)] == 'failed'
+    assert [status[('subtract_medians', JobNo)] for JobNo in range(4)] == ['ok', 'ok', 'skipped', 'skipped']
+    assert all(status[task] == 'ok' for task in tasks if task[0] not in ('make_medians', 'subtract_medians'))
+    assert ('subtract_medians', 2) not in ran
+    assert stage_scheduler.exit_status(results) == 1
+    assert stage_scheduler.exit_status([result for result in results if result[1] == 'ok']) == 0
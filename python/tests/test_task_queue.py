@@ -0,0 +1,50 @@
+#---------------------------------------------------------------------------------------------------
+# Task queue: local workers run the jobs of a queue; the job of a worker that died is run again once
+# its lease expired and the worker is replaced, a job past its timeout is killed, and the failed
+# jobs are retried JobRetries times
+#---------------------------------------------------------------------------------------------------
+
+import os, time, signal
+
+from supermopex import *
+import task_queue
+
+
+def job(JobNo):
+
+    if JobNo == 1:
+        if not os.path.exists('killed.1'):
+            open('killed.1', 'w').close()
+            os.kill(os.getppid(), signal.SIGKILL)   #the worker dies with its job
+            time.sleep(1)
+    elif JobNo == 2:
+        raise ValueError('bad frame')
+    elif JobNo == 3:
+        time.sleep(600)   #hung
+    return(10*JobNo)
+
+
+def test_queue_workers(workdir, monkeypatch, capfd):
+
+    monkeypatch.setattr(task_queue, 'LeaseTimeout', 1.5)
+    monkeypatch.setattr(task_queue, 'HeartbeatInterval', 0.2)
+    monkeypatch.setattr(task_queue, 'PollInterval', 0.1)
+    if os.path.exists('killed.1'):
+        os.remove('killed.1')
+
+    start = time.time()
+    results = task_queue.run_queue(job, 8, 3, 'teststage', timeouts=[60, 60, 60, 1, 60, 60, 60, 60])
+    assert time.time() - start < 30
+    assert [result[0] for result in results] == list(range(8))
+    assert [result[1] for result in results] == ['ok', 'ok', 'failed', 'timeout', 'ok', 'ok', 'ok', 'ok']
+    assert [result[4] for result in results if result[1] == 'ok'] == [0, 10, 40, 50, 60, 70]
+    assert 'bad frame' in results[2][3]
+
+    queue = task_queue.queue_dir('teststage')
+    tries = [int(open(queue + 'tries/' + str(JobNo)).read()) for JobNo in range(8)]
+    assert tries == [1, 2, JobRetries+1, JobRetries+1, 1, 1, 1, 1]
+    assert not [name for name in os.listdir(queue + 'leases')]
+
+    output = capfd.readouterr().out
+    assert 'job 1: lease of' in output
+    assert 'died (exit code -9); replaced' in output